@@ -171,6 +171,14 @@ def ResponseNormUndo(outGrad, denoms, inGrad, acts, targets, numChannels, sizeX,
                acts.p_mat, targets.p_mat, numChannels, sizeX,
                ct.c_float(addScale), ct.c_float(powScale))
 
+def RGBToYUV(images, targets):
+  """
+  images - (n_images, img_w**2 * 3) in RGB.
+  targets - (n_images, img_w**2 * 3) in YUV.
+  """
+  assert targets.shape == images.shape
+  _ConvNet.RGBToYUV(images.p_mat, targets.p_mat)
+
 def ResponseNormCrossMapUndo(outGrad, inGrad, acts, targets, numChannels, sizeF,
                              addScale, powScale, blocked):
   assert targets.shape == outGrad.shape
@@ -0,0 +1,247 @@
+""" Jitters, crops, flips, normalizes and adds PCA colour noise to whole
+batches of images, like RawImageFileIterator::Transform and
+DataIterator::SampleNoise and DataIterator::AddNoise."""
+from numpy.lib.stride_tricks import as_strided
+from util import *
+
+def GetImageSizes(config):
+  """Returns the (y, x) size of the stored images of a DataStreamConfig, and
+  the (y, x) size of the patches taken from them."""
+  size_y = config.image_size_y if config.HasField('image_size_y') else config.image_size
+  size_x = config.image_size_x if config.HasField('image_size_x') else config.image_size
+  patch_y = config.gpu_image_size_y if config.HasField('gpu_image_size_y') else size_y
+  patch_x = config.gpu_image_size_x if config.HasField('gpu_image_size_x') else size_x
+  return (size_y, size_x), (patch_y, patch_x)
+
+def NeedsAugmenter(config):
+  size, patch_size = GetImageSizes(config)
+  return size != patch_size or config.can_flip or config.pca_noise_stddev > 0 \
+      or config.normalize or config.pixelwise_normalize \
+      or config.random_rotate_raw_image
+
+class JitterGrids(object):
+  """Sampling grids that rotate and scale size_y x size_x images, as
+  RawImageFileIterator::Transform does, for num_angles angles from -max_angle
+  to max_angle degrees and num_scales scales from 1 to min_scale.
+
+  Angles and scales are rounded to the nearest of these, so there are at most
+  num_angles x num_scales grids, each computed the first time it is used. A
+  grid holds, for every output pixel, the flat offset of the nearest source
+  pixel from the top left corner of the crop it is taken from, so translating
+  an image only adds to the offsets.
+  """
+
+  def __init__(self, size_y, size_x, max_angle, min_scale, num_angles=16,
+               num_scales=4):
+    self.size_y_ = size_y
+    self.size_x_ = size_x
+    self.max_angle_ = float(max_angle)
+    self.max_scale_ = float(max(min_scale, 1))
+    self.num_angles_ = num_angles if max_angle > 0 else 1
+    self.num_scales_ = num_scales if self.max_scale_ > 1 else 1
+    num_grids = self.num_angles_ * self.num_scales_
+    self.offsets_ = np.empty((num_grids, size_y * size_x), dtype=np.int32)
+    self.crop_sizes_ = np.empty((num_grids, 2), dtype=np.int32)
+    self.ready_ = np.zeros(num_grids, dtype=bool)
+
+  def GetNumGrids(self):
+    return int(self.ready_.sum())
+
+  def GetGrids(self, angles, scales):
+    """Returns the index of the grid for each of angles and scales."""
+    a = np.zeros(len(angles), dtype=np.int64)
+    s = np.zeros(len(scales), dtype=np.int64)
+    if self.num_angles_ > 1:
+      a = np.rint((np.asarray(angles) / self.max_angle_ + 1) / 2 * (self.num_angles_ - 1))
+      a = np.clip(a, 0, self.num_angles_ - 1).astype(np.int64)
+    if self.num_scales_ > 1:
+      # Scales below 1 are not applied, as in Transform.
+      s = (np.asarray(scales) - 1) / (self.max_scale_ - 1) * (self.num_scales_ - 1)
+      s = np.clip(np.rint(s), 0, self.num_scales_ - 1).astype(np.int64)
+    grids = a * self.num_scales_ + s
+    for g in np.unique(grids[~self.ready_[grids]]):
+      self.Compute(g)
+    return grids
+
+  def Compute(self, grid):
+    a, s = divmod(grid, self.num_scales_)
+    angle = 0.
+    if self.num_angles_ > 1:
+      angle = self.max_angle_ * (2. * a / (self.num_angles_ - 1) - 1)
+    scale = 1.
+    if self.num_scales_ > 1:
+      scale = 1 + (self.max_scale_ - 1) * float(s) / (self.num_scales_ - 1)
+    crop_y = int(self.size_y_ / scale)
+    crop_x = int(self.size_x_ / scale)
+    # Transform resizes the crop up by rot so that rotating it leaves no
+    # border in the center size_y x size_x patch.
+    # Positive angles turn the image counter-clockwise, as in rotateOCV.
+    theta = -np.deg2rad(angle)
+    rot = np.sin(abs(theta)) + np.cos(abs(theta))
+    y, x = np.mgrid[0:self.size_y_, 0:self.size_x_].astype(np.float32)
+    y -= (self.size_y_ - 1) / 2.
+    x -= (self.size_x_ - 1) / 2.
+    source_y = (np.cos(theta) * y - np.sin(theta) * x) * crop_y / (self.size_y_ * rot)
+    source_x = (np.sin(theta) * y + np.cos(theta) * x) * crop_x / (self.size_x_ * rot)
+    source_y = np.clip(np.rint(source_y + (crop_y - 1) / 2.), 0, crop_y - 1)
+    source_x = np.clip(np.rint(source_x + (crop_x - 1) / 2.), 0, crop_x - 1)
+    self.offsets_[grid] = (source_y * self.size_x_ + source_x).reshape(-1)
+    self.crop_sizes_[grid] = crop_y, crop_x
+    self.ready_[grid] = True
+
+  def Apply(self, images, grids, trans_y, trans_x, out=None):
+    """Returns images, a (n, colors, size_y, size_x) array, each sampled with
+    its grid from a crop at trans_y and trans_x, between 0 and 1, of the room
+    left around it."""
+    n, num_colors = images.shape[:2]
+    num_pixels = self.size_y_ * self.size_x_
+    if out is None:
+      out = np.empty(images.shape, dtype=images.dtype)
+    crop_sizes = self.crop_sizes_[grids]
+    top = ((self.size_y_ - crop_sizes[:, 0]) * trans_y).astype(np.int64)
+    left = ((self.size_x_ - crop_sizes[:, 1]) * trans_x).astype(np.int64)
+    start = np.arange(n) * num_colors * num_pixels + top * self.size_x_ + left
+    index = self.offsets_[grids] + start[:, None]
+    source = np.ascontiguousarray(images).reshape(-1)
+    out = out.reshape(n, num_colors, num_pixels)
+    for c in range(num_colors):
+      np.take(source, index, out=out[:, c])
+      if c < num_colors - 1:
+        index += num_pixels
+    return out.reshape(images.shape)
+
+class Augmenter(object):
+  """Adds the noise a DataStreamConfig asks for to batches of images, each a
+  row of num_colors x image_size_y x image_size_x values.
+
+  Every step works on the whole batch. With random_rotate_raw_image, images
+  are first rotated, scaled and translated by one gather per colour through
+  JitterGrids, with nearest neighbour sampling. Patches are gathered with one
+  fancy index into a strided view of all the windows of the images, and
+  flipped images are gathered from a reversed view. Normalization and PCA noise are
+  then one multiply and one add, with the noise of the batch drawn by one
+  small matmul.
+  """
+
+  def __init__(self, config, base_dir='', seed=0):
+    (self.size_y_, self.size_x_), (self.patch_y_, self.patch_x_) = GetImageSizes(config)
+    self.num_colors_ = config.num_colors
+    self.translate_ = config.can_translate
+    self.flip_ = config.can_flip
+    self.crop_ = self.flip_ or (self.size_y_, self.size_x_) != (self.patch_y_, self.patch_x_)
+    self.pca_noise_stddev_ = config.pca_noise_stddev
+    self.random_ = np.random.RandomState(seed)
+    self.jitter_ = None
+    if config.random_rotate_raw_image:
+      self.jitter_ = JitterGrids(self.size_y_, self.size_x_,
+                                 config.random_rotate_max_angle, config.min_scale)
+      self.max_angle_ = config.random_rotate_max_angle
+      self.min_scale_ = config.min_scale
+    self.jittered_ = None
+    self.scale_ = None
+    self.shift_ = np.zeros(self.num_colors_, dtype=np.float32)
+    self.mean_ = None
+    self.std_ = None
+    if config.normalize or config.pixelwise_normalize or self.pca_noise_stddev_ > 0:
+      if not config.mean_file:
+        raise Exception('Layer %s needs a mean_file.' % config.layer_name)
+      f = h5py.File(os.path.join(base_dir, config.mean_file), 'r')
+      if config.pixelwise_normalize:
+        mean = f['pixel_mean'].value.reshape(-1).astype(np.float32)
+        std = f['pixel_std'].value.reshape(-1).astype(np.float32)
+        self.scale_ = 1 / std
+        self.shift_ = -mean / std
+      elif config.normalize:
+        # Per dimension of the stored images, so applied before cropping.
+        self.mean_ = f['mean'].value.reshape(1, -1).astype(np.float32)
+        self.std_ = f['std'].value.reshape(1, -1).astype(np.float32)
+      if self.pca_noise_stddev_ > 0:
+        self.eig_values_ = f['S'].value.reshape(-1).astype(np.float32)
+        self.eig_vectors_ = f['U'].value.astype(np.float32)
+      f.close()
+    self.output_ = None
+    self.SampleNoise(1)
+
+  def GetDims(self):
+    return self.num_colors_ * self.patch_y_ * self.patch_x_
+
+  def SampleNoise(self, batch_size, multiplicity_id=0):
+    """Draws the offsets, flips and colour noise of the next batch. Without
+    can_translate, multiplicity_id picks the center or a corner patch, and
+    without can_flip, whether it is flipped, as for 10-view testing."""
+    max_y = self.size_y_ - self.patch_y_
+    max_x = self.size_x_ - self.patch_x_
+    if self.jitter_ is not None:
+      # As in RawImageFileIterator::SampleNoiseDistributions.
+      angles = self.max_angle_ * 2 * (self.random_.rand(batch_size) - 0.5)
+      self.trans_x_ = self.random_.rand(batch_size)
+      self.trans_y_ = self.random_.rand(batch_size)
+      scales = self.min_scale_ + (1 - self.min_scale_) * self.random_.rand(batch_size)
+      self.grids_ = self.jitter_.GetGrids(angles, scales)
+    if self.translate_:
+      self.offset_y_ = self.random_.randint(0, max_y + 1, batch_size)
+      self.offset_x_ = self.random_.randint(0, max_x + 1, batch_size)
+    else:
+      y, x = [(max_y / 2, max_x / 2), (0, 0), (0, max_x), (max_y, max_x),
+              (max_y, 0)][multiplicity_id % 5]
+      self.offset_y_ = np.repeat(y, batch_size)
+      self.offset_x_ = np.repeat(x, batch_size)
+    if self.flip_:
+      self.flip_bit_ = self.random_.rand(batch_size) > 0.5
+    else:
+      self.flip_bit_ = np.repeat(multiplicity_id / 5 > 0, batch_size)
+    if self.pca_noise_stddev_ > 0:
+      noise = self.random_.randn(batch_size, self.eig_values_.size).astype(np.float32)
+      noise *= self.eig_values_
+      self.noise_ = np.dot(noise, self.eig_vectors_.T) * self.pca_noise_stddev_
+    else:
+      self.noise_ = None
+
+  def AddNoise(self, data):
+    """Returns the augmented (batch size, GetDims()) float32 images for data,
+    with the noise of the last SampleNoise. The result is valid until the
+    next call."""
+    n = data.shape[0]
+    images = np.ascontiguousarray(data).reshape(
+      n, self.num_colors_, self.size_y_, self.size_x_)
+    if self.jitter_ is not None:
+      if self.jittered_ is None or self.jittered_.shape != images.shape \
+          or self.jittered_.dtype != images.dtype:
+        self.jittered_ = np.empty(images.shape, dtype=images.dtype)
+      images = self.jitter_.Apply(images, self.grids_[:n], self.trans_y_[:n],
+                                  self.trans_x_[:n], self.jittered_)
+    if self.mean_ is not None:
+      images = (images.reshape(n, -1) - self.mean_) / self.std_
+      images = images.reshape(n, self.num_colors_, self.size_y_, self.size_x_)
+    shape = (n, self.num_colors_, self.patch_y_, self.patch_x_)
+    if self.output_ is None or self.output_.shape != shape:
+      self.output_ = np.empty(shape, dtype=np.float32)
+    out = self.output_
+    if self.crop_:
+      for flip in (False, True):
+        rows = np.nonzero(self.flip_bit_[:n] == flip)[0]
+        if rows.size == 0:
+          continue
+        # Column c of a flipped patch is column size_x - 1 - (offset + c) of
+        # the image, as in kExtractPatches2.
+        source = images[..., ::-1] if flip else images
+        out[rows] = self.GetWindows(source)[
+          rows, :, self.offset_y_[rows], self.offset_x_[rows]]
+    else:
+      out[:] = images
+    if self.scale_ is not None:
+      out *= self.scale_[:, None, None]
+    if self.noise_ is not None:
+      out += (self.shift_ + self.noise_[:n])[:, :, None, None]
+    elif self.scale_ is not None:
+      out += self.shift_[:, None, None]
+    return out.reshape(n, -1)
+
+  def GetWindows(self, images):
+    """Returns a (n, colors, y offsets, x offsets, patch y, patch x) view of
+    every patch of images."""
+    n, c, y, x = images.shape
+    s = images.strides
+    return as_strided(images, (n, c, y - self.patch_y_ + 1, x - self.patch_x_ + 1,
+                               self.patch_y_, self.patch_x_),
+                      (s[0], s[1], s[2], s[3], s[2], s[3]))
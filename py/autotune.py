@@ -0,0 +1,44 @@
+import sys
+import numpy as np
+import convnet as cn
+from edge import EdgeWithWeight
+
+def Usage():
+  print 'python autotune.py <model_file(.pbtxt)> [<model_parameters(.h5)>] [batch_size ...]'
+
+def FillRandomWeights(model, seed=0):
+  """Gives every edge random weights, so that a model can be tuned before it
+  has parameters. The algorithms take the same time whatever the values."""
+  random = np.random.RandomState(seed)
+  for e in model.edge_:
+    if isinstance(e, EdgeWithWeight):
+      e.AllocateMemory()
+      n_out, n_in = e.weights_.shape
+      e.weights_.overwrite(random.randn(n_out, n_in).astype(np.float32) / np.sqrt(n_in))
+      e.bias_.assign(0)
+
+def main():
+  if len(sys.argv) < 2:
+    Usage()
+    sys.exit(1)
+  pbtxt_file = sys.argv[1]
+  args = sys.argv[2:]
+  params_file = args.pop(0) if args and not args[0].isdigit() else None
+  batch_sizes = [int(b) for b in args] or [1, 8, 32, 128]
+  model = cn.ConvNet(pbtxt_file)
+  if params_file is None:
+    FillRandomWeights(model)
+  else:
+    model.Load(params_file, lazy=True)
+  autotuner = model.SetAutotuner()
+  input_size = next(l for l in model.layer_ if l.IsInput()).GetSize()
+  edges = [e for e in model.edge_ if e.CanAutotune()]
+  for batch_size in batch_sizes:
+    data = np.random.RandomState(0).randn(batch_size, input_size).astype(np.float32)
+    model.Fprop(data)
+    print 'Batch size %d: %s' % (batch_size, ', '.join(
+      '%s %s' % (e.GetName(), e.GetAlgorithm()) for e in edges))
+  print 'Decisions for %s are in %s.' % (autotuner.cpu_model_, autotuner.cache_file_)
+
+if __name__ == '__main__':
+  main()
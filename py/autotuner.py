@@ -0,0 +1,82 @@
+""" Picks the fastest convolution algorithm for each shape by timing them."""
+import json
+import os
+import platform
+import time
+
+def GetCPUModel():
+  """Returns the model name of the host CPU."""
+  try:
+    for line in open('/proc/cpuinfo'):
+      if line.startswith('model name'):
+        return line.split(':', 1)[1].strip()
+  except IOError:
+    pass
+  return platform.processor() or platform.machine()
+
+def GetDefaultCacheFile():
+  return os.environ.get('CONVNET_AUTOTUNE_CACHE',
+                        os.path.expanduser('~/.convnet_autotune.json'))
+
+class Autotuner(object):
+  """Times the algorithms a ConvEdge supports the first time it meets a shape
+  (channels, filters, kernel size, stride, padding, image size and batch size)
+  and keeps the fastest one. Decisions are stored in cache_file under the CPU
+  model, so that later processes on the same kind of host do not time them
+  again."""
+
+  def __init__(self, cache_file=None, reps=3):
+    self.cache_file_ = GetDefaultCacheFile() if cache_file is None else cache_file
+    self.reps_ = reps
+    self.cpu_model_ = GetCPUModel()
+    self.decisions_ = self.ReadCache().get(self.cpu_model_, {})
+
+  def ReadCache(self):
+    if not os.path.exists(self.cache_file_):
+      return {}
+    try:
+      return json.load(open(self.cache_file_))
+    except ValueError:
+      return {}  # A corrupt cache only costs a re-tune.
+
+  def WriteCache(self):
+    # Merge with what other processes wrote since we read the file, then
+    # replace the file in one rename so that readers never see half of it.
+    cache = self.ReadCache()
+    cache.setdefault(self.cpu_model_, {}).update(self.decisions_)
+    tmp_file = '%s.%d.tmp' % (self.cache_file_, os.getpid())
+    with open(tmp_file, 'w') as f:
+      json.dump(cache, f, indent=1, sort_keys=True)
+    os.rename(tmp_file, self.cache_file_)
+
+  def GetKey(self, edge, batch_size):
+    return ','.join(str(x) for x in edge.GetShape() + (batch_size,))
+
+  def GetDecisions(self):
+    """Returns {shape_key: algorithm} for this CPU model."""
+    return dict(self.decisions_)
+
+  def Tune(self, edge, input_layer, output_layer):
+    """Sets the algorithm of edge for the batch size of input_layer, timing
+    the candidates on the layer states if the shape is not in the cache."""
+    batch_size = input_layer.GetState().shape[0]
+    key = self.GetKey(edge, batch_size)
+    algorithm = self.decisions_.get(key)
+    candidates = edge.GetAlgorithms()
+    if algorithm not in candidates:
+      times = {}
+      for candidate in candidates:
+        edge.SetAlgorithm(candidate)
+        edge.ComputeUp(input_layer, output_layer, True)  # Warm up.
+        best = None
+        for i in range(self.reps_):
+          start = time.time()
+          edge.ComputeUp(input_layer, output_layer, True)
+          t = time.time() - start
+          best = t if best is None else min(best, t)
+        times[candidate] = best
+      algorithm = min(candidates, key=lambda a: times[a])
+      self.decisions_[key] = algorithm
+      self.WriteCache()
+    edge.SetAlgorithm(algorithm)
+    return algorithm
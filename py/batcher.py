@@ -0,0 +1,153 @@
+""" Merges concurrent Fprop requests into batches."""
+import collections
+import threading
+import time
+import numpy as np
+
+# Seconds the batching thread is given to wake up and start a batch before a
+# deadline, on top of the expected run time.
+WAKE_UP_TIME = 0.002
+
+class DeadlineExceeded(Exception):
+  pass
+
+class Request(object):
+  """One caller's input rows and the layers it wants."""
+
+  def __init__(self, data, layers, deadline):
+    self.data_ = data
+    self.layers_ = layers
+    self.deadline_ = deadline
+    self.submit_time_ = time.time()
+    self.result_ = None
+    self.error_ = None
+    self.done_ = threading.Event()
+
+  def GetNumRows(self):
+    return self.data_.shape[0]
+
+  def Finish(self, result=None, error=None):
+    self.result_ = result
+    self.error_ = error
+    self.done_.set()
+
+  def Wait(self):
+    """Returns {layer: rows of its state}. Raises DeadlineExceeded if the
+    result is not ready by the deadline."""
+    timeout = None
+    if self.deadline_ is not None:
+      timeout = max(0, self.deadline_ - time.time())
+    if not self.done_.wait(timeout):
+      raise DeadlineExceeded('Deadline exceeded.')
+    if self.error_ is not None:
+      raise self.error_
+    return self.result_
+
+class Batcher(object):
+  """Runs the requests submitted by many threads on one model, merging those
+  that arrive together into one Fprop.
+
+  A batch is started when it has max_batch_size rows, when its first request
+  has waited max_wait seconds, or when waiting any longer would make a request
+  miss its deadline, given how long the last batches took. Requests whose
+  deadline has passed before they are started are dropped. Requests are run
+  in the order they arrive, and a request with more than max_batch_size rows
+  is run alone.
+  """
+
+  def __init__(self, model, max_batch_size=32, max_wait=0.005, history=10000):
+    self.model_ = model
+    self.max_batch_size_ = max_batch_size
+    self.max_wait_ = max_wait
+    self.cond_ = threading.Condition()
+    self.pending_ = collections.deque()
+    self.batch_sizes_ = collections.Counter()
+    self.wait_times_ = collections.deque(maxlen=history)
+    self.run_time_ = 0.
+    self.thread_ = threading.Thread(target=self.Loop)
+    self.thread_.daemon = True
+    self.thread_.start()
+
+  def Submit(self, data, layers, timeout=None):
+    """Queues data, a (n, input size) array, and returns a Request whose Wait
+    returns {layer: (n, layer size) array} for each of layers."""
+    for name in layers:
+      if name not in self.model_.layer_name_dict_:
+        raise Exception('Unknown layer %s.' % name)
+    deadline = None if timeout is None else time.time() + timeout
+    request = Request(data, layers, deadline)
+    with self.cond_:
+      self.pending_.append(request)
+      self.cond_.notify()
+    return request
+
+  def Compute(self, data, layers, timeout=None):
+    return self.Submit(data, layers, timeout).Wait()
+
+  def GetStats(self):
+    """Returns the number of queued requests, {batch size: number of batches}
+    and the 50th, 90th and 99th percentiles of the time requests waited to be
+    started, in milliseconds, over the last history requests."""
+    with self.cond_:
+      wait_times = list(self.wait_times_)
+      stats = {'queue_depth': len(self.pending_),
+               'batch_sizes': dict(self.batch_sizes_)}
+    if wait_times:
+      stats['wait_ms'] = dict((p, 1000 * np.percentile(wait_times, p))
+                              for p in (50, 90, 99))
+    return stats
+
+  def Loop(self):
+    while True:
+      self.Run(self.NextBatch())
+
+  def Expire(self, now):
+    for request in [r for r in self.pending_
+                    if r.deadline_ is not None and r.deadline_ <= now]:
+      self.pending_.remove(request)
+      request.Finish(error=DeadlineExceeded('Deadline exceeded before the request was started.'))
+
+  def NextBatch(self):
+    """Waits for requests to run and returns them."""
+    with self.cond_:
+      while True:
+        now = time.time()
+        self.Expire(now)
+        if not self.pending_:
+          self.cond_.wait()
+          continue
+        num_rows = sum(r.GetNumRows() for r in self.pending_)
+        start = min([self.pending_[0].submit_time_ + self.max_wait_] +
+                    [r.deadline_ - self.run_time_ - WAKE_UP_TIME for r in self.pending_
+                     if r.deadline_ is not None])
+        if num_rows >= self.max_batch_size_ or now >= start:
+          break
+        self.cond_.wait(start - now)
+      batch = [self.pending_.popleft()]
+      num_rows = batch[0].GetNumRows()
+      while self.pending_ and \
+            num_rows + self.pending_[0].GetNumRows() <= self.max_batch_size_:
+        num_rows += self.pending_[0].GetNumRows()
+        batch.append(self.pending_.popleft())
+      return batch
+
+  def Run(self, batch):
+    start = time.time()
+    with self.cond_:
+      self.batch_sizes_[sum(r.GetNumRows() for r in batch)] += 1
+      self.wait_times_.extend(start - r.submit_time_ for r in batch)
+    layers = sorted(set(l for r in batch for l in r.layers_))
+    try:
+      self.model_.Fprop(np.concatenate([r.data_ for r in batch]), targets=layers)
+      states = dict((l, self.model_.GetState(l)) for l in layers)
+    except Exception as e:
+      for r in batch:
+        r.Finish(error=e)
+      return
+    row = 0
+    for r in batch:
+      n = r.GetNumRows()
+      r.Finish(dict((l, states[l][row:row + n].copy()) for l in r.layers_))
+      row += n
+    # The batches after this one are likely to take about as long.
+    self.run_time_ = 0.8 * self.run_time_ + 0.2 * (time.time() - start)
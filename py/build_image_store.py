@@ -0,0 +1,18 @@
+import sys
+from image_store import WriteImageStore
+
+def Usage():
+  print 'python build_image_store.py <file_list(.txt)> <output_file> [raw_image_size] [image_size] [num_workers]'
+
+def main():
+  if len(sys.argv) < 3:
+    Usage()
+    sys.exit(1)
+  raw_image_size = int(sys.argv[3]) if len(sys.argv) > 3 else 256
+  image_size = int(sys.argv[4]) if len(sys.argv) > 4 else raw_image_size
+  num_workers = int(sys.argv[5]) if len(sys.argv) > 5 else 0
+  WriteImageStore(sys.argv[1], sys.argv[2], raw_image_size, image_size,
+                  image_size, num_workers)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,41 @@
+import os
+import sys
+import h5py
+import numpy as np
+
+def Usage():
+  print 'python convert_half.py <model_parameters(.h5)> <output(.h5)>'
+
+def ConvertToHalf(params_file, output_file):
+  """Copies params_file to output_file, storing the '<edge>:weight' datasets as
+  float16. Biases and other datasets are copied as they are. Datasets are
+  written contiguous, so that ParamsFile can memory-map them.
+
+  Raises an exception, and writes no output_file, if a weight does not fit in
+  float16."""
+  f = h5py.File(params_file, 'r')
+  g = h5py.File(output_file, 'w')
+  try:
+    for name in f.keys():
+      value = f[name][()]
+      if name.endswith(':weight') and value.dtype == np.float32:
+        value = value.astype(np.float16)
+        if not np.isfinite(value).all():
+          raise Exception('%s has weights out of the float16 range.' % name)
+      g.create_dataset(name, data=value)
+  except:
+    g.close()
+    os.remove(output_file)
+    raise
+  finally:
+    f.close()
+  g.close()
+
+def main():
+  if len(sys.argv) < 3:
+    Usage()
+    sys.exit(1)
+  ConvertToHalf(sys.argv[1], sys.argv[2])
+
+if __name__ == '__main__':
+  main()
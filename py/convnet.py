@@ -1,15 +1,37 @@
 """ Python implementation of forward props for ConvNet models."""
 from layer import *
+from memory_plan import PlanMemory
+from params_file import ParamsFile
+from autotuner import Autotuner
+from cpuconv import RGB_TO_YUV
+from image_reader import ReadFileList, ImageBatches, Prefetch, GetPool
 
 class ConvNet(object):
   def __init__(self, model_pbtxt):
-    self.model_ = convnet_config_pb2.Model()
-    proto_pbtxt = open(model_pbtxt, 'r')
-    text_format.Merge(proto_pbtxt.read(), self.model_)
+    """model_pbtxt is a .pbtxt file or a Model proto."""
+    if isinstance(model_pbtxt, convnet_config_pb2.Model):
+      self.model_ = model_pbtxt
+    else:
+      self.model_ = convnet_config_pb2.Model()
+      proto_pbtxt = open(model_pbtxt, 'r')
+      text_format.Merge(proto_pbtxt.read(), self.model_)
     self.layer_name_dict_ = {}
     self.BuildNet()
     self.normalizer_set_ = False
     self.batch_size_ = 0
+    self.params_file_ = None
+    self.loaded_edges_ = set()
+    self.pinned_layers_ = None
+    self.memory_plan_ = None
+    self.arena_ = []
+    self.arena_key_ = None
+    self.buckets_ = None
+    self.padded_input_ = None
+    self.num_images_ = 0
+    self.plan_cache_ = {}
+    self.active_plan_ = None
+    self.readable_layers_ = set()
+    self.channels_last_ = False
 
   def BuildNet(self):
     self.layer_ = []
@@ -19,22 +41,25 @@ class ConvNet(object):
       self.layer_.append(ChooseLayer(l))
     for e in self.model_.edge:
       self.edge_.append(ChooseEdge(e))
-   
     for l in self.layer_:
-      for e in self.edge_:
-        l_name = l.GetName()
-        
-        if l_name == e.GetSourceName():
-          l.AddOutgoingEdge(e)
-          e.SetSource(l)
+      self.layer_name_dict_[l.GetName()] = l
 
-        if l_name == e.GetDestName():
-          l.AddIncomingEdge(e)
-          e.SetDest(l)
+    for e in self.edge_:
+      source = self.layer_name_dict_.get(e.GetSourceName())
+      if source is not None:
+        source.AddOutgoingEdge(e)
+        e.SetSource(source)
+      dest = self.layer_name_dict_.get(e.GetDestName())
+      if dest is not None:
+        dest.AddIncomingEdge(e)
+        e.SetDest(dest)
 
     for l in self.layer_:
       if l.IsInput():
-        image_size = self.model_.patch_size
+        if self.model_.patch_size > 0:
+          image_size = self.model_.patch_size
+        else:
+          image_size = l.GetImageSize()
       else:
         # Incoming edge num_modules should be set because self.layer_ is sorted.
         image_size = l.incoming_edge_[0].GetNumModules()
@@ -43,78 +68,408 @@ class ConvNet(object):
       for e in l.outgoing_edge_:
         e.SetImageSize(image_size)
 
+    self.FuseActivations()
+
+  def FuseActivations(self):
+    """Merges each layer that has a single incoming edge with that edge, so that
+    the edge computes the layer's bias and activation along with its output.
+    Only the CPU backend has fused kernels."""
     for l in self.layer_:
-      self.layer_name_dict_[l.GetName()] = l
+      if len(l.incoming_edge_) != 1 or not l.CanFuseActivation():
+        continue
+      e = l.incoming_edge_[0]
+      if e.CanFuseActivation():
+        e.FuseActivation(isinstance(l, ReLULayer))
+        l.FuseActivation()
 
   def Sort(self):
-    def GetName(edge):
-      return '%s:%s' % (edge.source, edge.dest)
-
+    """Returns the layer protos in topological order, in time linear in the
+    number of layers and edges."""
     model = self.model_
     S = []
     L = []
-    outgoing_edge = {}
-    incoming_edge = {}
-    mark = {}
-    for l in model.layer:
-      outgoing_edge[l.name] = [e for e in model.edge if e.source == l.name]
-      incoming_edge[l.name] = [e for e in model.edge if e.dest == l.name]
+    layer_by_name = dict((l.name, l) for l in model.layer)
+    outgoing_edge = dict((l.name, []) for l in model.layer)
+    unmarked = dict((l.name, 0) for l in model.layer)  # Incoming edges not yet visited.
     for e in model.edge:
-      mark[GetName(e)] = False
+      if e.source in outgoing_edge and e.dest in unmarked:
+        outgoing_edge[e.source].append(e)
+        unmarked[e.dest] += 1
 
     for l in model.layer:
-      if l.is_input:
+      if l.is_input or unmarked[l.name] == 0:
         S.append(l)
     while len(S) > 0:
       n = S.pop()
       L.append(n)
       for e in outgoing_edge[n.name]:
-        mark[GetName(e)] = True
-        m = next(l for l in model.layer if l.name == e.dest)
-        if reduce(lambda x, y: x and y, [mark[GetName(ee)] for ee in incoming_edge[m.name]], True):
-          S.append(m)
+        unmarked[e.dest] -= 1
+        if unmarked[e.dest] == 0:
+          S.append(layer_by_name[e.dest])
     return L
 
-  def Load(self, params_file):
-    f = h5py.File(params_file)
-    for e in self.edge_:
+  def Load(self, params_file, targets=None, lazy=False):
+    """Loads the parameters of the edges needed to compute the target layers
+    (by default, all layers). Other edges are loaded when an Fprop first needs
+    them.
+
+    If lazy is True, nothing is read now. Each edge maps its parameters from
+    params_file, which can then also be an open ParamsFile or model_cache
+    Artifact, the first time it is used (see ParamsFile). A ParamsFile is
+    closed once every edge has read its parameters.
+    """
+    if lazy:
+      self.params_file_ = None
+      if isinstance(params_file, basestring):
+        params = ParamsFile(params_file)
+      else:
+        params = params_file
+      for e in self.edge_:
+        e.SetParamsFile(params)
+      return
+    self.params_file_ = params_file
+    self.LoadEdges(self.GetPlan(targets)[0])
+
+  def LoadEdges(self, layers):
+    edges = [e for l in layers for e in l.incoming_edge_
+             if e.GetName() not in self.loaded_edges_]
+    if len(edges) == 0 or self.params_file_ is None:
+      return
+    f = h5py.File(self.params_file_, 'r')
+    for e in edges:
+      start = time.time()
       e.AllocateMemory()
       e.LoadParams(f)
+      e.load_time_ = time.time() - start
+      self.loaded_edges_.add(e.GetName())
     f.close()
 
+  def GetLoadTimes(self):
+    """Returns {edge_name: seconds spent loading its parameters} for the edges
+    loaded so far."""
+    return dict((e.GetName(), e.GetLoadTime()) for e in self.edge_
+                if e.GetLoadTime() is not None)
+
+  def GetPlan(self, targets=None):
+    """Returns (layers, pinned_layers, memory_plan, input_layers, calls) for
+    computing the states of the target layers (by default, all layers).
+
+    layers are the layers that contribute to the targets, in topological
+    order. pinned_layers are the ones that can be read with GetState after
+    Fprop. calls are what Fprop runs after setting input_layers (see Compile).
+    Plans are cached per target set.
+    """
+    key = None if targets is None else frozenset(targets)
+    if key in self.plan_cache_:
+      return self.plan_cache_[key]
+
+    if targets is None:
+      layers = self.layer_
+    else:
+      for name in targets:
+        if name not in self.layer_name_dict_:
+          raise Exception('Unknown layer %s.' % name)
+      # Walk backwards from the targets. self.layer_ is sorted, so every layer
+      # is visited after all the layers it feeds into.
+      needed = set(targets)
+      for l in reversed(self.layer_):
+        if l.GetName() in needed:
+          needed.update(e.GetSourceName() for e in l.incoming_edge_)
+      layers = [l for l in self.layer_ if l.GetName() in needed]
+
+    names = set(l.GetName() for l in layers)
+    if self.pinned_layers_ is None:
+      pinned, memory_plan = names, None
+    else:
+      pinned = (self.pinned_layers_ | set(targets or [])) & names
+      memory_plan = PlanMemory(layers, pinned)
+    input_layers = [l for l in layers if l.IsInput()]
+    plan = (layers, pinned, memory_plan, input_layers, self.Compile(layers))
+    self.plan_cache_[key] = plan
+    return plan
+
+  def Compile(self, layers):
+    """Returns the (function, args) calls that compute the states of the
+    non-input layers among layers, in order: ComputeUp for each incoming edge,
+    then the activation. They are bound once per plan, so that Fprop does not
+    walk the graph. The states they write are the layers' buffers, which
+    AllocateStates sets before the calls run."""
+    calls = []
+    for l in layers:
+      if l.IsInput():
+        continue
+      for i, e in enumerate(l.incoming_edge_):
+        calls.append((e.ComputeUp, (e.GetSource(), l, i == 0)))
+      calls.append((l.ApplyActivation, ()))
+    return calls
+
+  def PlanMemory(self, pinned_layers=None):
+    """Shares state buffers between layers whose lifetimes do not overlap.
+
+    Only the pinned layers (the output layers by default) keep their state
+    after Fprop, so they are the only ones that can be read with GetState.
+    """
+    if pinned_layers is None:
+      pinned_layers = [l.GetName() for l in self.layer_ if l.IsOutput()]
+    for name in pinned_layers:
+      if name not in self.layer_name_dict_:
+        raise Exception('Unknown layer %s.' % name)
+    self.pinned_layers_ = set(pinned_layers)
+    self.plan_cache_ = {}
+    self.active_plan_ = None  # Reallocate on the next Fprop.
+    self.memory_plan_ = self.GetPlan()[2]
+
+  def GetMemoryUsage(self, batch_size, targets=None):
+    """Returns the number of bytes taken by layer states when computing the
+    target layers, and when computing all layers without a memory plan."""
+    unplanned = sum(l.GetSize() for l in self.layer_)
+    layers, _, memory_plan, _, _ = self.GetPlan(targets)
+    if memory_plan is None:
+      planned = sum(l.GetSize() for l in layers)
+    else:
+      planned = sum(memory_plan[1])
+    return 4 * batch_size * planned, 4 * batch_size * unplanned
+
+  def SetBatchBuckets(self, buckets):
+    """Allocates layer states once, for the largest of buckets (e.g.
+    [1, 8, 32, 128]). Each batch is padded up to the next bucket and runs on
+    views of those buffers, so changing the batch size does not reallocate.
+
+    Off by default. It is meant for the GPU, where allocation is expensive; its
+    benefit there has not been measured. On the CPU backend numpy allocation is
+    cheap and the padded rows cost more than it saves: for the MNIST net, over
+    batches of random size 1-128, mean latency goes from 15.0 ms to 24.4 ms
+    with buckets [1, 8, 32, 128]."""
+    self.buckets_ = sorted(buckets)
+    self.padded_input_ = None
+    self.batch_size_ = 0
+    self.active_plan_ = None
+
+  def GetBucket(self, batch_size):
+    for bucket in self.buckets_:
+      if bucket >= batch_size:
+        return bucket
+    raise Exception('Batch size %d is larger than the largest bucket %d.' % (
+      batch_size, self.buckets_[-1]))
+
+  def PadInput(self, input_data, bucket):
+    """Returns input_data padded with zero rows to bucket rows."""
+    batch_size, dims = input_data.shape
+    if batch_size == bucket:
+      return input_data
+    if self.padded_input_ is None or self.padded_input_.shape[1] != dims:
+      self.padded_input_ = np.zeros((self.buckets_[-1], dims), dtype=np.float32)
+    padded = self.padded_input_[:bucket]
+    padded[:batch_size] = input_data
+    padded[batch_size:] = 0
+    return padded
+
   def SetBatchSize(self, batch_size):
     self.batch_size_ = batch_size
-    for l in self.layer_:
-      l.AllocateMemory(self.batch_size_)
+    self.active_plan_ = None  # Reallocate on the next Fprop.
+
+  def AllocateStates(self, plan):
+    """Allocates the states of the layers in plan for the current batch size."""
+    layers, _, memory_plan, _, _ = plan
+    batch_size = self.batch_size_
+    self.active_plan_ = plan
+    if memory_plan is None and self.buckets_ is None:
+      for l in layers:
+        state = l.GetState()
+        if state is None or state.shape[0] != batch_size:
+          l.AllocateMemory(batch_size)
+      return
+
+    if memory_plan is None:
+      # One buffer per layer.
+      arena_of = dict((l.GetName(), i) for i, l in enumerate(layers))
+      arena_sizes = [l.GetSize() for l in layers]
+    else:
+      arena_of, arena_sizes = memory_plan
+    capacity = batch_size if self.buckets_ is None else self.buckets_[-1]
+    if self.arena_key_ is None or self.arena_key_[0] is not plan \
+       or self.arena_key_[1] != capacity:
+      self.arena_key_ = (plan, capacity)
+      for l in layers:
+        l.FreeMemory()
+      for arena in self.arena_:
+        arena.free_device_memory()
+      self.arena_ = []
+      for size in arena_sizes:
+        arena = cm.empty((1, capacity * size))
+        arena.assign(0)
+        self.arena_.append(arena)
+    for l in layers:
+      state = self.arena_[arena_of[l.GetName()]].slice(0, batch_size * l.GetSize())
+      state.reshape((batch_size, l.GetSize()))
+      l.SetState(state)
 
-  def Fprop(self, input_data):
-    batch_size = input_data.shape[0]
+  def Fprop(self, input_data, targets=None):
+    """Computes the states of the target layers (by default, all layers),
+    skipping the layers and edges that do not contribute to them."""
+    plan = self.GetPlan(targets)
+    layers, pinned, _, input_layers, calls = plan
+    self.num_images_ = input_data.shape[0]
+    if self.buckets_ is None:
+      batch_size = self.num_images_
+    else:
+      batch_size = self.GetBucket(self.num_images_)
+      input_data = self.PadInput(input_data, batch_size)
     if self.batch_size_ != batch_size:
       self.SetBatchSize(batch_size)
+    if plan is not self.active_plan_:
+      # The edges of the active plan are already loaded.
+      self.LoadEdges(layers)
+      self.AllocateStates(plan)
+
+    for l in input_layers:
+      state = l.GetState()
+      state.overwrite(input_data)
+      self.Normalize(state)
+      l.ApplyDropout()
+    for function, args in calls:
+      function(*args)
+    self.readable_layers_ = pinned
+
+  def Extract(self, source, layers, batch_size=128, resize=256, prefetch=2,
+              num_workers=0):
+    """Yields (ids, {layer: state}) for batches of up to batch_size images.
+
+    source is a file list such as test_images.txt, whose lines are image files
+    relative to its directory, or a sequence of (id, file_name). Images are
+    resized to resize pixels on their shorter side and center-cropped to the
+    input size. They are read on a background thread, up to prefetch batches
+    ahead of Fprop, so memory use does not grow with the length of the list.
+    With num_workers > 0, each batch is decoded by that many processes.
+    """
+    files = ReadFileList(source) if isinstance(source, basestring) else source
+    crop = self.GetInputLayer().GetImageSize()
+    pool = GetPool(num_workers)
+    try:
+      batches = ImageBatches(files, batch_size, resize, crop, pool)
+      for ids, data in Prefetch(batches, prefetch):
+        self.Fprop(data, targets=layers)
+        yield ids, dict((name, self.GetState(name).copy()) for name in layers)
+    finally:
+      if pool is not None:
+        pool.terminate()
+
+  def Quantize(self, calibration_data, edge_names=None):
+    """Switches edges to int8 weights (one scale per output channel) and int8
+    inputs. calibration_data is a sample of inputs: a forward prop through it
+    gives the range of the input of every edge. edge_names are the edges to
+    quantize, by default every conv and fully connected edge that supports it.
+    The other edges stay in float32. With batch buckets, the calibration
+    data is propagated in slices of at most the largest bucket.
+
+    Only the CPU backend has quantized kernels. They simulate int8 inference:
+    the weights take a quarter of the memory, but the GEMMs run in float32 on
+    the widened values (see cpuconv.GemmQuantized), with no speedup.
+    """
+    if edge_names is None:
+      edges = [e for e in self.edge_ if e.CanQuantize()]
+    else:
+      edges = [e for e in self.edge_ if e.GetName() in edge_names]
+      if len(edges) != len(set(edge_names)):
+        raise Exception('Unknown edge in %s.' % ', '.join(edge_names))
+      for e in edges:
+        if not e.CanQuantize():
+          raise Exception('Edge %s can not be quantized.' % e.GetName())
+
+    # Keep every layer state for the calibration pass.
+    pinned_layers = self.pinned_layers_
+    self.pinned_layers_ = None
+    self.plan_cache_ = {}
+    num_images = calibration_data.shape[0]
+    batch_size = num_images if self.buckets_ is None else self.buckets_[-1]
+    ranges = dict((e.GetName(), 0) for e in edges)
+    for start in range(0, num_images, batch_size):
+      batch = calibration_data[start:start + batch_size]
+      self.Fprop(batch)
+      for e in edges:
+        state = e.GetSource().GetState().asarray()[:batch.shape[0]]
+        ranges[e.GetName()] = max(ranges[e.GetName()], np.abs(state).max())
+    self.pinned_layers_ = pinned_layers
+    self.plan_cache_ = {}
+    self.active_plan_ = None
+    if self.pinned_layers_ is not None:
+      self.memory_plan_ = self.GetPlan()[2]
+
+    for e in edges:
+      input_range = ranges[e.GetName()]
+      e.Quantize(input_range / 127 if input_range > 0 else 1)
+
+  def SetAutotuner(self, cache_file=None):
+    """Makes each conv edge time its algorithms the first time it runs at a
+    batch size, and use the fastest. Decisions are cached in cache_file (by
+    default $CONVNET_AUTOTUNE_CACHE or ~/.convnet_autotune.json), keyed by
+    shape and CPU model. Only the CPU backend has more than one algorithm.
+    Returns the Autotuner."""
+    if not USE_CPU:
+      raise Exception('Autotuning needs the CPU backend.')
+    autotuner = Autotuner(cache_file)
+    for e in self.edge_:
+      if e.CanAutotune():
+        e.SetAutotuner(autotuner)
+    return autotuner
+
+  def SetChannelsLast(self):
+    """Stores the states of conv, one-to-one, pooling, response norm and YUV
+    layers channels-last (see cpuconv.py), which suits the CPU kernels better.
+    The layout of the net is converted only at its boundaries: the edges after
+    an input layer read the input layout, fully connected edges after such a
+    layer get their weight columns permuted once, when they are loaded, and
+    GetState returns the usual layout. Only the CPU backend has channels-last
+    kernels. FFT conv edges then use direct convolution instead. There are no
+    channels-last int8 kernels: Quantize skips the edges that touch a
+    channels-last layer, and SetChannelsLast can not follow Quantize."""
+    if not USE_CPU:
+      raise Exception('The channels-last layout needs the CPU backend.')
+    if any(e.quantized_ for e in self.edge_):
+      raise Exception('The channels-last layout can not be set after Quantize.')
+    self.channels_last_ = True
+    self.MatchLayouts()
 
+  def MatchLayouts(self):
+    channels_last = set(
+      l for l in self.layer_ if self.channels_last_ and not l.IsInput()
+      and l.CanUseChannelsLast()
+      and all(e.CanUseChannelsLast() for e in l.incoming_edge_))
+    # Edges other than fully connected ones only read channels-last layers when
+    # they also write one.
+    changed = True
+    while changed:
+      changed = False
+      for l in list(channels_last):
+        if any(not e.CanReadChannelsLast() and e.GetDest() not in channels_last
+               for e in l.outgoing_edge_):
+          channels_last.remove(l)
+          changed = True
     for l in self.layer_:
-      overwrite = True
-      for e in l.incoming_edge_:
-        e.ComputeUp(e.GetSource(), l, overwrite)
-        overwrite = False
-      if l.IsInput():
-        state = l.GetState()
-        state.overwrite(input_data)
-        self.Normalize(state)
-        l.ApplyDropout()
-      else:
-        l.ApplyActivation()
-        
+      l.SetChannelsLast(l in channels_last)
+    for e in self.edge_:
+      e.MatchLayout()
+
   def GetLayerNames(self):
     return [l.GetName() for l in self.layer_]
 
+  def GetInputLayer(self):
+    return next(l for l in self.layer_ if l.IsInput())
+
   def GetState(self, layer_name):
-    return self.layer_name_dict_[layer_name].GetState().asarray()
+    if layer_name not in self.readable_layers_:
+      raise Exception('Layer %s was not computed or not pinned in the last Fprop.' % layer_name)
+    l = self.layer_name_dict_[layer_name]
+    if l.IsChannelsLast():
+      return cc.ChannelsFirst(l.GetState(), l.GetNumChannels())[:self.num_images_]
+    return l.GetState().asarray()[:self.num_images_]
 
   def SetNormalizer(self, means_file, image_size=1):
-    f = h5py.File(means_file)
+    f = h5py.File(means_file, 'r')
     mean = f['pixel_mean'].value.reshape(1, -1)
     std  = f['pixel_std'].value.reshape(1, -1)
+    self.pixel_mean_ = mean.reshape(-1)
+    self.pixel_std_ = std.reshape(-1)
     self.mean_ = cm.CUDAMatrix(np.tile(mean, (image_size**2, 1)))
     self.std_  = cm.CUDAMatrix(np.tile(std,  (image_size**2, 1)))
     self.mean_.reshape((1, -1))
@@ -125,3 +480,73 @@ class ConvNet(object):
     if self.normalizer_set_:
       state.add_row_mult(self.mean_, -1)
       state.div_by_row(self.std_)
+
+  def FoldNormalizer(self):
+    """Folds the input normalization, and RGB to YUV edges that follow the
+    input layers, into the weights and biases of the edges after them.
+
+    The normalization (x - mean) / std, applied to each pixel, is an affine map
+    of its channels, and so is RGB to YUV. Composed with the linear part of a
+    conv, one-to-one or fully connected edge, they give an edge with different
+    weights and bias. After this, Fprop does no work to normalize the input,
+    the mean and std buffers are freed, and the YUV layers no longer exist.
+    The state of an input layer is then the raw input.
+    """
+    if not self.normalizer_set_:
+      raise Exception('No normalizer set.')
+    # Every edge to fold into, with the input layer it will read from and the
+    # affine map (M, v) that precedes it.
+    folds = []
+    removed = []
+    for l in self.layer_:
+      if not l.IsInput():
+        continue
+      num_channels = l.GetNumChannels()
+      if self.pixel_mean_.size != num_channels:
+        raise Exception('Can only fold a per-channel mean and std, got %d values '
+                        'for %d channels.' % (self.pixel_mean_.size, num_channels))
+      scale = 1. / self.pixel_std_
+      M = np.diag(scale)
+      v = -self.pixel_mean_ * scale
+      for e in l.outgoing_edge_:
+        if e.CanFoldInputAffine():
+          folds.append((e, l, M, v))
+          continue
+        yuv = e.GetDest()
+        if not isinstance(e, RGBToYUVEdge) or type(yuv) is not Layer \
+           or yuv.dropprob_ > 0 or len(yuv.incoming_edge_) != 1 \
+           or yuv.IsOutput() \
+           or not all(ee.CanFoldInputAffine() for ee in yuv.outgoing_edge_):
+          raise Exception('Can not fold the normalizer into edge %s.' % e.GetName())
+        A = RGB_TO_YUV.astype(np.float64)
+        for ee in yuv.outgoing_edge_:
+          folds.append((ee, l, np.dot(A, M), np.dot(A, v)))
+        removed.append((l, e, yuv))
+
+    self.LoadEdges([e.GetDest() for e, _, _, _ in folds])
+    for e, l, M, v in folds:
+      e.FoldInputAffine(M, v)
+    for l, e, yuv in removed:
+      l.outgoing_edge_.remove(e)
+      for ee in yuv.outgoing_edge_:
+        ee.source_name_ = l.GetName()
+        ee.SetSource(l)
+        l.AddOutgoingEdge(ee)
+      yuv.FreeMemory()
+      self.edge_.remove(e)
+      self.layer_.remove(yuv)
+      del self.layer_name_dict_[yuv.GetName()]
+      if self.pinned_layers_ is not None:
+        self.pinned_layers_.discard(yuv.GetName())
+
+    self.normalizer_set_ = False
+    self.mean_.free_device_memory()
+    self.std_.free_device_memory()
+    self.mean_ = None
+    self.std_ = None
+    self.plan_cache_ = {}
+    self.active_plan_ = None
+    self.arena_key_ = None
+    if self.pinned_layers_ is not None:
+      self.memory_plan_ = self.GetPlan()[2]
+    self.MatchLayouts()
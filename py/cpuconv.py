@@ -0,0 +1,840 @@
+""" Host-memory implementations of the forward ops in cudamat_conv.
+
+The signatures and matrix layouts are the same as in cudamat_conv, so they can
+be used with the matrices from cpumat interchangeably:
+
+images  - (n_images, n_chans * img_w**2), stored as (n_chans, img_w, img_w, n_images)
+filters - (n_filters, n_chans * filter_w**2), stored as (n_chans, filter_w, filter_w, n_filters)
+targets - (n_images, n_filters * n_locs**2), stored as (n_filters, n_locs, n_locs, n_images)
+
+Scratch space (padded images, im2col matrices) is kept in module-level
+workspaces that grow to the largest size requested, so nothing is allocated
+per batch once every layer has run once.
+
+The *ChannelsLast functions at the end work on the channels-last layout
+described there.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+_workspace = {}
+
+# Same coefficients as kRGBToYUV in cudamat_conv.
+RGB_TO_YUV = np.array([[ 0.2126,   0.7152,   0.0722 ],
+                       [-0.09991, -0.33609,  0.436  ],
+                       [ 0.615,   -0.55861, -0.05639]], dtype=np.float32)
+
+def GetWorkspace(name, shape):
+  """Returns a float32 C-ordered array of the given shape backed by the
+  workspace called name. The contents are undefined."""
+  size = int(np.prod(shape))
+  buf = _workspace.get(name)
+  if buf is None or buf.size < size:
+    buf = np.empty(size, dtype=np.float32)
+    _workspace[name] = buf
+  return buf[:size].reshape(shape)
+
+def FreeWorkspace():
+  _workspace.clear()
+
+def _Images(mat, num_colors, img_size_y):
+  """ Returns a (n_chans, img_h, img_w, n_images) view of mat."""
+  num_images, dims = mat.shape
+  img_size_x = dims / (num_colors * img_size_y)
+  return mat.numpy_array.T.reshape(num_colors, img_size_y, img_size_x, num_images)
+
+def _Pad(images, name, padding, size_y, size_x, value):
+  """Returns images (n_chans, img_h, img_w, n_images) placed at offset
+  (padding, padding) inside a (n_chans, size_y, size_x, n_images) workspace
+  whose border is set to value."""
+  c, h, w, n = images.shape
+  if padding == 0 and size_y <= h and size_x <= w:
+    return images
+  padded = GetWorkspace(name, (c, size_y, size_x, n))
+  padded[:, :padding, :, :] = value
+  padded[:, padding + h:, :, :] = value
+  padded[:, padding:padding + h, :padding, :] = value
+  padded[:, padding:padding + h, padding + w:, :] = value
+  padded[:, padding:padding + h, padding:padding + w, :] = images
+  return padded
+
+# Size of the blocks of targets that the bias and ReLU are applied to, small
+# enough for a block to stay in cache while both are applied.
+BLOCK_BYTES = 1 << 18
+
+# Size of the blocks of int8 or float16 weights that are widened to float32 at
+# a time.
+WIDEN_BLOCK_BYTES = 1 << 22
+
+def _Im2Col(images, filterSize, imgSizeY, numModulesY, numModulesX, paddingStart, moduleStride, numImgColors):
+  """Returns the (n_chans * filter_w**2, n_locs**2 * n_images) matrix of image
+  patches, with rows in filter order and columns in target order."""
+  imgs = _Images(images, numImgColors, imgSizeY)
+  c, h, w, n = imgs.shape
+  size_y = max(h + paddingStart, (numModulesY - 1) * moduleStride + filterSize)
+  size_x = max(w + paddingStart, (numModulesX - 1) * moduleStride + filterSize)
+  padded = _Pad(imgs, 'conv_pad', paddingStart, size_y, size_x, 0)
+
+  sc, sy, sx, sn = padded.strides
+  patches = as_strided(padded,
+                       shape=(c, filterSize, filterSize, numModulesY, numModulesX, n),
+                       strides=(sc, sy, sx, sy * moduleStride, sx * moduleStride, sn))
+  cols = GetWorkspace('conv_cols', patches.shape)
+  cols[...] = patches
+  return cols.reshape(c * filterSize**2, -1)
+
+def convUp(images, filters, targets, imgSizeY, numModulesY, numModulesX, paddingStart, moduleStride, numImgColors, scaleTargets=0, numGroups=1):
+  """
+  images - (n_images, img_w**2 * n_chans)
+  filters - (n_filters, filter_w**2 * n_chans)
+  targets - (n_images, n_locs**2 * n_filters)
+  numModulesX - Number of filter locations along an axis. = n_locs
+  paddingStart - Set to k for a k-pixel border of zeros. Usually set to 0.
+  moduleStride - stride to move the filters by.
+  numImgColors - n_chans
+
+  The images are unrolled into a (filter_w**2 * n_chans, n_locs**2 * n_images)
+  matrix (im2col), so the whole batch is a single GEMM per group.
+  """
+  numImages = images.shape[0]
+  numFilters = filters.shape[0]
+  numFilterColors = numImgColors / numGroups
+  numFiltersPerGroup = numFilters / numGroups
+  filterSize = int(np.sqrt(filters.shape[1] / numFilterColors))
+
+  assert targets.shape == (numImages, numFilters * numModulesX * numModulesY), '%s %d %d-%d-%d' % (targets.shape.__str__(), numImages, numFilters, numModulesX, numModulesY)
+  assert filters.shape[1] == numFilterColors * filterSize**2
+
+  cols = _Im2Col(images, filterSize, imgSizeY, numModulesY, numModulesX,
+                 paddingStart, moduleStride, numImgColors)
+  cols = cols.reshape(numGroups, numFilterColors * filterSize**2, -1)
+
+  out = targets.numpy_array.T.reshape(numGroups, numFiltersPerGroup, -1)
+  w = filters.numpy_array
+  for g in range(numGroups):
+    w_g = w[g * numFiltersPerGroup:(g + 1) * numFiltersPerGroup]
+    if scaleTargets == 0:
+      np.dot(w_g, cols[g], out=out[g])
+    else:
+      out[g] *= scaleTargets
+      out[g] += np.dot(w_g, cols[g])
+
+def AddBiasReLU(out, bias, numImages, relu):
+  """Computes out += bias, followed by max(out, 0) if relu, one block of rows
+  at a time, so that out is read from memory once instead of twice.
+
+  out - (n_out, n_cols)
+  bias - (n_out, 1), or (n_out, n_cols / numImages) for a bias per location.
+  numImages - columns that share a bias value are consecutive runs of numImages.
+  """
+  n_out, n_cols = out.shape
+  block = max(1, BLOCK_BYTES / (4 * n_cols))
+  for start in range(0, n_out, block):
+    end = min(n_out, start + block)
+    t = out[start:end]
+    if bias.shape[1] == 1:
+      t += bias[start:end]
+    else:
+      t = t.reshape(end - start, -1, numImages)
+      t += bias[start:end, :, np.newaxis]
+    if relu:
+      np.maximum(t, 0, out=t)
+
+def convUpBias(images, filters, bias, targets, imgSizeY, numModulesY, numModulesX, paddingStart, moduleStride, numImgColors, relu, numGroups=1):
+  """
+  Same as convUp, followed by adding bias and, if relu, max(targets, 0), in a
+  single pass over targets (see AddBiasReLU).
+  bias - (1, n_filters) for a shared bias, or (1, n_filters * n_locs**2)
+  """
+  numImages = images.shape[0]
+  numFilters = filters.shape[0]
+  numFilterColors = numImgColors / numGroups
+  numFiltersPerGroup = numFilters / numGroups
+  filterSize = int(np.sqrt(filters.shape[1] / numFilterColors))
+
+  assert targets.shape == (numImages, numFilters * numModulesX * numModulesY)
+  assert filters.shape[1] == numFilterColors * filterSize**2
+
+  cols = _Im2Col(images, filterSize, imgSizeY, numModulesY, numModulesX,
+                 paddingStart, moduleStride, numImgColors)
+  cols = cols.reshape(numGroups, numFilterColors * filterSize**2, -1)
+
+  out = targets.numpy_array.T.reshape(numGroups, numFiltersPerGroup, -1)
+  w = filters.numpy_array
+  b = bias.numpy_array.reshape(numGroups, numFiltersPerGroup, -1)
+  for g in range(numGroups):
+    w_g = w[g * numFiltersPerGroup:(g + 1) * numFiltersPerGroup]
+    np.dot(w_g, cols[g], out=out[g])
+    AddBiasReLU(out[g], b[g], numImages, relu)
+
+def dotBias(images, filters, bias, targets, relu):
+  """
+  targets = images filters.T + bias, followed by max(targets, 0) if relu, in a
+  single pass over targets (see AddBiasReLU).
+  images - (n_images, n_in)
+  filters - (n_out, n_in)
+  bias - (1, n_out)
+  targets - (n_images, n_out)
+  """
+  assert targets.shape == (images.shape[0], filters.shape[0])
+  out = targets.numpy_array.T
+  np.dot(filters.numpy_array, images.numpy_array.T, out=out)
+  AddBiasReLU(out, bias.numpy_array.reshape(-1, 1), 1, relu)
+
+def QuantizeRows(w):
+  """Returns (w_q, scale): w quantized to int8 with one scale per row, so that
+  w ~ scale[:, np.newaxis] * w_q."""
+  w = np.asarray(w, dtype=np.float32)
+  scale = np.abs(w).max(axis=1) / 127
+  scale[scale == 0] = 1
+  w_q = np.empty(w.shape, dtype=np.int8)
+  np.rint(w / scale[:, np.newaxis], out=w_q, casting='unsafe')
+  return w_q, scale
+
+def _QuantizeInto(x, scale, x_q):
+  """Sets x_q to x / scale rounded and clipped to [-127, 127]. x_q may be x."""
+  np.multiply(x, 1. / scale, out=x_q)
+  np.rint(x_q, out=x_q)
+  np.clip(x_q, -127, 127, out=x_q)
+  return x_q
+
+def _WidenHalf(src, dst):
+  """Sets the float32 array dst to the float16 array src, which must be finite.
+
+  numpy converts float16 in software. Instead, the sign-extended bits of src
+  are shifted into place and the exponent is rebased by multiplying with
+  2**112, which is exact for every finite float16, subnormals included.
+  """
+  bits = dst.view(np.int32)
+  bits[...] = src.view(np.int16)
+  bits <<= 13
+  bits &= np.int32(-0x70000001)  # Keep the sign bit and the low 28 bits.
+  dst *= np.float32(2.**112)
+
+def _Widen(src, name):
+  """Returns src as float32, in the workspace called name, in the same memory
+  order as src."""
+  if src.flags.c_contiguous:
+    dst = GetWorkspace(name, src.shape)
+  else:
+    dst = GetWorkspace(name, src.shape[::-1]).T
+  if src.dtype == np.float16:
+    _WidenHalf(src, dst)
+  else:
+    dst[...] = src
+  return dst
+
+def GemmWiden(w, x, bias, out, numImages, relu, scale=None, scaleTargets=0):
+  """Computes out = scale (w x) + bias, followed by max(out, 0) if relu, for
+  weights w stored in a narrower type than float32 (int8 or float16).
+
+  w - (n_out, k)
+  x - (k, n_cols)
+  scale - (n_out,) or None
+  bias, numImages - see AddBiasReLU.
+  scaleTargets - if not 0, w x is added to scaleTargets * out. Needs scale None.
+
+  When w is the larger operand (fully connected layers), contiguous blocks of
+  it are widened to float32 in cache and multiplied with the float32 GEMM, so
+  the weights are only ever read from memory in their narrow type. Those are
+  blocks of rows if w is in C order, else blocks of columns whose products are
+  summed.
+  """
+  assert scale is None or scaleTargets == 0
+  n_out, k = w.shape
+  if w.size <= x.size:
+    w_wide = _Widen(w, 'widen_block')
+    if scaleTargets == 0:
+      np.dot(w_wide, x, out=out)
+    else:
+      out *= scaleTargets
+      out += np.dot(w_wide, x)
+  elif w.flags.c_contiguous:
+    block = max(1, WIDEN_BLOCK_BYTES / (4 * k))
+    for start in range(0, n_out, block):
+      end = min(n_out, start + block)
+      w_wide = _Widen(w[start:end], 'widen_block')
+      if scaleTargets == 0:
+        np.dot(w_wide, x, out=out[start:end])
+      else:
+        out[start:end] *= scaleTargets
+        out[start:end] += np.dot(w_wide, x)
+  else:
+    block = max(1, WIDEN_BLOCK_BYTES / (4 * n_out))
+    product = GetWorkspace('widen_product', out.shape)
+    for start in range(0, k, block):
+      end = min(k, start + block)
+      w_wide = _Widen(w[:, start:end], 'widen_block')
+      if start == 0 and scaleTargets == 0:
+        np.dot(w_wide, x[start:end], out=out)
+      else:
+        if start == 0:
+          out *= scaleTargets
+        np.dot(w_wide, x[start:end], out=product)
+        out += product
+  if scale is not None:
+    out *= scale[:, np.newaxis]
+  AddBiasReLU(out, bias, numImages, relu)
+
+def GemmQuantized(w_q, w_scale, x_q, x_scale, bias, out, numImages, relu):
+  """Computes out = (w_scale x_scale) (w_q x_q) + bias, followed by max(out, 0)
+  if relu.
+
+  w_q - (n_out, k) int8
+  w_scale - (n_out,)
+  x_q - (k, n_cols), integers in [-127, 127] stored as float32.
+  bias, numImages - see AddBiasReLU.
+
+  This simulates int8 quantization: the int8 values are widened and the GEMM
+  runs in float32 (see GemmWiden), so it is no faster than a float32 GEMM.
+  Sums of the integer products are exact only while they stay below 2**24.
+  With k = 9216 (fc6 of the ImageNet nets) they can reach 127 * 127 * 9216,
+  about 1.5e8, and are then rounded as in any float32 GEMM.
+  """
+  GemmWiden(w_q, x_q, bias, out, numImages, relu, w_scale * x_scale)
+
+def dotQuantized(images, filters_q, filters_scale, images_scale, bias, targets, relu):
+  """
+  Same as dotBias, with int8 filters (see QuantizeRows) and images quantized
+  to int8 with a single scale, images_scale.
+  """
+  assert targets.shape == (images.shape[0], filters_q.shape[0])
+  x = images.numpy_array.T
+  x_q = _QuantizeInto(x, images_scale, GetWorkspace('quantized_images', x.shape))
+  GemmQuantized(filters_q, filters_scale, x_q, images_scale,
+                bias.numpy_array.reshape(-1, 1), targets.numpy_array.T, 1, relu)
+
+def convUpQuantized(images, filters_q, filters_scale, images_scale, bias, targets, imgSizeY, numModulesY, numModulesX, paddingStart, moduleStride, numImgColors, relu):
+  """
+  Same as convUpBias, with int8 filters (see QuantizeRows) and images
+  quantized to int8 with a single scale, images_scale.
+  """
+  numImages = images.shape[0]
+  numFilters = filters_q.shape[0]
+  filterSize = int(np.sqrt(filters_q.shape[1] / numImgColors))
+  assert targets.shape == (numImages, numFilters * numModulesX * numModulesY)
+
+  cols = _Im2Col(images, filterSize, imgSizeY, numModulesY, numModulesX,
+                 paddingStart, moduleStride, numImgColors)
+  _QuantizeInto(cols, images_scale, cols)
+  GemmQuantized(filters_q, filters_scale, cols, images_scale,
+                bias.numpy_array.reshape(numFilters, -1),
+                targets.numpy_array.T.reshape(numFilters, -1), numImages, relu)
+
+def dotHalf(images, filters, bias, targets, relu, scaleTargets=0):
+  """
+  Same as dotBias, with float16 filters (an ndarray), and targets scaled by
+  scaleTargets before the product is added.
+  """
+  assert targets.shape == (images.shape[0], filters.shape[0])
+  GemmWiden(filters, images.numpy_array.T, bias.numpy_array.reshape(-1, 1),
+            targets.numpy_array.T, 1, relu, scaleTargets=scaleTargets)
+
+def convUpHalf(images, filters, bias, targets, imgSizeY, numModulesY, numModulesX, paddingStart, moduleStride, numImgColors, relu, scaleTargets=0):
+  """
+  Same as convUpBias, with float16 filters (an ndarray), and targets scaled
+  by scaleTargets before the convolution is added.
+  """
+  numImages = images.shape[0]
+  numFilters = filters.shape[0]
+  filterSize = int(np.sqrt(filters.shape[1] / numImgColors))
+  assert targets.shape == (numImages, numFilters * numModulesX * numModulesY)
+
+  cols = _Im2Col(images, filterSize, imgSizeY, numModulesY, numModulesX,
+                 paddingStart, moduleStride, numImgColors)
+  GemmWiden(filters, cols, bias.numpy_array.reshape(numFilters, -1),
+            targets.numpy_array.T.reshape(numFilters, -1), numImages, relu,
+            scaleTargets=scaleTargets)
+
+# Transforms for Winograd's F(2x2, 3x3) minimal filtering algorithm.
+WINOGRAD_G = np.array([[1, 0, 0], [.5, .5, .5], [.5, -.5, .5], [0, 0, 1]])
+
+def WinogradFilters(filters, numImgColors):
+  """Returns the (4, 4, n_filters, n_chans) Winograd transform of 3x3 filters."""
+  w = np.asarray(filters, dtype=np.float64).reshape(filters.shape[0], numImgColors, 3, 3)
+  u = np.einsum('ai,fcij,bj->abfc', WINOGRAD_G, w, WINOGRAD_G)
+  return np.ascontiguousarray(u, dtype=np.float32)
+
+def convUpWinograd(images, filters_w, bias, targets, imgSizeY, numModulesX, paddingStart, numImgColors, relu):
+  """
+  Same as convUpBias for 3x3 filters with stride 1, computed with Winograd's
+  F(2x2, 3x3) algorithm, which takes 16 multiplies per 2x2 outputs instead of
+  36.
+  filters_w - filters transformed by WinogradFilters.
+
+  Agrees with convUpBias to within about 1e-5 of the largest output.
+  """
+  numImages = images.shape[0]
+  numFilters = filters_w.shape[2]
+  M = numModulesX
+  T = (M + 1) / 2  # Number of 2x2 output tiles along an axis.
+  assert targets.shape == (numImages, numFilters * M * M)
+
+  imgs = _Images(images, numImgColors, imgSizeY)
+  c, h, w, n = imgs.shape
+  size = max(h + paddingStart, 2 * T + 2)
+  padded = _Pad(imgs, 'conv_pad', paddingStart, size, size, 0)
+  sc, sy, sx, sn = padded.strides
+  d = as_strided(padded, shape=(c, 4, 4, T, T, n),
+                 strides=(sc, sy, sx, 2 * sy, 2 * sx, sn))
+
+  # V = B^T d B, one (n_chans, tiles) matrix for each of the 4x4 positions.
+  def BT(x, i, out):
+    if i == 0:
+      np.subtract(x(0), x(2), out=out)
+    elif i == 1:
+      np.add(x(1), x(2), out=out)
+    elif i == 2:
+      np.subtract(x(2), x(1), out=out)
+    else:
+      np.subtract(x(1), x(3), out=out)
+  rows = GetWorkspace('winograd_rows', (4, c, 4, T, T, n))
+  for i in range(4):
+    BT(lambda k: d[:, k], i, rows[i])
+  v = GetWorkspace('winograd_v', (4, 4, c, T, T, n))
+  for i in range(4):
+    for j in range(4):
+      BT(lambda k: rows[i][:, k], j, v[i, j])
+
+  m = GetWorkspace('winograd_m', (4, 4, numFilters, T, T, n))
+  for i in range(4):
+    for j in range(4):
+      np.dot(filters_w[i, j], v[i, j].reshape(c, -1),
+             out=m[i, j].reshape(numFilters, -1))
+
+  # Y = A^T m A, written straight into the 2x2 interleaved outputs.
+  def AT(x, i, out):
+    if i == 0:
+      np.add(x(0), x(1), out=out)
+      out += x(2)
+    else:
+      np.subtract(x(1), x(2), out=out)
+      out -= x(3)
+  out = targets.numpy_array.T.reshape(numFilters, M, M, n)
+  half = GetWorkspace('winograd_rows', (4, numFilters, T, T, n))
+  for i in range(2):
+    AT(lambda k: m[k], i, half)
+    for j in range(2):
+      y = out[:, i::2, j::2, :]
+      AT(lambda k: half[k][:, :y.shape[1], :y.shape[2]], j, y)
+  AddBiasReLU(targets.numpy_array.T.reshape(numFilters, -1),
+              bias.numpy_array.reshape(numFilters, -1), numImages, relu)
+
+def _FFTSize(n):
+  """Returns the smallest integer >= n whose only prime factors are 2, 3, 5."""
+  while True:
+    m = n
+    for p in (2, 3, 5):
+      while m % p == 0:
+        m /= p
+    if m == 1:
+      return n
+    n += 1
+
+def GetFFTSize(imgSizeY, numModulesX, paddingStart, moduleStride, filterSize):
+  return _FFTSize(max(imgSizeY + paddingStart,
+                      (numModulesX - 1) * moduleStride + filterSize))
+
+def FFTFilters(filters, numImgColors, fftSize):
+  """Returns the conjugate Fourier transform of the filters, as a
+  (fftSize * (fftSize / 2 + 1), n_filters, n_chans) array."""
+  numFilters = filters.shape[0]
+  filterSize = int(np.sqrt(filters.shape[1] / numImgColors))
+  w = np.asarray(filters, dtype=np.float64).reshape(numFilters, numImgColors,
+                                                     filterSize, filterSize)
+  f = np.conj(np.fft.rfft2(w, s=(fftSize, fftSize)))
+  f = f.reshape(numFilters, numImgColors, -1).transpose(2, 0, 1)
+  return np.ascontiguousarray(f, dtype=np.complex64)
+
+def convUpFFT(images, filters_f, bias, targets, imgSizeY, numModulesX, paddingStart, moduleStride, numImgColors, fftSize, relu):
+  """
+  Same as convUpBias, computed as a pointwise product in the frequency domain.
+  The cost does not grow with the filter size, which pays off for large
+  filters with stride 1. Strided convolutions compute every stride 1 output
+  and keep the ones needed.
+  filters_f - filters transformed by FFTFilters.
+
+  The transforms are in float64 and the products in complex64, so this agrees
+  with convUpBias to within about 1e-6 of the largest output.
+  """
+  numImages = images.shape[0]
+  numFilters = filters_f.shape[1]
+  M = numModulesX
+  assert targets.shape == (numImages, numFilters * M * M)
+
+  imgs = _Images(images, numImgColors, imgSizeY)
+  c, h, w, n = imgs.shape
+  size = max(h + paddingStart, (M - 1) * moduleStride + 1)
+  padded = _Pad(imgs, 'conv_pad', paddingStart, size, size, 0)
+  # The transforms are much faster over the last, contiguous axes.
+  x = np.fft.rfft2(padded.transpose(0, 3, 1, 2), s=(fftSize, fftSize))
+  x = x.reshape(c, n, -1).transpose(2, 0, 1).astype(np.complex64)
+  y = np.matmul(filters_f, x)  # (freqs, n_filters, n_images)
+  y = y.transpose(1, 2, 0).reshape(numFilters, n, fftSize, -1)
+  y = np.fft.irfft2(y, s=(fftSize, fftSize))
+  end = (M - 1) * moduleStride + 1
+  out = targets.numpy_array.T.reshape(numFilters, M, M, n)
+  out[...] = y[:, :, :end:moduleStride, :end:moduleStride].transpose(0, 2, 3, 1)
+  AddBiasReLU(targets.numpy_array.T.reshape(numFilters, -1),
+              bias.numpy_array.reshape(numFilters, -1), numImages, relu)
+
+def ChooseConvAlgorithm(filterSize, moduleStride, paddingStart, imgSizeY, numModulesX, numImgColors, numFilters):
+  """Returns 'winograd', 'fft' or 'direct' (im2col), whichever is expected to
+  be fastest. The costs are multiply-adds per image, with the FFTs weighted by
+  how much slower numpy's FFT runs than the float32 GEMM. Strided
+  convolutions stay direct: the FFT computes every stride-1 output and then
+  drops most of them."""
+  if moduleStride != 1:
+    return 'direct'
+  if filterSize == 3:
+    return 'winograd'
+  direct = float(numFilters) * numImgColors * filterSize**2 * numModulesX**2
+  L = GetFFTSize(imgSizeY, numModulesX, paddingStart, moduleStride, filterSize)
+  transforms = 25. * (numImgColors + numFilters) * L * L * np.log2(L)
+  products = 4. * numFilters * numImgColors * L * (L / 2 + 1)
+  if transforms + products < direct:
+    return 'fft'
+  return 'direct'
+
+def MaxPool(images, targets, numChannels, kernel_size, padding, stride, num_modules_x):
+  """
+  images - (n_images, img_w**2 * n_chans)
+  numChannels - number of filter/color channels
+  kernel_size - width of pooling area
+  padding - pooling starts at pixel -padding
+  stride - stride
+  num_modules_x - number of pooling sites
+
+  Pooling windows are clipped to the image, as in cudamat_conv.
+  """
+  numImages = images.shape[0]
+
+  assert targets.shape == (numImages, numChannels * num_modules_x**2)
+
+  imgs = _Images(images, numChannels, int(np.sqrt(images.shape[1] / numChannels)))
+  c, h, w, n = imgs.shape
+  size = max(h + padding, (num_modules_x - 1) * stride + kernel_size)
+  padded = _Pad(imgs, 'pool_pad', padding, size, size, -np.inf)
+
+  out = targets.numpy_array.T.reshape(c, num_modules_x, num_modules_x, n)
+  end = (num_modules_x - 1) * stride + 1
+  for y in range(kernel_size):
+    for x in range(kernel_size):
+      window = padded[:, y:y + end:stride, x:x + end:stride, :]
+      if x == 0 and y == 0:
+        out[...] = window
+      else:
+        np.maximum(out, window, out=out)
+
+def RGBToYUV(images, targets):
+  """
+  images - (n_images, img_w**2 * 3) in RGB.
+  targets - (n_images, img_w**2 * 3) in YUV.
+  """
+  assert targets.shape == images.shape
+  x = images.numpy_array.T.reshape(3, -1)
+  np.dot(RGB_TO_YUV, x, out=targets.numpy_array.T.reshape(3, -1))
+
+def ResponseNormCrossMap(images, targets, numChannels, sizeF, addScale, powScale, blocked):
+  """
+  Computes images / ((1 + addScale * (sum sq images over neighbourhood))^{powScale})
+  blocked : true means divide input into blocks and compete within each,
+  false means compete within a running window centered at self.
+  """
+  assert targets.shape == images.shape
+  x = images.numpy_array.T.reshape(numChannels, -1)
+  out = targets.numpy_array.T.reshape(numChannels, -1)
+  sq = GetWorkspace('rnorm_sq', x.shape)
+  np.multiply(x, x, out=sq)
+
+  if blocked:
+    for start in range(0, numChannels, sizeF):
+      end = min(numChannels, start + sizeF)
+      out[start:end] = sq[start:end].sum(axis=0)
+  else:
+    out.fill(0)
+    for d in range(-(sizeF / 2), sizeF - sizeF / 2):
+      if d < 0:
+        out[-d:] += sq[:numChannels + d]
+      else:
+        out[:numChannels - d] += sq[d:]
+
+  out *= addScale
+  out += 1
+  np.power(out, -powScale, out=out)
+  out *= x
+
+# Channels-last layout.
+#
+# On the CPU, a net can keep the states of its conv layers channels-last:
+# (n_images, img_w**2 * n_chans) stored as (img_w, img_w, n_images, n_chans).
+# Every pixel of every image is then a contiguous row of channels, so im2col
+# copies whole rows, pooling windows are contiguous blocks, conv and one-to-one
+# targets come out of a single GEMM, and the bias is added along rows. Filters
+# are stored as (n_filters, filter_w, filter_w, n_chans) to match. The kernels
+# below write channels-last targets and read images in either layout, so the
+# conversion from the input layer happens inside the first edge.
+
+def _ImagesLast(mat, num_colors, img_size_y, channels_last):
+  """ Returns a (img_h, img_w, n_images, n_chans) view of mat, which is
+  channels-last if channels_last and in the layout of cudamat_conv otherwise."""
+  num_images, dims = mat.shape
+  img_size_x = dims / (num_colors * img_size_y)
+  a = mat.numpy_array.T
+  if channels_last:
+    return a.reshape(img_size_y, img_size_x, num_images, num_colors)
+  return a.reshape(num_colors, img_size_y, img_size_x, num_images).transpose(1, 2, 3, 0)
+
+def _PixelsLast(mat, num_colors, channels_last):
+  """ Returns a (n_locs * n_images, n_chans) view of mat, with rows in
+  channels-last order."""
+  a = mat.numpy_array.T
+  if channels_last:
+    return a.reshape(-1, num_colors)
+  return a.reshape(num_colors, -1).T
+
+def _PadLast(images, name, padding, size_y, size_x, value):
+  """Same as _Pad, for (img_h, img_w, n_images, n_chans) images."""
+  h, w, n, c = images.shape
+  if padding == 0 and size_y <= h and size_x <= w:
+    return images
+  padded = GetWorkspace(name, (size_y, size_x, n, c))
+  padded[:padding] = value
+  padded[padding + h:] = value
+  padded[padding:padding + h, :padding] = value
+  padded[padding:padding + h, padding + w:] = value
+  padded[padding:padding + h, padding:padding + w] = images
+  return padded
+
+def AddBiasReLUChannelsLast(out, bias, relu):
+  """Same as AddBiasReLU, for channels-last targets.
+
+  out - (n_locs, n_rows, n_out)
+  bias - (n_out, 1), or (n_out, n_locs) for a bias per location.
+  """
+  num_locs, n, f = out.shape
+  b = bias.T.reshape(-1, 1, f)
+  block = max(1, BLOCK_BYTES / (4 * n * f))
+  for start in range(0, num_locs, block):
+    end = min(num_locs, start + block)
+    t = out[start:end]
+    if b.shape[0] == 1:
+      t += b
+    else:
+      t += b[start:end]
+    if relu:
+      np.maximum(t, 0, out=t)
+
+def _GemmLast(x, filters, targets, numFilters, scaleTargets):
+  """ Returns targets as a (n_rows, n_filters) array set to
+  x filters.T + scaleTargets * targets."""
+  out = targets.numpy_array.T.reshape(-1, numFilters)
+  w = filters.numpy_array.T
+  if scaleTargets == 0:
+    np.dot(x, w, out=out)
+  else:
+    out *= scaleTargets
+    out += np.dot(x, w)
+  return out
+
+def convUpChannelsLast(images, filters, bias, targets, imgSizeY, numModulesX, paddingStart, moduleStride, numImgColors, relu, imagesChannelsLast, scaleTargets=0):
+  """
+  Same as convUpBias, for channels-last targets and filters. images are
+  channels-last if imagesChannelsLast.
+  """
+  numImages = images.shape[0]
+  numFilters = filters.shape[0]
+  filterSize = int(np.sqrt(filters.shape[1] / numImgColors))
+
+  assert targets.shape == (numImages, numFilters * numModulesX**2)
+
+  imgs = _ImagesLast(images, numImgColors, imgSizeY, imagesChannelsLast)
+  h, w, n, c = imgs.shape
+  size = max(h + paddingStart, (numModulesX - 1) * moduleStride + filterSize)
+  padded = _PadLast(imgs, 'conv_pad', paddingStart, size, size, 0)
+
+  sy, sx, sn, sc = padded.strides
+  patches = as_strided(padded,
+                       shape=(numModulesX, numModulesX, n, filterSize, filterSize, c),
+                       strides=(sy * moduleStride, sx * moduleStride, sn, sy, sx, sc))
+  cols = GetWorkspace('conv_cols', patches.shape)
+  cols[...] = patches
+  out = _GemmLast(cols.reshape(-1, filterSize**2 * c), filters, targets,
+                  numFilters, scaleTargets)
+  AddBiasReLUChannelsLast(out.reshape(numModulesX**2, numImages, numFilters),
+                          bias.numpy_array.reshape(numFilters, -1), relu)
+
+def convUpWinogradChannelsLast(images, filters_w, bias, targets, imgSizeY, numModulesX, paddingStart, numImgColors, relu, imagesChannelsLast):
+  """
+  Same as convUpWinograd, for channels-last targets. images are channels-last
+  if imagesChannelsLast.
+  """
+  numImages = images.shape[0]
+  numFilters = filters_w.shape[2]
+  M = numModulesX
+  T = (M + 1) / 2
+  assert targets.shape == (numImages, numFilters * M * M)
+
+  imgs = _ImagesLast(images, numImgColors, imgSizeY, imagesChannelsLast)
+  h, w, n, c = imgs.shape
+  size = max(h + paddingStart, 2 * T + 2)
+  padded = _PadLast(imgs, 'conv_pad', paddingStart, size, size, 0)
+  sy, sx, sn, sc = padded.strides
+  d = as_strided(padded, shape=(4, 4, T, T, n, c),
+                 strides=(sy, sx, 2 * sy, 2 * sx, sn, sc))
+
+  def BT(x, i, out):
+    if i == 0:
+      np.subtract(x(0), x(2), out=out)
+    elif i == 1:
+      np.add(x(1), x(2), out=out)
+    elif i == 2:
+      np.subtract(x(2), x(1), out=out)
+    else:
+      np.subtract(x(1), x(3), out=out)
+  rows = GetWorkspace('winograd_rows', (4, 4, T, T, n, c))
+  for i in range(4):
+    BT(lambda k: d[k], i, rows[i])
+  v = GetWorkspace('winograd_v', (4, 4, T, T, n, c))
+  for i in range(4):
+    for j in range(4):
+      BT(lambda k: rows[i][k], j, v[i, j])
+
+  m = GetWorkspace('winograd_m', (4, 4, T, T, n, numFilters))
+  for i in range(4):
+    for j in range(4):
+      np.dot(v[i, j].reshape(-1, c), filters_w[i, j].T,
+             out=m[i, j].reshape(-1, numFilters))
+
+  def AT(x, i, out):
+    if i == 0:
+      np.add(x(0), x(1), out=out)
+      out += x(2)
+    else:
+      np.subtract(x(1), x(2), out=out)
+      out -= x(3)
+  out = targets.numpy_array.T.reshape(M, M, n, numFilters)
+  half = GetWorkspace('winograd_rows', (4, T, T, n, numFilters))
+  for i in range(2):
+    AT(lambda k: m[k], i, half)
+    for j in range(2):
+      y = out[i::2, j::2]
+      AT(lambda k: half[k][:y.shape[0], :y.shape[1]], j, y)
+  AddBiasReLUChannelsLast(out.reshape(M * M, n, numFilters),
+                          bias.numpy_array.reshape(numFilters, -1), relu)
+
+def convOneToOneChannelsLast(images, filters, bias, targets, numImgColors, relu, imagesChannelsLast, scaleTargets=0):
+  """
+  Same as convUpChannelsLast for 1x1 filters, without the im2col copy.
+  """
+  numFilters = filters.shape[0]
+  x = _PixelsLast(images, numImgColors, imagesChannelsLast)
+  out = _GemmLast(x, filters, targets, numFilters, scaleTargets)
+  AddBiasReLUChannelsLast(out.reshape(-1, 1, numFilters),
+                          bias.numpy_array.reshape(numFilters, 1), relu)
+
+def dotChannelsLast(images, filters, bias, targets, numImgColors, relu, scaleTargets=0):
+  """
+  Same as dotBias, for channels-last images and filters whose columns are in
+  channels-last order, (n_out, img_w, img_w, n_chans).
+
+  An image is not contiguous unless there is only one, so for larger batches
+  the product is summed over locations instead of transposing the images.
+  """
+  numImages = images.shape[0]
+  numFilters = filters.shape[0]
+  assert targets.shape == (numImages, numFilters)
+  x = images.numpy_array.T.reshape(-1, numImages, numImgColors)
+  w = filters.numpy_array
+  out = targets.numpy_array.T
+  if numImages == 1:
+    if scaleTargets == 0:
+      np.dot(w, x.reshape(-1, 1), out=out)
+    else:
+      out *= scaleTargets
+      out += np.dot(w, x.reshape(-1, 1))
+  else:
+    if scaleTargets == 0:
+      out.fill(0)
+    else:
+      out *= scaleTargets
+    product = GetWorkspace('dot_product', out.shape)
+    for loc in range(x.shape[0]):
+      w_loc = w[:, loc * numImgColors:(loc + 1) * numImgColors]
+      np.dot(w_loc, x[loc].T, out=product)
+      out += product
+  AddBiasReLU(out, bias.numpy_array.reshape(-1, 1), 1, relu)
+
+def MaxPoolChannelsLast(images, targets, numChannels, kernel_size, padding, stride, num_modules_x, imagesChannelsLast):
+  """
+  Same as MaxPool, for channels-last targets. images are channels-last if
+  imagesChannelsLast.
+  """
+  numImages = images.shape[0]
+
+  assert targets.shape == (numImages, numChannels * num_modules_x**2)
+
+  imgs = _ImagesLast(images, numChannels, int(np.sqrt(images.shape[1] / numChannels)),
+                     imagesChannelsLast)
+  h, w, n, c = imgs.shape
+  size = max(h + padding, (num_modules_x - 1) * stride + kernel_size)
+  padded = _PadLast(imgs, 'pool_pad', padding, size, size, -np.inf)
+
+  out = targets.numpy_array.T.reshape(num_modules_x, num_modules_x, n, c)
+  end = (num_modules_x - 1) * stride + 1
+  for y in range(kernel_size):
+    for x in range(kernel_size):
+      window = padded[y:y + end:stride, x:x + end:stride]
+      if x == 0 and y == 0:
+        out[...] = window
+      else:
+        np.maximum(out, window, out=out)
+
+def RGBToYUVChannelsLast(images, targets, imagesChannelsLast):
+  """
+  Same as RGBToYUV, for channels-last targets. images are channels-last if
+  imagesChannelsLast.
+  """
+  assert targets.shape == images.shape
+  x = _PixelsLast(images, 3, imagesChannelsLast)
+  np.dot(x, RGB_TO_YUV.T, out=targets.numpy_array.T.reshape(-1, 3))
+
+def ResponseNormCrossMapChannelsLast(images, targets, numChannels, sizeF, addScale, powScale, blocked, imagesChannelsLast):
+  """
+  Same as ResponseNormCrossMap, for channels-last targets. images are
+  channels-last if imagesChannelsLast.
+  """
+  assert targets.shape == images.shape
+  x = _PixelsLast(images, numChannels, imagesChannelsLast)
+  out = targets.numpy_array.T.reshape(-1, numChannels)
+  sq = GetWorkspace('rnorm_sq', x.shape)
+  np.multiply(x, x, out=sq)
+
+  if blocked:
+    for start in range(0, numChannels, sizeF):
+      end = min(numChannels, start + sizeF)
+      out[:, start:end] = sq[:, start:end].sum(axis=1)[:, np.newaxis]
+  else:
+    # Channels are not contiguous here, so instead of adding shifted copies,
+    # the window sums are differences of running sums, s[c] being the sum of
+    # the first c channels. Channel c sums channels [c - before, c + after).
+    s = GetWorkspace('rnorm_sum', (x.shape[0], numChannels + 1))
+    s[:, 0] = 0
+    np.cumsum(sq, axis=1, out=s[:, 1:])
+    before = sizeF / 2
+    after = sizeF - before
+    out[:, :numChannels - after] = s[:, after:numChannels]
+    out[:, numChannels - after:] = s[:, numChannels:]
+    out[:, before:] -= s[:, :numChannels - before]
+
+  out *= addScale
+  out += 1
+  np.power(out, -powScale, out=out)
+  out *= x
+
+def ChannelsFirst(state, numChannels):
+  """ Returns a (n_images, n_chans * img_w**2) array in the layout of
+  cudamat_conv with the contents of state, a channels-last matrix."""
+  numImages = state.shape[0]
+  x = state.numpy_array.T.reshape(-1, numImages, numChannels)
+  return x.transpose(1, 2, 0).reshape(numImages, -1)
@@ -0,0 +1,221 @@
+""" Host-memory implementation of the subset of the cudamat API used by the
+Python ConvNet.
+
+Matrices are float32 numpy arrays in FORTRAN order, exactly like the host
+copies kept by cudamat, so that (n_images, channels * image_size**2) states
+have the same memory layout as on the GPU and reshapes reinterpret the
+buffer without moving any data. All operations work in place on
+preallocated targets.
+"""
+import numpy as np
+
+class CUDAMatException(Exception):
+  pass
+
+class TransposedCUDAMatrix(object):
+  def __init__(self, mat):
+    self.mat = mat
+
+  @property
+  def shape(self):
+    return self.mat.shape[::-1]
+
+  @property
+  def numpy_array(self):
+    return self.mat.numpy_array.T
+
+class CUDAMatrix(object):
+  """
+  A CUDAMatrix object represents a matrix of single precision floating point
+  numbers in host memory.
+  """
+
+  def __init__(self, array, copy_to_device=True):
+    self.numpy_array = reformat(array)
+
+  @property
+  def T(self):
+    return TransposedCUDAMatrix(self)
+
+  @property
+  def shape(self):
+    return self.numpy_array.shape
+
+  def overwrite(self, array, copy_to_device=True):
+    """Overwrites self with array.
+
+    If array has the same shape as self, it is copied into the existing
+    buffer. Otherwise self is re-initialized from array.
+    """
+    assert type(array) == np.ndarray, 'array must be a np.ndarray.'
+    if array.shape == self.shape:
+      self.numpy_array[...] = array
+    else:
+      self.numpy_array = reformat(array)
+
+  def reshape(self, shape):
+    """
+    Reshapes self to have the given shape. The number of elements cannot
+    change as this only changes how the contents are interpreted.
+    """
+    m, n = shape
+    mlen = self.shape[0] * self.shape[1]
+    if m == -1:
+      assert n > 0 and mlen % n == 0
+      m = mlen / n
+    elif n == -1:
+      assert m > 0 and mlen % m == 0
+      n = mlen / m
+    if m * n != mlen:
+      raise CUDAMatException('Incompatible matrix dimensions.')
+
+    # Setting the shape attribute raises instead of silently copying.
+    array = self.numpy_array.T
+    array.shape = (n, m)
+    self.numpy_array = array.T
+    return self
+
+  def slice(self, first_col, last_col):
+    """
+    Returns a view of columns [first_col, last_col) of self.
+    """
+    mat = CUDAMatrix.__new__(CUDAMatrix)
+    mat.numpy_array = self.numpy_array[:, first_col:last_col]
+    return mat
+
+  def asarray(self):
+    """
+    Returns the underlying ndarray.
+    """
+    return self.numpy_array
+
+  def copy_to_device(self):
+    pass
+
+  def copy_to_host(self):
+    pass
+
+  def free_device_memory(self):
+    self.numpy_array = None
+
+  def assign(self, val):
+    """Assign val to self, where val can be a scalar or a CUDAMatrix
+    with the same dimensions as self. """
+    if isinstance(val, CUDAMatrix):
+      self.numpy_array[...] = val.numpy_array
+    elif isinstance(val, (int, float)):
+      self.numpy_array.fill(val)
+    else:
+      raise ValueError, "Assigned value must be of type CUDAMatrix, int, or float."
+    return self
+
+  def add_row_vec(self, vec, target=None):
+    """
+    Add vector vec to every row of the matrix. If a target is provided,
+    it is used to store the result instead of self.
+    """
+    if not target:
+      target = self
+    np.add(self.numpy_array, vec.numpy_array, out=target.numpy_array)
+    return target
+
+  def add_row_mult(self, vec, mult, target=None):
+    """
+    Add a multiple of vector vec to every row of the matrix. If a target
+    is provided, it is used to store the result instead of self.
+    """
+    if not target:
+      target = self
+    np.add(self.numpy_array, mult * vec.numpy_array, out=target.numpy_array)
+    return target
+
+  def div_by_row(self, vec, target=None):
+    """
+    Divide vector vec into every row of the matrix. If a target is
+    provided, it is used to store the result instead of self.
+    """
+    if not target:
+      target = self
+    np.divide(self.numpy_array, vec.numpy_array, out=target.numpy_array)
+    return target
+
+  def mult(self, val, target=None):
+    """Multiply self by val, where val can be a scalar or a CUDAMatrix with
+    the same dimensions as self. """
+    if not target:
+      target = self
+    if isinstance(val, CUDAMatrix):
+      val = val.numpy_array
+    np.multiply(self.numpy_array, val, out=target.numpy_array)
+    return target
+
+  def lower_bound(self, val, target=None):
+    """
+    Perform the operation target = (self < val) ? val:self, where val can be a matrix or a scalar.
+    """
+    if not target:
+      target = self
+    if isinstance(val, CUDAMatrix):
+      val = val.numpy_array
+    np.maximum(self.numpy_array, val, out=target.numpy_array)
+    return target
+
+  def apply_softmax_row_major(self, num_slices=None):
+    """
+    Apply the softmax activation function.
+    """
+    if num_slices is None:
+      num_slices = self.shape[1]
+    mlen = self.shape[0] * self.shape[1]
+    if mlen % num_slices != 0:
+      raise CUDAMatException('Incompatible matrix dimensions.')
+    array = self.numpy_array.T
+    array.shape = (num_slices, mlen / num_slices)
+    array -= array.max(axis=0)
+    np.exp(array, out=array)
+    array /= array.sum(axis=0)
+    return self
+
+def empty(shape):
+  """
+  Creates and returns a new CUDAMatrix with the given shape.
+  """
+  mat = CUDAMatrix.__new__(CUDAMatrix)
+  mat.numpy_array = np.empty(shape, dtype=np.float32, order='F')
+  return mat
+
+def dot(m1, m2, mult=1.0, target=None, scale_targets=0.0):
+  """
+  Find the dot product between m1 and m2.
+  """
+  if not target:
+    target = empty((m1.shape[0], m2.shape[1]))
+
+  # target.T is C-contiguous, so the product is written straight into it.
+  t = target.numpy_array.T
+  if scale_targets == 0 and mult == 1:
+    np.dot(m2.numpy_array.T, m1.numpy_array.T, out=t)
+  else:
+    prod = np.dot(m2.numpy_array.T, m1.numpy_array.T)
+    t *= scale_targets
+    t += mult * prod
+  return target
+
+def reformat(array):
+  """
+  Returns array as a float32 array in FORTRAN order.
+  """
+  return np.array(array, dtype=np.float32, order='F')
+
+def cuda_set_device(dev_id):
+  pass
+
+def cublas_init():
+  pass
+
+init = cublas_init
+
+def cublas_shutdown():
+  pass
+
+shutdown = cublas_shutdown
@@ -0,0 +1,360 @@
+""" Reads the data streams of a DatasetConfig in chunks, like the C++
+DataHandler."""
+import threading
+from augmenter import Augmenter, NeedsAugmenter, GetImageSizes
+from image_reader import ImageCache, ReadFileList
+from image_store import ImageStore, IsImageStore
+from util import *
+
+def ChooseDataStream(config, base_dir, image_cache_bytes=0):
+  if config.data_type == convnet_config_pb2.DataStreamConfig.HDF5:
+    return HDF5DataStream(config, base_dir)
+  elif config.data_type == convnet_config_pb2.DataStreamConfig.TXT:
+    return TextDataStream(config, base_dir)
+  elif config.data_type == convnet_config_pb2.DataStreamConfig.IMAGE_RAW:
+    if IsImageStore(os.path.join(base_dir, config.file_pattern)):
+      return ImageStoreDataStream(config, base_dir)
+    return ImageDataStream(config, base_dir, image_cache_bytes)
+  else:
+    raise Exception('Data type %s not implemented.' %
+                    convnet_config_pb2.DataStreamConfig.DataType.Name(config.data_type))
+
+class DataStream(object):
+  """ The rows of one data_config."""
+  def __init__(self, config, base_dir):
+    self.layer_name_ = config.layer_name
+    self.file_name_ = os.path.join(base_dir, config.file_pattern)
+    self.dataset_size_ = 0
+    self.num_dims_ = 0
+
+  def GetLayerName(self):
+    return self.layer_name_
+
+  def GetDataSetSize(self):
+    return self.dataset_size_
+
+  def GetDims(self):
+    return self.num_dims_
+
+  def Read(self, start, end, out, dest):
+    """ Copies rows start to end into out, a (rows, dims) float32 array, from
+    row dest on."""
+    pass
+
+  def GetCacheStats(self):
+    return None
+
+  def Close(self):
+    pass
+
+class HDF5DataStream(DataStream):
+  """ A 1-d or 2-d dataset in an HDF5 file. Rows are converted to float32 by
+  HDF5 as they are read, straight into the chunk buffer."""
+  def __init__(self, config, base_dir):
+    super(HDF5DataStream, self).__init__(config, base_dir)
+    self.f_ = h5py.File(self.file_name_, 'r')
+    self.dset_ = self.f_[config.dataset_name]
+    self.dataset_size_ = self.dset_.shape[0]
+    self.num_dims_ = 1 if len(self.dset_.shape) == 1 else self.dset_.shape[1]
+
+  def Read(self, start, end, out, dest):
+    if len(self.dset_.shape) == 1:
+      out = out.reshape(-1)
+    self.dset_.read_direct(out, np.s_[start:end], np.s_[dest:dest + end - start])
+
+  def Close(self):
+    self.f_.close()
+
+class TextDataStream(DataStream):
+  """ A text file with one row of numbers per line, kept in memory."""
+  def __init__(self, config, base_dir):
+    super(TextDataStream, self).__init__(config, base_dir)
+    self.data_ = np.loadtxt(self.file_name_, dtype=np.float32, ndmin=2)
+    self.dataset_size_, self.num_dims_ = self.data_.shape
+
+  def Read(self, start, end, out, dest):
+    out[dest:dest + end - start] = self.data_[start:end]
+
+class ImageDataStream(DataStream):
+  """ The images in a file list, like ImageDataIterator. Each image is resized
+  so that its shorter side is raw_image_size, and its center image_size_y x
+  image_size_x patch is the row.
+
+  The resized images are kept in an ImageCache of image_cache_bytes, so that
+  an image read again, by a later chunk or epoch, is not decoded again. The
+  random crops, flips and jitter of the Augmenter are then taken from the
+  same decode.
+  """
+  def __init__(self, config, base_dir, image_cache_bytes):
+    super(ImageDataStream, self).__init__(config, base_dir)
+    raw_y = config.raw_image_size_y if config.HasField('raw_image_size_y') else config.raw_image_size
+    raw_x = config.raw_image_size_x if config.HasField('raw_image_size_x') else config.raw_image_size
+    if raw_y != raw_x:
+      raise Exception('Only square raw images are supported.')
+    (self.size_y_, self.size_x_), _ = GetImageSizes(config)
+    if self.size_y_ > raw_y or self.size_x_ > raw_x:
+      raise Exception('image_size must not be larger than raw_image_size.')
+    self.file_names_ = [f for _, f in ReadFileList(self.file_name_)]
+    self.cache_ = ImageCache(image_cache_bytes, raw_y)
+    self.dataset_size_ = len(self.file_names_)
+    self.num_dims_ = 3 * self.size_y_ * self.size_x_
+
+  def Read(self, start, end, out, dest):
+    for row in range(start, end):
+      image = self.cache_.Get(self.file_names_[row])
+      top = (image.shape[1] - self.size_y_) / 2
+      left = (image.shape[2] - self.size_x_) / 2
+      out[dest].reshape(3, self.size_y_, self.size_x_)[:] = \
+          image[:, top:top + self.size_y_, left:left + self.size_x_]
+      dest += 1
+
+  def GetCacheStats(self):
+    return self.cache_.GetStats()
+
+class ImageStoreDataStream(DataStream):
+  """ An IMAGE_RAW stream whose file_pattern is an ImageStore, written by
+  build_image_store.py for the same raw_image_size and image_size. Nothing is
+  decoded, but each chunk is still copied from the map into the float32 chunk
+  buffer, converting every uint8 pixel.
+
+  The store holds only the center image_size crop of each image, fixed when it
+  was written. Random crops for training can only be taken inside it, by the
+  Augmenter, never from elsewhere in the raw image."""
+  def __init__(self, config, base_dir):
+    super(ImageStoreDataStream, self).__init__(config, base_dir)
+    self.store_ = ImageStore(self.file_name_)
+    raw = config.raw_image_size_y if config.HasField('raw_image_size_y') else config.raw_image_size
+    size, _ = GetImageSizes(config)
+    if (raw, size) != (self.store_.GetRawImageSize(), self.store_.GetImageSize()):
+      raise Exception('%s holds images of raw size %d and size %s, not %d and %s.' % (
+        self.file_name_, self.store_.GetRawImageSize(), self.store_.GetImageSize(),
+        raw, size))
+    self.dataset_size_ = self.store_.GetDataSetSize()
+    self.num_dims_ = self.store_.GetDims()
+
+  def Read(self, start, end, out, dest):
+    out[dest:dest + end - start] = self.store_.GetRows(start, end)
+
+  def Close(self):
+    self.store_.Close()
+
+class DataHandler(object):
+  """Returns batches of the rows of every data stream of a DatasetConfig.
+
+  Rows are read chunk_size at a time (the whole dataset if chunk_size is 0)
+  into preallocated float32 buffers. With pipeline_loads, the next chunk is
+  read on a background thread, into a second set of buffers, while batches
+  are taken from the current one. With randomize_cpu, a chunk is made of runs
+  of random_access_chunk_size consecutive rows from random places. The runs
+  are read in file order, so that reads go forward through the file, and put
+  in the buffer in random order. With randomize_gpu, the rows of each chunk
+  are shuffled every time it is used. A chunk is used max_reuse_count + 1
+  times, and each batch is returned multiplicity times.
+
+  Streams that ask for translation, flips, normalization or PCA noise get an
+  Augmenter, which is applied to each batch as it is returned.
+  """
+
+  def __init__(self, config, base_dir=None, seed=0, image_cache_bytes=1 << 30):
+    """config is a DatasetConfig or a .pbtxt file holding one. Relative file
+    patterns are taken from base_dir, by default the directory of the .pbtxt
+    file, or the current directory. Each IMAGE_RAW stream keeps up to
+    image_cache_bytes of decoded images."""
+    if isinstance(config, basestring):
+      if base_dir is None:
+        base_dir = os.path.dirname(os.path.abspath(config))
+      dataset = convnet_config_pb2.DatasetConfig()
+      text_format.Merge(open(config).read(), dataset)
+      config = dataset
+    if base_dir is None:
+      base_dir = os.getcwd()
+    self.streams_ = [ChooseDataStream(dsc, base_dir, image_cache_bytes)
+                     for dsc in config.data_config]
+    self.augmenters_ = dict((dsc.layer_name, Augmenter(dsc, base_dir, seed + 2 + i))
+                            for i, dsc in enumerate(config.data_config)
+                            if NeedsAugmenter(dsc))
+    sizes = set(s.GetDataSetSize() for s in self.streams_)
+    if len(sizes) != 1:
+      raise Exception('All data streams must have the same size.')
+    self.dataset_size_ = sizes.pop()
+    if config.max_dataset_size > 0:
+      self.dataset_size_ = min(self.dataset_size_, config.max_dataset_size)
+    self.batch_size_ = config.batch_size
+    self.chunk_size_ = config.chunk_size
+    self.fits_ = self.chunk_size_ <= 0 or self.chunk_size_ >= self.dataset_size_
+    if self.fits_:
+      self.chunk_size_ = self.dataset_size_
+    self.max_reuse_count_ = config.max_reuse_count
+    self.pipeline_loads_ = config.pipeline_loads and not self.fits_
+    self.randomize_cpu_ = config.randomize_cpu and not self.fits_
+    self.randomize_gpu_ = config.randomize_gpu
+    self.random_access_chunk_size_ = max(1, config.random_access_chunk_size)
+    self.multiplicity_ = config.multiplicity
+    self.random_ = np.random.RandomState(seed)
+    self.load_random_ = np.random.RandomState(seed + 1)  # For the loading thread.
+    num_buffers = 2 if self.pipeline_loads_ else 1
+    self.buffers_ = [self.NewBuffers() for i in range(num_buffers)]
+    # Shuffle gathers rows into these, so that it does not allocate a chunk.
+    self.spare_buffers_ = [self.NewBuffers() if self.randomize_gpu_ else None
+                           for i in range(num_buffers)]
+    self.thread_ = None
+    self.thread_error_ = None
+    self.next_ = None  # Index of the buffer holding or loading the next chunk.
+    self.current_ = 0
+    self.wait_time_ = 0.
+    self.load_time_ = 0.
+    self.num_chunks_ = 0
+    self.Seek(0)
+
+  def NewBuffers(self):
+    return dict((s.GetLayerName(), np.empty((self.chunk_size_, s.GetDims()),
+                                            dtype=np.float32))
+                for s in self.streams_)
+
+  def GetBatchSize(self):
+    return self.batch_size_
+
+  def GetDataSetSize(self):
+    return self.dataset_size_
+
+  def GetDims(self, layer_name):
+    if layer_name in self.augmenters_:
+      return self.augmenters_[layer_name].GetDims()
+    for s in self.streams_:
+      if s.GetLayerName() == layer_name:
+        return s.GetDims()
+    raise Exception('Layer name %s not found.' % layer_name)
+
+  def GetWaitTime(self):
+    """Returns the number of seconds GetBatch has spent waiting for chunks to
+    be read."""
+    return self.wait_time_
+
+  def GetLoadTime(self):
+    """Returns the number of seconds spent reading chunks, on any thread."""
+    return self.load_time_
+
+  def GetNumChunks(self):
+    return self.num_chunks_
+
+  def GetCacheStats(self):
+    """Returns {layer name: ImageCache.GetStats()} for the IMAGE_RAW streams."""
+    return dict((s.GetLayerName(), s.GetCacheStats()) for s in self.streams_
+                if s.GetCacheStats() is not None)
+
+  def Seek(self, row):
+    """Makes the next chunk start at row, if it is not random."""
+    self.Sync()
+    self.next_ = None
+    self.row_ = row % self.dataset_size_
+    self.start_ = 0
+    self.reuse_counter_ = 0
+    self.multiplicity_counter_ = 0
+    self.restart_ = True
+
+  def Sync(self):
+    """Waits for the chunk being read, if any."""
+    if self.thread_ is not None:
+      self.thread_.join()
+      self.thread_ = None
+    if self.thread_error_ is not None:
+      exc_info, self.thread_error_ = self.thread_error_, None
+      raise exc_info[0], exc_info[1], exc_info[2]
+
+  def GetBatch(self):
+    """Returns {layer name: (batch_size, dims) array} for the next batch. The
+    arrays are views of the chunk buffers, or of the buffers of the
+    augmenters, valid until the next call."""
+    end = self.start_ + self.batch_size_
+    if end > self.chunk_size_ or self.restart_:
+      if self.reuse_counter_ < self.max_reuse_count_ and not self.restart_:
+        self.reuse_counter_ += 1
+        self.Shuffle(self.current_, self.random_)
+      elif self.restart_ or not self.fits_:
+        self.NextChunk()
+        self.reuse_counter_ = 0
+      else:
+        self.Shuffle(self.current_, self.random_)
+      self.restart_ = False
+      self.start_ = 0
+      end = self.batch_size_
+    batch = dict((name, b[self.start_:end])
+                 for name, b in self.buffers_[self.current_].items())
+    for name, augmenter in self.augmenters_.items():
+      augmenter.SampleNoise(self.batch_size_, self.multiplicity_counter_)
+      batch[name] = augmenter.AddNoise(batch[name])
+    self.multiplicity_counter_ += 1
+    if self.multiplicity_counter_ == self.multiplicity_:
+      self.multiplicity_counter_ = 0
+      self.start_ = end
+    return batch
+
+  def NextChunk(self):
+    start = time.time()
+    if not self.pipeline_loads_:
+      self.LoadChunk(0)
+      self.current_ = 0
+    else:
+      if self.next_ is None:
+        self.StartLoad(0)
+      self.Sync()
+      self.current_ = self.next_
+      self.StartLoad(1 - self.current_)
+    self.wait_time_ += time.time() - start
+
+  def StartLoad(self, index):
+    self.next_ = index
+    self.thread_ = threading.Thread(target=self.Load, args=(index,))
+    self.thread_.daemon = True
+    self.thread_.start()
+
+  def Load(self, index):
+    try:
+      self.LoadChunk(index)
+    except Exception:
+      self.thread_error_ = sys.exc_info()
+
+  def LoadChunk(self, index):
+    """Reads the next chunk into buffer set index."""
+    start = time.time()
+    buffers = self.buffers_[index]
+    if self.randomize_cpu_:
+      k = self.random_access_chunk_size_
+      num_runs = (self.chunk_size_ + k - 1) / k
+      rows = self.load_random_.randint(0, self.dataset_size_, num_runs)
+      for i in np.argsort(rows, kind='mergesort'):
+        self.ReadRows(buffers, i * k, min(k, self.chunk_size_ - i * k), rows[i])
+    else:
+      self.ReadRows(buffers, 0, self.chunk_size_, self.row_)
+      self.row_ = (self.row_ + self.chunk_size_) % self.dataset_size_
+    self.Shuffle(index, self.load_random_)
+    self.load_time_ += time.time() - start
+    self.num_chunks_ += 1
+
+  def ReadRows(self, buffers, dest, count, row):
+    """Reads count rows from row on, wrapping around at the end of the
+    dataset, into buffers from row dest on."""
+    while count > 0:
+      n = min(count, self.dataset_size_ - row)
+      for s in self.streams_:
+        s.Read(row, row + n, buffers[s.GetLayerName()], dest)
+      dest += n
+      count -= n
+      row = (row + n) % self.dataset_size_
+
+  def Shuffle(self, index, random):
+    """Permutes the rows of buffer set index. Each buffer is gathered into its
+    spare, which then takes its place. The loading thread only shuffles the
+    set it loads, so the two threads never share a spare."""
+    if self.randomize_gpu_:
+      perm = random.permutation(self.chunk_size_)
+      buffers = self.buffers_[index]
+      spares = self.spare_buffers_[index]
+      for name, b in buffers.items():
+        np.take(b, perm, axis=0, out=spares[name])
+        buffers[name], spares[name] = spares[name], b
+
+  def Close(self):
+    self.Sync()
+    for s in self.streams_:
+      s.Close()
@@ -0,0 +1,76 @@
+import sys
+import time
+import multiprocessing
+import numpy as np
+from image_reader import Image, ReadFileList, ImageBatches, GetPool
+
+def Usage():
+  print 'python decode_report.py <file_list(.txt)> [num_workers] [reps]'
+
+def GetdataLoadImage(file_name, resize=256, crop=224):
+  """LoadImage as it was before the reduced decode: a full decode, and pixels
+  read one tuple at a time through getdata into a float64 array."""
+  image = Image.open(file_name)
+  width, height = image.size
+
+  if width > height:
+    width = (width * resize) / height
+    height = resize
+  else:
+    height = (height * resize) / width
+    width = resize
+  left = (width  - crop) / 2
+  top  = (height - crop) / 2
+  image_resized = image.resize((width, height), Image.BICUBIC).crop((left, top, left + crop, top + crop))
+  data = np.array(image_resized.convert('RGB').getdata()).T.reshape(1, -1)
+  return data
+
+def GetdataBatch(file_names, crop=224):
+  data = np.empty((len(file_names), 3 * crop * crop), dtype=np.float32)
+  for i, f in enumerate(file_names):
+    data[i] = GetdataLoadImage(f, crop=crop)
+  return data
+
+def TimeDecode(decode, reps):
+  """Returns the best time of reps calls to decode."""
+  best = None
+  for i in range(reps):
+    start = time.time()
+    decode()
+    t = time.time() - start
+    best = t if best is None else min(best, t)
+  return best
+
+def DecodeAll(file_names, pool, draft):
+  """Returns a function that decodes and crops all of file_names."""
+  files = [(f, f) for f in file_names]
+  def Decode():
+    for ids, data in ImageBatches(files, len(files), pool=pool, draft=draft):
+      pass
+  return Decode
+
+def main():
+  if len(sys.argv) < 2:
+    Usage()
+    sys.exit(1)
+  file_names = [f for _, f in ReadFileList(sys.argv[1])]
+  num_workers = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+  reps = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+  pool = GetPool(num_workers)
+  num_cores = min(num_workers, multiprocessing.cpu_count()) or 1
+  print '%d images, %d workers on %d cores' % (len(file_names), num_workers,
+                                               multiprocessing.cpu_count())
+  print '%-28s %12s %14s' % ('', 'images/s', 'images/s/core')
+  decoders = [('full decode, getdata', 1, lambda: GetdataBatch(file_names)),
+              ('full decode', 1, DecodeAll(file_names, None, False)),
+              ('draft decode', 1, DecodeAll(file_names, None, True))]
+  if pool is not None:
+    decoders.append(('draft decode, pool', num_cores, DecodeAll(file_names, pool, True)))
+  for name, cores, decode in decoders:
+    rate = len(file_names) / TimeDecode(decode, reps)
+    print '%-28s %12.1f %14.1f' % (name, rate, rate / cores)
+  if pool is not None:
+    pool.terminate()
+
+if __name__ == '__main__':
+  main()
@@ -11,6 +11,8 @@ def ChooseEdge(edge_proto):
     return MaxPoolEdge(edge_proto)
   elif edge_proto.edge_type == convnet_config_pb2.Edge.RESPONSE_NORM:
     return ResponseNormEdge(edge_proto)
+  elif edge_proto.edge_type == convnet_config_pb2.Edge.RGBTOYUV:
+    return RGBToYUVEdge(edge_proto)
   else:
     raise Exception('Edge type not implemented.')
 
@@ -20,6 +22,10 @@ class Edge(object):
     self.dest_name_ = edge_proto.dest
     self.num_modules_ = 1
     self.name_ = '%s:%s' % (self.source_name_, self.dest_name_)
+    self.load_time_ = None
+    self.fused_ = False
+    self.relu_ = False
+    self.quantized_ = False
 
   def SetSource(self, l):
     self.source_ = l
@@ -29,6 +35,9 @@ class Edge(object):
     self.dest_ = l
     self.num_output_channels_ = l.GetNumChannels() 
 
+  def GetName(self):
+    return self.name_
+
   def GetSourceName(self):
     return self.source_name_
 
@@ -54,6 +63,49 @@ class Edge(object):
   def LoadParams(self, f):
     pass
 
+  def SetParamsFile(self, params):
+    pass
+
+  def GetParams(self):
+    """ Returns {dataset name: array} for the parameters of the edge, laid out
+    as in the HDF5 checkpoints."""
+    return {}
+
+  def GetLoadTime(self):
+    return self.load_time_
+
+  def CanFoldInputAffine(self):
+    return False
+
+  def CanFuseActivation(self):
+    return False
+
+  def FuseActivation(self, relu):
+    """Makes ComputeUp add the bias and, if relu, apply max(x, 0) to the output
+    in the same call that computes it. The destination layer must not apply its
+    activation again."""
+    self.fused_ = True
+    self.relu_ = relu
+
+  def CanQuantize(self):
+    return False
+
+  def CanAutotune(self):
+    return False
+
+  def CanUseChannelsLast(self):
+    """ Whether ComputeUp can write a channels-last destination."""
+    return False
+
+  def CanReadChannelsLast(self):
+    """ Whether ComputeUp can read a channels-last source into a destination
+    in the usual layout."""
+    return False
+
+  def MatchLayout(self):
+    """ Called when the layout of the source or destination changes."""
+    pass
+
   def ComputeUp(self, input_layer, output_layer, overwrite):
     pass
 
@@ -61,17 +113,147 @@ class EdgeWithWeight(Edge):
   def __init__(self, edge_proto):
     super(EdgeWithWeight, self).__init__(edge_proto)
     self.weights_ = None
+    self.weights_half_ = None
     self.bias_ = None
+    self.params_ = None
+    self.weights_channels_last_ = False
+    self.weights_permuted_ = False
 
   def LoadParams(self, f):
+    # The file holds (n_in, n_out) weights. Their transpose is (n_out, n_in) in
+    # FORTRAN order, the layout the matrices keep, and BLAS takes it as it is,
+    # so ComputeUp passes the weights to every GEMM without copying them.
     w_name = '%s:weight' % self.name_
     w = f[w_name].value.T
     assert self.weights_.shape == w.shape
-    self.weights_.overwrite(w)
+    if USE_CPU and w.dtype == np.float16:
+      self.SetHalfWeights(w)
+    else:
+      self.weights_.overwrite(w)
     b_name = '%s:bias' % self.name_
     b = f[b_name].value.reshape(1, -1)
     assert self.bias_.shape == b.shape
     self.bias_.overwrite(b)
+    self.weights_permuted_ = False
+    self.PermuteWeights(self.weights_channels_last_)
+
+  def SetParamsFile(self, params):
+    """ Loads the parameters from params, a ParamsFile, the first time the edge
+    is used."""
+    if self.params_ is not None:
+      self.params_.Done()
+    self.params_ = params
+    params.AddReader()
+
+  def LoadLazyParams(self):
+    if self.params_ is None:
+      return
+    start = time.time()
+    self.AllocateMemory()
+    w_name = '%s:weight' % self.name_
+    if USE_CPU and self.params_.GetDtype(w_name) == np.float16:
+      self.SetHalfWeights(self.params_.Read(w_name, self.weights_.shape))
+    else:
+      self.params_.ReadInto(w_name, self.weights_)
+    self.params_.ReadInto('%s:bias' % self.name_, self.bias_)
+    params, self.params_ = self.params_, None
+    params.Done()
+    self.weights_permuted_ = False
+    self.PermuteWeights(self.weights_channels_last_)
+    self.load_time_ = time.time() - start
+
+  def GetParams(self):
+    self.LoadLazyParams()
+    if self.quantized_:
+      raise Exception('Can not save the quantized weights of %s.' % self.name_)
+    if self.weights_half_ is not None:
+      w = self.weights_half_
+    else:
+      w = self.weights_.asarray()
+    if self.weights_permuted_:
+      w = w.reshape(w.shape[0], -1, self.num_input_channels_)
+      w = w.transpose(0, 2, 1).reshape(w.shape[0], -1)
+    return {'%s:weight' % self.name_: w.T,
+            '%s:bias' % self.name_: self.bias_.asarray().reshape(-1)}
+
+  def SetHalfWeights(self, w):
+    """ Keeps w, a float16 array, as the weights. The kernels widen it to
+    float32 one block at a time."""
+    if self.weights_ is not None:
+      self.weights_.free_device_memory()
+    self.weights_ = None
+    self.weights_half_ = w
+
+  def GetWeights(self):
+    """ Returns the weights as a float32 array."""
+    if self.weights_half_ is not None:
+      return self.weights_half_.astype(np.float32)
+    return self.weights_.asarray()
+
+  def WidenWeights(self):
+    """ Replaces float16 weights with float32 weights."""
+    if self.weights_half_ is not None:
+      self.weights_ = cm.CUDAMatrix(self.weights_half_)
+      self.weights_half_ = None
+
+  def CanFoldInputAffine(self):
+    return True
+
+  def CanFuseActivation(self):
+    return USE_CPU
+
+  def MatchLayout(self):
+    self.weights_channels_last_ = self.dest_.IsChannelsLast()
+    self.PermuteWeights(self.weights_channels_last_)
+
+  def PermuteWeights(self, channels_last):
+    """ Puts the weight columns, if loaded, in channels-last order,
+    (n_out, img_w, img_w, n_chans), or back in the order of the file. The
+    channels-last kernels only take float32 weights, so float16 weights are
+    widened."""
+    if self.weights_permuted_ == channels_last:
+      return
+    if self.weights_ is None and self.weights_half_ is None:
+      return
+    self.WidenWeights()
+    w = self.weights_.asarray()
+    num_out = w.shape[0]
+    if channels_last:
+      w = w.reshape(num_out, self.num_input_channels_, -1)
+    else:
+      w = w.reshape(num_out, -1, self.num_input_channels_)
+    self.weights_.overwrite(w.transpose(0, 2, 1).reshape(num_out, -1))
+    self.weights_permuted_ = channels_last
+
+  def Quantize(self, input_scale):
+    """Replaces the weights by int8 weights with one scale per output channel.
+    The input is quantized to int8 with input_scale in every ComputeUp."""
+    self.LoadLazyParams()
+    self.PermuteWeights(False)
+    self.weights_q_, self.weights_scale_ = cc.QuantizeRows(self.GetWeights())
+    self.input_scale_ = input_scale
+    if self.weights_ is not None:
+      self.weights_.free_device_memory()
+    self.weights_ = None
+    self.weights_half_ = None
+    self.quantized_ = True
+
+  def FoldInputAffine(self, M, v):
+    """Folds the map x -> M x + v, applied to the channels of every input pixel
+    before this edge, into the weights and bias."""
+    self.LoadLazyParams()
+    self.PermuteWeights(False)
+    self.WidenWeights()
+    w = self.weights_.asarray()
+    w = w.reshape(w.shape[0], self.num_input_channels_, -1)
+    b = self.bias_.asarray() + np.einsum('ocr,c->o', w, v).reshape(1, -1)
+    self.bias_.overwrite(b)
+    self.FoldInputChannels(M)
+
+  def FoldInputChannels(self, M):
+    w = self.weights_.asarray()
+    w = w.reshape(w.shape[0], self.num_input_channels_, -1)
+    self.weights_.overwrite(np.einsum('ocr,cd->odr', w, M).reshape(w.shape[0], -1))
 
 class ConvEdge(EdgeWithWeight):
   def __init__(self, edge_proto):
@@ -80,13 +262,110 @@ class ConvEdge(EdgeWithWeight):
     self.stride_ = edge_proto.stride
     self.padding_ = edge_proto.padding
     self.shared_bias_ = edge_proto.shared_bias
+    self.algorithm_ = 'direct'
+    self.transformed_filters_ = None
+    self.autotuner_ = None
+    self.tuned_batch_size_ = None
 
   def SetImageSize(self, image_size):
     self.image_size_ = image_size
     self.num_modules_ = (image_size + 2 * self.padding_
                          - self.kernel_size_) / self.stride_ + 1
+    self.transformed_filters_ = None
+    self.tuned_batch_size_ = None
+    if USE_CPU:
+      self.fft_size_ = cc.GetFFTSize(self.image_size_, self.num_modules_,
+                                     self.padding_, self.stride_,
+                                     self.kernel_size_)
+      self.SetAlgorithm(cc.ChooseConvAlgorithm(
+        self.kernel_size_, self.stride_, self.padding_, image_size,
+        self.num_modules_, self.num_input_channels_, self.num_output_channels_))
+
+  def GetShape(self):
+    shape = (self.num_input_channels_, self.num_output_channels_,
+             self.kernel_size_, self.stride_, self.padding_, self.image_size_)
+    if self.dest_.IsChannelsLast():
+      shape += ('channels_last',)
+    return shape
+
+  def GetAlgorithms(self):
+    """ Returns the algorithms this edge can use on the CPU."""
+    if not self.fused_:
+      return ['direct']
+    algorithms = ['direct']
+    if self.kernel_size_ == 3 and self.stride_ == 1:
+      algorithms.append('winograd')
+    if not self.dest_.IsChannelsLast():
+      algorithms.append('fft')
+    return algorithms
+
+  def SetAlgorithm(self, algorithm):
+    """ Sets the algorithm used on the CPU: 'direct' (im2col), 'winograd' (3x3
+    filters with stride 1 only) or 'fft'."""
+    if algorithm not in ('direct', 'winograd', 'fft'):
+      raise Exception('Unknown convolution algorithm %s.' % algorithm)
+    if algorithm == 'winograd' and (self.kernel_size_ != 3 or self.stride_ != 1):
+      raise Exception('Winograd needs 3x3 filters with stride 1.')
+    if algorithm == 'fft' and self.dest_.IsChannelsLast():
+      raise Exception('There is no channels-last FFT convolution.')
+    if algorithm != self.algorithm_:
+      self.algorithm_ = algorithm
+      self.transformed_filters_ = None
+
+  def GetAlgorithm(self):
+    return self.algorithm_
+
+  def CanAutotune(self):
+    return USE_CPU and self.fused_
+
+  def CanUseChannelsLast(self):
+    return USE_CPU
+
+  def SetAutotuner(self, autotuner):
+    """ The autotuner picks the algorithm the first time each batch size is
+    seen (see autotuner.py)."""
+    self.autotuner_ = autotuner
+    self.tuned_batch_size_ = None
+
+  def GetTransformedFilters(self):
+    """ Returns the filters transformed for the Winograd or FFT algorithm."""
+    if self.transformed_filters_ is None:
+      w = self.GetWeights()
+      if self.weights_permuted_:
+        w = w.reshape(w.shape[0], -1, self.num_input_channels_)
+        w = w.transpose(0, 2, 1).reshape(w.shape[0], -1)
+      if self.algorithm_ == 'winograd':
+        self.transformed_filters_ = cc.WinogradFilters(w, self.num_input_channels_)
+      else:
+        self.transformed_filters_ = cc.FFTFilters(w, self.num_input_channels_,
+                                                  self.fft_size_)
+    return self.transformed_filters_
+
+  def GetParams(self):
+    params = super(ConvEdge, self).GetParams()
+    if self.transformed_filters_ is not None:
+      params['%s:%s' % (self.name_, self.algorithm_)] = self.transformed_filters_
+    return params
+
+  def LoadLazyParams(self):
+    params = self.params_
+    super(ConvEdge, self).LoadLazyParams()
+    if params is not None and self.algorithm_ != 'direct':
+      # Saved with the weights by model_cache.py, so that they are not recomputed.
+      self.transformed_filters_ = params.GetTransformedFilters(self.name_,
+                                                               self.algorithm_)
+
+  def FoldInputChannels(self, M):
+    super(ConvEdge, self).FoldInputChannels(M)
+    self.transformed_filters_ = None
+
+  def MatchLayout(self):
+    super(ConvEdge, self).MatchLayout()
+    if self.algorithm_ == 'fft' and self.dest_.IsChannelsLast():
+      self.SetAlgorithm('direct')
 
   def AllocateMemory(self):
+    self.transformed_filters_ = None
     input_size = self.kernel_size_**2 * self.num_input_channels_
     if self.shared_bias_:
       bias_locs = 1
@@ -99,13 +378,62 @@ class ConvEdge(EdgeWithWeight):
     self.weights_ = cm.empty((self.num_output_channels_, input_size))
     self.bias_ = cm.empty((1, self.num_output_channels_ * bias_locs))
 
+  def CanQuantize(self):
+    # The quantized kernels overwrite their targets.
+    return USE_CPU and len(self.dest_.incoming_edge_) == 1 \
+      and not self.weights_channels_last_
+
   def ComputeUp(self, input_layer, output_layer, overwrite):
+    self.LoadLazyParams()
     scale_targets = 0 if overwrite else 1
     w = self.weights_
     b = self.bias_
     input_state = input_layer.GetState()
     output_state = output_layer.GetState()
     batch_size = input_state.shape[0]
+    if self.quantized_:
+      cc.convUpQuantized(input_state, self.weights_q_, self.weights_scale_,
+                         self.input_scale_, b, output_state, self.image_size_,
+                         self.num_modules_, self.num_modules_, self.padding_,
+                         self.stride_, self.num_input_channels_, self.relu_)
+      return
+    if self.autotuner_ is not None and batch_size != self.tuned_batch_size_:
+      self.tuned_batch_size_ = batch_size
+      self.autotuner_.Tune(self, input_layer, output_layer)
+    if output_layer.IsChannelsLast():
+      if self.fused_ and self.algorithm_ == 'winograd':
+        cc.convUpWinogradChannelsLast(
+          input_state, self.GetTransformedFilters(), b, output_state,
+          self.image_size_, self.num_modules_, self.padding_,
+          self.num_input_channels_, self.relu_, input_layer.IsChannelsLast())
+        return
+      cc.convUpChannelsLast(input_state, w, b, output_state, self.image_size_,
+                            self.num_modules_, self.padding_, self.stride_,
+                            self.num_input_channels_, self.relu_,
+                            input_layer.IsChannelsLast(), scale_targets)
+      return
+    if self.fused_ and self.algorithm_ == 'winograd':
+      cc.convUpWinograd(input_state, self.GetTransformedFilters(), b,
+                        output_state, self.image_size_, self.num_modules_,
+                        self.padding_, self.num_input_channels_, self.relu_)
+      return
+    if self.fused_ and self.algorithm_ == 'fft':
+      cc.convUpFFT(input_state, self.GetTransformedFilters(), b, output_state,
+                   self.image_size_, self.num_modules_, self.padding_,
+                   self.stride_, self.num_input_channels_, self.fft_size_,
+                   self.relu_)
+      return
+    if self.weights_half_ is not None:
+      cc.convUpHalf(input_state, self.weights_half_, b, output_state,
+                    self.image_size_, self.num_modules_, self.num_modules_,
+                    self.padding_, self.stride_, self.num_input_channels_,
+                    self.relu_, scale_targets)
+      return
+    if self.fused_:
+      cc.convUpBias(input_state, w, b, output_state, self.image_size_,
+                    self.num_modules_, self.num_modules_, self.padding_,
+                    self.stride_, self.num_input_channels_, self.relu_)
+      return
     cc.convUp(input_state, w, output_state, self.image_size_, self.num_modules_,
               self.num_modules_, self.padding_, self.stride_,
               self.num_input_channels_, scale_targets)
@@ -115,6 +443,35 @@ class ConvEdge(EdgeWithWeight):
     if self.shared_bias_:
       output_state.reshape((batch_size, -1))
 
+  def FoldInputAffine(self, M, v):
+    """Folds the map x -> M x + v, applied to the channels of every input pixel
+    before this edge, into the weights and bias.
+
+    With padding, windows at the border see zeros instead of v, so the bias
+    correction is computed by convolving an image filled with v, and the bias
+    stops being shared unless it is the same at every location.
+    """
+    self.LoadLazyParams()
+    self.PermuteWeights(False)
+    self.WidenWeights()
+    num_locs = self.num_modules_**2
+    image = np.repeat(np.asarray(v, dtype=np.float32), self.image_size_**2)
+    image = cm.CUDAMatrix(image.reshape(1, -1))
+    correction = cm.empty((1, self.num_output_channels_ * num_locs))
+    cc.convUp(image, self.weights_, correction, self.image_size_,
+              self.num_modules_, self.num_modules_, self.padding_, self.stride_,
+              self.num_input_channels_)
+    correction = correction.asarray().reshape(self.num_output_channels_, num_locs)
+    b = self.bias_.asarray().reshape(self.num_output_channels_, -1)
+    b = b + correction
+    if self.shared_bias_ and np.allclose(b, b[:, :1]):
+      b = b[:, :1]
+    else:
+      self.shared_bias_ = False
+    self.bias_.free_device_memory()
+    self.bias_ = cm.CUDAMatrix(b.reshape(1, -1))
+    self.FoldInputChannels(M)
+
 class MaxPoolEdge(Edge):
   def __init__(self, edge_proto):
     super(MaxPoolEdge, self).__init__(edge_proto)
@@ -127,9 +484,17 @@ class MaxPoolEdge(Edge):
     self.num_modules_ = (image_size + 2 * self.padding_
                          - self.kernel_size_) / self.stride_ + 1
 
+  def CanUseChannelsLast(self):
+    return USE_CPU
+
   def ComputeUp(self, input_layer, output_layer, overwrite):
     input_state = input_layer.GetState()
     output_state = output_layer.GetState()
+    if output_layer.IsChannelsLast():
+      cc.MaxPoolChannelsLast(input_state, output_state, self.num_input_channels_,
+                             self.kernel_size_, self.padding_, self.stride_,
+                             self.num_modules_, input_layer.IsChannelsLast())
+      return
     cc.MaxPool(input_state, output_state, self.num_input_channels_,
                self.kernel_size_, self.padding_, self.stride_,
                self.num_modules_)
@@ -148,13 +513,40 @@ class ResponseNormEdge(Edge):
     self.num_modules_ = image_size
     self.num_filters_response_norm_ = int(self.frac_ * self.num_input_channels_)
 
+  def CanUseChannelsLast(self):
+    return USE_CPU
+
   def ComputeUp(self, input_layer, output_layer, overwrite):
     input_state = input_layer.GetState()
     output_state = output_layer.GetState()
+    if output_layer.IsChannelsLast():
+      cc.ResponseNormCrossMapChannelsLast(
+        input_state, output_state, self.num_input_channels_,
+        self.num_filters_response_norm_, self.add_scale_, self.pow_scale_,
+        self.blocked_, input_layer.IsChannelsLast())
+      return
     cc.ResponseNormCrossMap(input_state, output_state, self.num_input_channels_,
                             self.num_filters_response_norm_, self.add_scale_,
                             self.pow_scale_, self.blocked_)
 
+class RGBToYUVEdge(Edge):
+  def __init__(self, edge_proto):
+    super(RGBToYUVEdge, self).__init__(edge_proto)
+
+  def SetImageSize(self, image_size):
+    self.image_size_ = image_size
+    self.num_modules_ = image_size
+
+  def CanUseChannelsLast(self):
+    return USE_CPU
+
+  def ComputeUp(self, input_layer, output_layer, overwrite):
+    if output_layer.IsChannelsLast():
+      cc.RGBToYUVChannelsLast(input_layer.GetState(), output_layer.GetState(),
+                              input_layer.IsChannelsLast())
+      return
+    cc.RGBToYUV(input_layer.GetState(), output_layer.GetState())
+
 class FCEdge(EdgeWithWeight):
   def __init__(self, edge_proto):
     super(FCEdge, self).__init__(edge_proto)
@@ -164,13 +556,42 @@ class FCEdge(EdgeWithWeight):
     self.weights_ = cm.empty((self.num_output_channels_, input_size))
     self.bias_ = cm.empty((1, self.num_output_channels_))
 
+  def CanQuantize(self):
+    # The quantized kernels overwrite their targets.
+    return USE_CPU and len(self.dest_.incoming_edge_) == 1 \
+      and not self.weights_channels_last_
+
+  def CanReadChannelsLast(self):
+    return USE_CPU
+
+  def MatchLayout(self):
+    # The weights follow the layout of the input instead.
+    self.weights_channels_last_ = self.source_.IsChannelsLast()
+    self.PermuteWeights(self.weights_channels_last_)
+
   def ComputeUp(self, input_layer, output_layer, overwrite):
+    self.LoadLazyParams()
     scale_targets = 0 if overwrite else 1
 
     input_state = input_layer.GetState()
     output_state = output_layer.GetState()
     w = self.weights_
     b = self.bias_
+    if input_layer.IsChannelsLast():
+      cc.dotChannelsLast(input_state, w, b, output_state,
+                         self.num_input_channels_, self.relu_, scale_targets)
+      return
+    if self.quantized_:
+      cc.dotQuantized(input_state, self.weights_q_, self.weights_scale_,
+                      self.input_scale_, b, output_state, self.relu_)
+      return
+    if self.weights_half_ is not None:
+      cc.dotHalf(input_state, self.weights_half_, b, output_state, self.relu_,
+                 scale_targets)
+      return
+    if self.fused_:
+      cc.dotBias(input_state, w, b, output_state, self.relu_)
+      return
     cm.dot(input_state, w.T, target=output_state, scale_targets=scale_targets)
     output_state.add_row_vec(b)
 
@@ -187,17 +608,32 @@ class ConvOneToOneEdge(EdgeWithWeight):
                               self.num_input_channels_))
     self.bias_ = cm.empty((1, self.num_output_channels_))
 
+  def CanUseChannelsLast(self):
+    return USE_CPU
+
   def ComputeUp(self, input_layer, output_layer, overwrite):
+    self.LoadLazyParams()
     scale_targets = 0 if overwrite else 1
     w = self.weights_
     b = self.bias_
     input_state = input_layer.GetState()
     output_state = output_layer.GetState()
+    if output_layer.IsChannelsLast():
+      cc.convOneToOneChannelsLast(input_state, w, b, output_state,
+                                  self.num_input_channels_, self.relu_,
+                                  input_layer.IsChannelsLast(), scale_targets)
+      return
     batch_size = input_state.shape[0]
     input_state.reshape((-1, self.num_input_channels_))
     output_state.reshape((-1, self.num_output_channels_))
-    cm.dot(input_state, w.T, target=output_state, scale_targets=scale_targets)
-    output_state.add_row_vec(b)
+    if self.weights_half_ is not None:
+      cc.dotHalf(input_state, self.weights_half_, b, output_state, self.relu_,
+                 scale_targets)
+    elif self.fused_:
+      cc.dotBias(input_state, w, b, output_state, self.relu_)
+    else:
+      cm.dot(input_state, w.T, target=output_state, scale_targets=scale_targets)
+      output_state.add_row_vec(b)
 
     input_state.reshape((batch_size, -1))
     output_state.reshape((batch_size, -1))
@@ -0,0 +1,188 @@
+""" Reads lists of images into batches for ConvNet.Extract."""
+import collections
+import multiprocessing
+import os
+import sys
+import threading
+import Queue
+import numpy as np
+try:
+  from PIL import Image
+except ImportError:
+  try:
+    import Image
+  except ImportError:
+    Image = None
+
+def LoadImage(file_name, resize=256, crop=224, draft=True):
+  """Returns the image resized so that its shorter side is resize pixels and
+  center-cropped to crop x crop, as a (1, 3 * crop * crop) uint8 array. It
+  used to be a float64 array: callers that need floats must convert it.
+
+  With draft, JPEGs are decoded at 1/2, 1/4 or 1/8 of their size when that
+  still leaves the shorter side at least resize pixels. The decoder then skips
+  most of the inverse DCT, and the resize has fewer pixels to filter.
+  """
+  image = _OpenResized(file_name, resize, draft)
+  width, height = image.size
+  left = (width  - crop) / 2
+  top  = (height - crop) / 2
+  image_resized = image.crop((left, top, left + crop, top + crop))
+  # np.asarray reads the pixels through the buffer protocol as (y, x, color).
+  data = np.asarray(image_resized.convert('RGB')).transpose(2, 0, 1).reshape(1, -1)
+  return data
+
+def DecodeImage(file_name, resize=256, draft=True):
+  """Returns the whole image resized so that its shorter side is resize
+  pixels, as a (3, height, width) uint8 array."""
+  image = _OpenResized(file_name, resize, draft)
+  return np.asarray(image.convert('RGB')).transpose(2, 0, 1)
+
+def _OpenResized(file_name, resize, draft):
+  if Image is None:
+    raise Exception('Reading images requires PIL.')
+  image = Image.open(file_name)
+  width, height = image.size
+
+  if width > height:
+    width = (width * resize) / height
+    height = resize
+  else:
+    height = (height * resize) / width
+    width = resize
+  if draft:
+    image.draft('RGB', (width, height))
+  return image.resize((width, height), Image.BICUBIC)
+
+def _LoadImage(args):
+  return LoadImage(*args)
+
+class ImageCache(object):
+  """Keeps the images returned by DecodeImage, up to max_bytes of pixels, so
+  that images read again are not decoded again. When it is full, the least
+  recently used images are dropped. The arrays returned are shared and read
+  only. It can be used from several threads."""
+
+  def __init__(self, max_bytes, resize=256, draft=True):
+    self.max_bytes_ = max_bytes
+    self.resize_ = resize
+    self.draft_ = draft
+    self.images_ = collections.OrderedDict()
+    self.bytes_ = 0
+    self.hits_ = 0
+    self.misses_ = 0
+    self.evictions_ = 0
+    self.lock_ = threading.Lock()
+
+  def Get(self, file_name):
+    with self.lock_:
+      image = self.images_.pop(file_name, None)
+      if image is not None:
+        self.images_[file_name] = image  # Now the most recently used.
+        self.hits_ += 1
+        return image
+      self.misses_ += 1
+    image = DecodeImage(file_name, self.resize_, self.draft_)
+    image.flags.writeable = False
+    with self.lock_:
+      if image.nbytes <= self.max_bytes_ and file_name not in self.images_:
+        while self.bytes_ + image.nbytes > self.max_bytes_:
+          _, old = self.images_.popitem(last=False)
+          self.bytes_ -= old.nbytes
+          self.evictions_ += 1
+        self.images_[file_name] = image
+        self.bytes_ += image.nbytes
+    return image
+
+  def GetStats(self):
+    """Returns the number of hits, misses and evictions, the hit rate, and the
+    number and bytes of the images held."""
+    with self.lock_:
+      lookups = self.hits_ + self.misses_
+      return {'hits': self.hits_, 'misses': self.misses_,
+              'evictions': self.evictions_,
+              'hit_rate': float(self.hits_) / lookups if lookups else 0.,
+              'images': len(self.images_), 'bytes': self.bytes_,
+              'max_bytes': self.max_bytes_}
+
+def ReadFileList(list_file):
+  """Yields (id, file_name) for each line of a file list such as
+  test_images.txt. The id is the line itself, and the file name is relative to
+  the directory of the list. The list is read one line at a time."""
+  base_dir = os.path.dirname(os.path.abspath(list_file))
+  with open(list_file) as f:
+    for line in f:
+      line = line.strip()
+      if line:
+        yield line, os.path.join(base_dir, line)
+
+def ImageBatches(files, batch_size, resize=256, crop=224, pool=None,
+                 draft=True):
+  """Yields (ids, data) for batches of up to batch_size images, where data is
+  a (n, 3 * crop * crop) float32 array. files is a sequence of
+  (id, file_name). If pool is a multiprocessing.Pool, the images of each batch
+  are decoded by its workers. Only one batch is handed to the pool at a time,
+  so that a long list is not queued up in memory."""
+  ids, file_names = [], []
+  for image_id, file_name in files:
+    ids.append(image_id)
+    file_names.append(file_name)
+    if len(ids) == batch_size:
+      yield ids, _LoadBatch(file_names, resize, crop, pool, draft)
+      ids, file_names = [], []
+  if ids:
+    yield ids, _LoadBatch(file_names, resize, crop, pool, draft)
+
+def _LoadBatch(file_names, resize, crop, pool, draft):
+  args = [(f, resize, crop, draft) for f in file_names]
+  images = map(_LoadImage, args) if pool is None else pool.map(_LoadImage, args)
+  data = np.empty((len(images), 3 * crop * crop), dtype=np.float32)
+  for i, image in enumerate(images):
+    data[i] = image
+  return data
+
+def GetPool(num_workers):
+  """Returns a pool of num_workers processes to decode images, or None if
+  num_workers is 0."""
+  return multiprocessing.Pool(num_workers) if num_workers > 0 else None
+
+def Prefetch(iterable, depth=2):
+  """Yields the items of iterable, computing up to depth of them ahead on a
+  background thread. Exceptions raised by iterable are raised in the caller."""
+  queue = Queue.Queue(maxsize=depth)
+  stop = threading.Event()
+  done = object()
+
+  def Put(item):
+    while not stop.is_set():
+      try:
+        queue.put(item, timeout=0.1)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def Work():
+    try:
+      for item in iterable:
+        if not Put((item, None)):
+          return
+    except Exception:
+      Put((done, sys.exc_info()))
+      return
+    Put((done, None))
+
+  thread = threading.Thread(target=Work)
+  thread.daemon = True
+  thread.start()
+  try:
+    while True:
+      item, exc_info = queue.get()
+      if item is done:
+        if exc_info is not None:
+          raise exc_info[0], exc_info[1], exc_info[2]
+        return
+      yield item
+  finally:
+    # Lets the thread finish if the caller stops early.
+    stop.set()
@@ -0,0 +1,122 @@
+""" Stores a list of images, decoded and cropped once, in one memory-mapped
+file."""
+import json
+import struct
+from image_reader import DecodeImage, GetPool, ReadFileList
+from util import *
+
+MAGIC = 'CNVIMGS1'
+ALIGNMENT = 64
+
+def IsImageStore(file_name):
+  with open(file_name, 'rb') as f:
+    return f.read(len(MAGIC)) == MAGIC
+
+def PreprocessImage(file_name, raw_image_size, image_size_y, image_size_x,
+                    draft=True):
+  """Returns the image resized so that its shorter side is raw_image_size,
+  center-cropped to image_size_y x image_size_x, as ImageDataIterator does,
+  as a (3 * image_size_y * image_size_x,) uint8 array."""
+  image = DecodeImage(file_name, raw_image_size, draft)
+  top = (image.shape[1] - image_size_y) / 2
+  left = (image.shape[2] - image_size_x) / 2
+  return image[:, top:top + image_size_y, left:left + image_size_x].reshape(-1)
+
+def _PreprocessImage(args):
+  return PreprocessImage(*args)
+
+def WriteImageStore(list_file, file_name, raw_image_size=256, image_size_y=None,
+                    image_size_x=None, num_workers=0, draft=True):
+  """Decodes the images of list_file and writes them to file_name.
+
+  The file is MAGIC, the start of the images and a JSON header, followed by
+  the images, each 3 x image_size_y x image_size_x uint8 values, at a fixed
+  stride aligned to ALIGNMENT bytes. The header holds the sizes and the ids
+  of the images, in the order of the list, from which the offset of each
+  image follows. Images are decoded by num_workers processes, if any.
+  """
+  if image_size_y is None:
+    image_size_y = raw_image_size
+  if image_size_x is None:
+    image_size_x = raw_image_size
+  if image_size_y > raw_image_size or image_size_x > raw_image_size:
+    raise Exception('image_size must not be larger than raw_image_size.')
+  files = list(ReadFileList(list_file))
+  num_dims = 3 * image_size_y * image_size_x
+  stride = (num_dims + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+  header = json.dumps({'raw_image_size': raw_image_size,
+                       'image_size_y': image_size_y,
+                       'image_size_x': image_size_x,
+                       'num_colors': 3, 'stride': stride,
+                       'ids': [image_id for image_id, _ in files]})
+  start = len(MAGIC) + 8 + len(header)
+  start = (start + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+  args = [(f, raw_image_size, image_size_y, image_size_x, draft) for _, f in files]
+  pool = GetPool(num_workers)
+  tmp_file = '%s.%d.tmp' % (file_name, os.getpid())
+  try:
+    images = map(_PreprocessImage, args) if pool is None else \
+        pool.imap(_PreprocessImage, args, chunksize=16)
+    with open(tmp_file, 'wb') as f:
+      f.write(MAGIC)
+      f.write(struct.pack('<Q', start))
+      f.write(header)
+      for i, image in enumerate(images):
+        f.seek(start + i * stride)
+        f.write(image.tostring())
+      f.truncate(start + len(files) * stride)
+  finally:
+    if pool is not None:
+      pool.terminate()
+  # Readers never see a partial file.
+  os.rename(tmp_file, file_name)
+
+class ImageStore(object):
+  """A file written by WriteImageStore, memory-mapped read only. Images are
+  returned as views of the map, so reading them copies nothing until they are
+  used, and the data is read from the page cache."""
+
+  def __init__(self, file_name):
+    self.file_name_ = file_name
+    with open(file_name, 'rb') as f:
+      if f.read(len(MAGIC)) != MAGIC:
+        raise Exception('%s is not an image store.' % file_name)
+      start, = struct.unpack('<Q', f.read(8))
+      header = json.loads(f.read(start - len(MAGIC) - 8).rstrip('\0'))
+    self.raw_image_size_ = header['raw_image_size']
+    self.image_size_y_ = header['image_size_y']
+    self.image_size_x_ = header['image_size_x']
+    self.num_dims_ = header['num_colors'] * self.image_size_y_ * self.image_size_x_
+    self.ids_ = header['ids']
+    self.rows_ = dict((image_id, row) for row, image_id in enumerate(self.ids_))
+    size = len(self.ids_)
+    self.map_ = np.memmap(file_name, dtype=np.uint8, mode='r')
+    self.images_ = np.ndarray((size, self.num_dims_), dtype=np.uint8,
+                              buffer=self.map_, offset=start,
+                              strides=(header['stride'], 1))
+
+  def GetDataSetSize(self):
+    return self.images_.shape[0]
+
+  def GetDims(self):
+    return self.num_dims_
+
+  def GetRawImageSize(self):
+    return self.raw_image_size_
+
+  def GetImageSize(self):
+    return self.image_size_y_, self.image_size_x_
+
+  def GetIds(self):
+    return self.ids_
+
+  def GetRow(self, image_id):
+    return self.rows_[image_id]
+
+  def GetRows(self, start, end):
+    """Returns images start to end as a (end - start, dims) uint8 view."""
+    return self.images_[start:end]
+
+  def Close(self):
+    self.images_ = None
+    self.map_ = None
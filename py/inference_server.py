@@ -0,0 +1,220 @@
+""" Serves ConvNet features over HTTP from pre-forked worker processes."""
+import BaseHTTPServer
+import SocketServer
+import errno
+import json
+import os
+import signal
+import stat
+import urlparse
+from cStringIO import StringIO
+import numpy as np
+import convnet as cn
+from image_reader import LoadImage
+from batcher import Batcher, DeadlineExceeded
+from model_cache import LoadModel
+
+class InferenceServer(object):
+  """Answers requests for the features of an image on one listening socket,
+  from num_workers processes forked after the models are loaded.
+
+  Each model is loaded and run once on a blank image before the workers are
+  forked. Its weights, and the transformed filters of its Winograd and FFT
+  edges, are then in pages that all workers share copy-on-write. Each worker
+  gets its own layer states on its first request.
+
+  POST /<model>?layers=hidden7,output with an image as the body returns
+  {layer: features} as JSON. layers defaults to the output layers of the
+  model. GET /models returns {model: layer names}.
+
+  With max_batch_size > 1, each worker serves requests on concurrent threads
+  and merges them into batches (see Batcher). A request can then set
+  timeout_ms, which is rejected otherwise, and GET /stats returns the batching statistics of the worker
+  that answers it.
+
+  With a cache_dir, models are loaded through model_cache.LoadModel.
+  """
+
+  def __init__(self, address, num_workers=1, resize=256, max_batch_size=1,
+               max_wait=0.005, cache_dir=None):
+    if not cn.USE_CPU:
+      raise Exception('The inference server needs the CPU backend.')
+    self.address_ = address
+    self.num_workers_ = num_workers
+    self.resize_ = resize
+    self.max_batch_size_ = max_batch_size
+    self.max_wait_ = max_wait
+    self.cache_dir_ = cache_dir
+    self.models_ = {}
+    self.batchers_ = {}
+    self.workers_ = set()
+    self.server_ = None
+
+  def AddModel(self, name, pbtxt_file, params_file, means_file=None):
+    if self.cache_dir_ is None:
+      model = cn.ConvNet(pbtxt_file)
+      model.Load(params_file)
+    else:
+      model = LoadModel(pbtxt_file, params_file, self.cache_dir_)
+    input_layer = model.GetInputLayer()
+    if means_file:
+      model.SetNormalizer(means_file, input_layer.GetImageSize())
+    model.Fprop(np.zeros((1, input_layer.GetSize()), dtype=np.float32))
+    self.models_[name] = model
+
+  def GetModels(self):
+    return dict((name, model.GetLayerNames())
+                for name, model in self.models_.items())
+
+  def GetStats(self):
+    return dict((name, batcher.GetStats())
+                for name, batcher in self.batchers_.items())
+
+  def Compute(self, name, image, layers=None, timeout=None):
+    """Returns {layer: features} for image, the contents of an image file."""
+    model = self.models_[name]
+    if not layers:
+      layers = [l.GetName() for l in model.layer_ if l.IsOutput()]
+    crop = model.GetInputLayer().GetImageSize()
+    data = LoadImage(StringIO(image), self.resize_, crop).astype(np.float32)
+    if name in self.batchers_:
+      states = self.batchers_[name].Compute(data, layers, timeout)
+    else:
+      model.Fprop(data, targets=layers)
+      states = dict((l, model.GetState(l)) for l in layers)
+    return dict((l, states[l][0].tolist()) for l in layers)
+
+  def Run(self):
+    """Serves until SIGTERM or SIGINT. Workers that die are replaced."""
+    self.server_ = MakeServer(self.address_, self, self.max_batch_size_ > 1)
+    signal.signal(signal.SIGTERM, _Exit)
+    try:
+      while len(self.workers_) < self.num_workers_:
+        self.Fork()
+      while True:
+        try:
+          pid, _ = os.wait()
+        except OSError as e:
+          if e.errno != errno.EINTR:
+            raise
+          continue
+        if pid in self.workers_:
+          self.workers_.remove(pid)
+          self.Fork()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      self.Stop()
+
+  def Fork(self):
+    pid = os.fork()
+    if pid == 0:
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      try:
+        if self.max_batch_size_ > 1:
+          # Threads do not survive fork, so each worker starts its own.
+          self.batchers_ = dict(
+            (name, Batcher(model, self.max_batch_size_, self.max_wait_))
+            for name, model in self.models_.items())
+        self.server_.serve_forever()
+      finally:
+        os._exit(0)
+    self.workers_.add(pid)
+
+  def Stop(self):
+    for pid in self.workers_:
+      try:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+      except OSError:
+        pass
+    self.workers_ = set()
+    self.server_.server_close()
+    if isinstance(self.server_, UnixHTTPServer):
+      os.remove(self.address_)
+
+def _Exit(signum, frame):
+  raise SystemExit(0)
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    path = urlparse.urlparse(self.path).path
+    if path == '/models':
+      self.Reply(200, self.server.inference_server_.GetModels())
+    elif path == '/stats':
+      self.Reply(200, self.server.inference_server_.GetStats())
+    else:
+      self.Reply(404, {'error': 'Not found.'})
+
+  def do_POST(self):
+    inference_server = self.server.inference_server_
+    url = urlparse.urlparse(self.path)
+    name = url.path.strip('/')
+    if name not in inference_server.models_:
+      return self.Reply(404, {'error': 'Unknown model %s.' % name})
+    query = urlparse.parse_qs(url.query)
+    layers = [l for v in query.get('layers', []) for l in v.split(',') if l]
+    unknown = [l for l in layers
+               if l not in inference_server.models_[name].layer_name_dict_]
+    if unknown:
+      return self.Reply(400, {'error': 'Unknown layers %s.' % ', '.join(unknown)})
+    timeout = None
+    if 'timeout_ms' in query:
+      try:
+        timeout = float(query['timeout_ms'][0]) / 1000
+      except ValueError:
+        return self.Reply(400, {'error': 'Invalid timeout_ms %s.' % query['timeout_ms'][0]})
+      if inference_server.max_batch_size_ <= 1:
+        # Requests run one at a time as they arrive, with no queue to drop
+        # them from.
+        return self.Reply(400, {'error': 'timeout_ms needs a max_batch_size above 1.'})
+    image = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+    try:
+      result = inference_server.Compute(name, image, layers, timeout)
+    except IOError as e:
+      return self.Reply(400, {'error': 'Can not read the image: %s' % e})
+    except DeadlineExceeded as e:
+      return self.Reply(504, {'error': str(e)})
+    except Exception as e:
+      return self.Reply(500, {'error': str(e)})
+    self.Reply(200, result)
+
+  def Reply(self, code, result):
+    body = json.dumps(result)
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+class TCPHTTPServer(BaseHTTPServer.HTTPServer):
+  # Lets a restarted server bind while old connections are in TIME_WAIT.
+  allow_reuse_address = True
+
+class UnixHTTPServer(SocketServer.UnixStreamServer):
+  pass
+
+class ThreadingTCPHTTPServer(SocketServer.ThreadingMixIn, TCPHTTPServer):
+  daemon_threads = True
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, UnixHTTPServer):
+  daemon_threads = True
+
+def MakeServer(address, inference_server, threading=False):
+  """Returns a server listening on address, which is host:port or the path
+  of a Unix socket. With threading, each request is handled on its own
+  thread."""
+  host, sep, port = address.rpartition(':')
+  if sep and port.isdigit():
+    server_class = ThreadingTCPHTTPServer if threading else TCPHTTPServer
+    server = server_class((host, int(port)), RequestHandler)
+  else:
+    if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+      os.remove(address)  # Left over from a server that did not stop cleanly.
+    server_class = ThreadingUnixHTTPServer if threading else UnixHTTPServer
+    server = server_class(address, RequestHandler)
+  server.inference_server_ = inference_server
+  return server
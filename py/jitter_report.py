@@ -0,0 +1,93 @@
+import sys
+import time
+import numpy as np
+from PIL import Image
+from augmenter import JitterGrids
+try:
+  import cv2
+except ImportError:
+  cv2 = None
+
+def Usage():
+  print 'python jitter_report.py [batch_size] [image_size] [max_angle] [min_scale] [reps]'
+
+def SampleJitter(random, batch_size, max_angle, min_scale):
+  """Returns angles, scales and translations drawn as in
+  RawImageFileIterator::SampleNoiseDistributions."""
+  angles = 2 * max_angle * (random.rand(batch_size) - 0.5)
+  scales = min_scale + (1 - min_scale) * random.rand(batch_size)
+  return angles, scales, random.rand(batch_size), random.rand(batch_size)
+
+def GetAffine(angle, scale, trans_y, trans_x, size):
+  """Returns the 2 x 3 matrix that maps output (x, y) to source (x, y) for one
+  image, as RawImageFileIterator::Transform builds it."""
+  scale = max(scale, 1)
+  crop = int(size / scale)
+  top = int((size - crop) * trans_y)
+  left = int((size - crop) * trans_x)
+  theta = np.deg2rad(angle)
+  k = float(crop) / (size * (np.sin(abs(theta)) + np.cos(abs(theta))))
+  c, s = k * np.cos(theta), k * np.sin(theta)
+  center = (size - 1) / 2.
+  cx, cy = left + (crop - 1) / 2., top + (crop - 1) / 2.
+  return np.array([[c, -s, cx - c * center + s * center],
+                   [s, c, cy - s * center - c * center]])
+
+def PILWarp(images, jitter, method):
+  n, num_colors, size = images.shape[:3]
+  out = np.empty(images.shape, dtype=images.dtype)
+  for i in range(n):
+    image = Image.fromarray(images[i].transpose(1, 2, 0))
+    m = GetAffine(*([p[i] for p in jitter] + [size]))
+    image = image.transform((size, size), Image.AFFINE, tuple(m.reshape(-1)), method)
+    out[i] = np.asarray(image).transpose(2, 0, 1)
+  return out
+
+def OpenCVWarp(images, jitter, interpolation):
+  n, num_colors, size = images.shape[:3]
+  out = np.empty(images.shape, dtype=images.dtype)
+  for i in range(n):
+    m = GetAffine(*([p[i] for p in jitter] + [size]))
+    image = np.ascontiguousarray(images[i].transpose(1, 2, 0))
+    image = cv2.warpAffine(image, m, (size, size),
+                           flags=interpolation | cv2.WARP_INVERSE_MAP)
+    out[i] = image.transpose(2, 0, 1)
+  return out
+
+def BatchedWarp(images, jitter, grids):
+  angles, scales, trans_y, trans_x = jitter
+  return grids.Apply(images, grids.GetGrids(angles, scales), trans_y, trans_x)
+
+def main():
+  if len(sys.argv) > 1 and sys.argv[1] in ('-h', '--help'):
+    Usage()
+    sys.exit(1)
+  batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+  size = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+  max_angle = float(sys.argv[3]) if len(sys.argv) > 3 else 15
+  min_scale = float(sys.argv[4]) if len(sys.argv) > 4 else 1.3
+  reps = int(sys.argv[5]) if len(sys.argv) > 5 else 3
+  random = np.random.RandomState(0)
+  images = random.randint(0, 256, (batch_size, 3, size, size)).astype(np.uint8)
+  grids = JitterGrids(size, size, max_angle, min_scale)
+  methods = [('per image PIL, nearest', lambda j: PILWarp(images, j, Image.NEAREST)),
+             ('per image PIL, bilinear', lambda j: PILWarp(images, j, Image.BILINEAR))]
+  if cv2 is not None:
+    methods += [('per image OpenCV, nearest', lambda j: OpenCVWarp(images, j, cv2.INTER_NEAREST)),
+                ('per image OpenCV, bilinear', lambda j: OpenCVWarp(images, j, cv2.INTER_LINEAR))]
+  methods.append(('batched grids, nearest', lambda j: BatchedWarp(images, j, grids)))
+  print '%d images of 3 x %d x %d, angles up to %g, scales up to %g' % (
+    batch_size, size, size, max_angle, min_scale)
+  for name, warp in methods:
+    best = None
+    for i in range(reps):
+      jitter = SampleJitter(random, batch_size, max_angle, min_scale)
+      start = time.time()
+      warp(jitter)
+      t = time.time() - start
+      best = t if best is None else min(best, t)
+    print '%-28s %10.1f images/s' % (name, batch_size / best)
+  print '%d grids computed' % grids.GetNumGrids()
+
+if __name__ == '__main__':
+  main()
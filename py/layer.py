@@ -17,12 +17,15 @@ class Layer(object):
     self.is_output_ = True
     self.incoming_edge_ = []
     self.outgoing_edge_ = []
-    self.image_size_ = 1
+    self.image_size_ = layer_proto.image_size_y
     self.name_ = layer_proto.name
     self.dropprob_ = layer_proto.dropprob
     self.dropout_scale_up_at_train_time_ = True
     self.gaussian_dropout_ = layer_proto.gaussian_dropout
     self.state_ = None
+    self.owns_state_ = False
+    self.activation_fused_ = False
+    self.channels_last_ = False
 
   def GetName(self):
     return self.name_
@@ -33,15 +36,45 @@ class Layer(object):
   def IsInput(self):
     return self.is_input_
 
+  def IsOutput(self):
+    return self.is_output_
+
   def SetSize(self, image_size):
     self.image_size_ = image_size
 
+  def GetImageSize(self):
+    return self.image_size_
+
+  def GetSize(self):
+    return self.num_channels_ * self.image_size_**2
+
+  def CanUseChannelsLast(self):
+    return True
+
+  def SetChannelsLast(self, channels_last):
+    """ Sets whether the state is stored channels-last (see cpuconv.py)."""
+    self.channels_last_ = channels_last
+
+  def IsChannelsLast(self):
+    return self.channels_last_
+
   def AllocateMemory(self, batch_size):
-    layer_size = self.num_channels_ * self.image_size_**2
-    if self.state_ is not None:
-      self.state_.free_device_memory()
-    self.state_ = cm.empty((batch_size, layer_size))
+    self.FreeMemory()
+    self.state_ = cm.empty((batch_size, self.GetSize()))
     self.state_.assign(0)
+    self.owns_state_ = True
+
+  def SetState(self, state):
+    """ Makes state, a view into a shared buffer, the state of this layer."""
+    self.FreeMemory()
+    self.state_ = state
+
+  def FreeMemory(self):
+    # Views are not freed, the buffer they point into may still be in use.
+    if self.state_ is not None and self.owns_state_:
+      self.state_.free_device_memory()
+    self.state_ = None
+    self.owns_state_ = False
 
   def GetState(self):
     return self.state_
@@ -57,6 +90,13 @@ class Layer(object):
   def ApplyActivation(self):
     pass
 
+  def CanFuseActivation(self):
+    return True
+
+  def FuseActivation(self):
+    """ The incoming edge applies the activation, see Edge.FuseActivation."""
+    self.activation_fused_ = True
+
   def ApplyDropout(self):
     if self.dropprob_ > 0 and not self.dropout_scale_up_at_train_time_ \
        and not gaussian_dropout_:
@@ -68,13 +108,20 @@ class ReLULayer(Layer):
     super(ReLULayer, self).__init__(layer_proto)
 
   def ApplyActivation(self):
-    self.state_.lower_bound(0)
+    if not self.activation_fused_:
+      self.state_.lower_bound(0)
     self.ApplyDropout()
 
 class SoftmaxLayer(Layer):
   def __init__(self, layer_proto):
     super(SoftmaxLayer, self).__init__(layer_proto)
 
+  def CanFuseActivation(self):
+    return False
+
+  def CanUseChannelsLast(self):
+    return False
+
   def ApplyActivation(self):
     self.state_.apply_softmax_row_major()
     self.ApplyDropout()
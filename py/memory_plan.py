@@ -0,0 +1,52 @@
+""" Liveness-based sharing of layer states for forward props."""
+
+def GetLifetimes(layers, pinned):
+  """Returns {layer_name: (first_step, last_step)} for a topologically sorted
+  list of layers. A layer is written at its own step and read at the steps
+  of the destinations of its outgoing edges. Pinned layers live until the
+  end of the pass."""
+  step = dict((l.GetName(), i) for i, l in enumerate(layers))
+  end = len(layers) - 1
+  lifetimes = {}
+  for i, l in enumerate(layers):
+    if l.GetName() in pinned:
+      last = end
+    else:
+      # Edges into layers that are not in the list are never computed.
+      last = max([step[e.GetDestName()] for e in l.outgoing_edge_
+                  if e.GetDestName() in step] + [i])
+    lifetimes[l.GetName()] = (i, last)
+  return lifetimes
+
+def PlanMemory(layers, pinned):
+  """Assigns layers to a small pool of shared buffers (arenas).
+
+  Two layers share an arena only if their lifetimes are disjoint. Arenas are
+  picked best-fit: the smallest free arena that is large enough, otherwise the
+  largest free arena, grown to fit.
+
+  Returns:
+    arena_of : {layer_name: arena index}
+    arena_sizes : list of arena sizes in floats per image.
+  """
+  lifetimes = GetLifetimes(layers, pinned)
+  arena_of = {}
+  arena_sizes = []
+  busy_until = []  # Last step at which each arena is in use.
+  for i, l in enumerate(layers):
+    name = l.GetName()
+    size = l.GetSize()
+    free = [a for a in range(len(arena_sizes)) if busy_until[a] < i]
+    fits = [a for a in free if arena_sizes[a] >= size]
+    if len(fits) > 0:
+      a = min(fits, key=lambda a: arena_sizes[a])
+    elif len(free) > 0:
+      a = max(free, key=lambda a: arena_sizes[a])
+      arena_sizes[a] = size
+    else:
+      a = len(arena_sizes)
+      arena_sizes.append(size)
+      busy_until.append(0)
+    busy_until[a] = lifetimes[name][1]
+    arena_of[name] = a
+  return arena_of, arena_sizes
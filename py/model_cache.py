@@ -0,0 +1,139 @@
+""" Saves loaded models as single memory-mapped files, for fast startup."""
+import hashlib
+import json
+import struct
+import convnet as cn
+from util import *
+
+MAGIC = 'CONVNET1'
+ALIGNMENT = 64
+
+def GetDefaultCacheDir():
+  return os.environ.get('CONVNET_MODEL_CACHE',
+                        os.path.expanduser('~/.convnet_models'))
+
+def GetKey(pbtxt_file, params_file):
+  """Returns a hash of the contents of pbtxt_file and of the path, size and
+  modification time of params_file. Hashing the contents of the parameters
+  would take longer than loading them."""
+  h = hashlib.sha1(MAGIC)
+  h.update(open(pbtxt_file).read())
+  st = os.stat(params_file)
+  h.update('%s %d %r %d' % (os.path.abspath(params_file), st.st_size,
+                            st.st_mtime, st.st_ino))
+  return h.hexdigest()
+
+def WriteArtifact(model, file_name):
+  """Writes the Model proto and the parameters of every edge of model, which
+  must not be quantized, to file_name.
+
+  The file is MAGIC, the length of a JSON header and the header, followed by
+  the arrays, each aligned to ALIGNMENT bytes. The header gives the offset,
+  dtype and shape of every array. The Model proto is stored in binary as the
+  array 'model'.
+  """
+  arrays = {'model': np.frombuffer(model.model_.SerializePartialToString(), dtype=np.uint8)}
+  for e in model.edge_:
+    arrays.update(e.GetParams())
+  index = {}
+  offset = 0
+  for name in sorted(arrays):
+    array = arrays[name]
+    index[name] = (offset, array.dtype.str, array.shape)
+    offset += (array.nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+  header = json.dumps(index)
+  start = len(MAGIC) + 8 + len(header)
+  start = (start + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+  tmp_file = '%s.%d.tmp' % (file_name, os.getpid())
+  with open(tmp_file, 'wb') as f:
+    f.write(MAGIC)
+    f.write(struct.pack('<Q', start))
+    f.write(header)
+    for name in sorted(arrays):
+      f.seek(start + index[name][0])
+      f.write(np.ascontiguousarray(arrays[name]).tostring())
+  # Readers never see a partial file.
+  os.rename(tmp_file, file_name)
+
+class Artifact(object):
+  """A file written by WriteArtifact, memory-mapped copy-on-write. It reads
+  edge parameters like a ParamsFile, and also holds the Model proto and the
+  Winograd and FFT filters of the conv edges."""
+
+  def __init__(self, file_name):
+    self.file_name_ = file_name
+    with open(file_name, 'rb') as f:
+      if f.read(len(MAGIC)) != MAGIC:
+        raise Exception('%s is not a model artifact.' % file_name)
+      start, = struct.unpack('<Q', f.read(8))
+      header = f.read(start - len(MAGIC) - 8).rstrip('\0')
+    self.index_ = json.loads(header)
+    self.start_ = start
+    self.map_ = np.memmap(file_name, dtype=np.uint8, mode='c')
+
+  def Map(self, name):
+    offset, dtype, shape = self.index_[name]
+    dtype = np.dtype(str(dtype))
+    size = dtype.itemsize * int(np.prod(shape))
+    offset += self.start_
+    return np.asarray(self.map_[offset:offset + size]).view(dtype).reshape(shape)
+
+  def GetModel(self):
+    model = convnet_config_pb2.Model()
+    model.MergeFromString(self.Map('model').tostring())
+    return model
+
+  def GetDtype(self, name):
+    return np.dtype(str(self.index_[name][1]))
+
+  def Read(self, name, shape):
+    array = self.Map(name)
+    assert array.size == shape[0] * shape[1], '%s has shape %s, expected %s' % (
+      name, array.shape, shape[::-1])
+    return array.reshape(shape[::-1]).T
+
+  def ReadInto(self, name, mat):
+    array = self.Read(name, mat.shape)
+    if USE_CPU and array.dtype == np.float32:
+      mat.numpy_array = array
+    else:
+      mat.overwrite(array)
+
+  def GetTransformedFilters(self, name, algorithm):
+    name = '%s:%s' % (name, algorithm)
+    return self.Map(name) if name in self.index_ else None
+
+  def AddReader(self):
+    pass
+
+  def Done(self):
+    # The parameters of the edges are views of the map, so it stays open.
+    pass
+
+  def Close(self):
+    self.map_ = None
+
+def LoadModel(pbtxt_file, params_file, cache_dir=None):
+  """Returns a ConvNet for pbtxt_file with the parameters in params_file.
+
+  The first call for a pair of files loads them, runs the model once at batch
+  size 1, so that the conv edges compute their Winograd or FFT filters, and
+  saves everything in one file in cache_dir. Later calls, in any process, only
+  parse the Model proto from that file and map it: the parameters and filters
+  are read from the page cache the first time each edge is used.
+  """
+  if cache_dir is None:
+    cache_dir = GetDefaultCacheDir()
+  file_name = os.path.join(cache_dir, GetKey(pbtxt_file, params_file) + '.cnv')
+  if not os.path.exists(file_name):
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    model = cn.ConvNet(pbtxt_file)
+    model.Load(params_file)
+    input_size = model.GetInputLayer().GetSize()
+    model.Fprop(np.zeros((1, input_size), dtype=np.float32))
+    WriteArtifact(model, file_name)
+  artifact = Artifact(file_name)
+  model = cn.ConvNet(artifact.GetModel())
+  model.Load(artifact, lazy=True)
+  return model
@@ -0,0 +1,80 @@
+""" Reads edge parameters from HDF5 checkpoints without intermediate copies."""
+from util import *
+
+class ParamsFile(object):
+  """An HDF5 file of '<edge>:weight' and '<edge>:bias' datasets.
+
+  Contiguous float32 and float16 datasets are memory-mapped copy-on-write. A
+  dataset of shape (n, m) stored in C order has the same bytes as the (m, n)
+  FORTRAN-order matrix the backends use, so the map is used as is: on the CPU
+  backend it becomes the weight buffer, on the GPU it is copied to the device
+  straight from the page cache. Other datasets are read directly into the
+  buffer.
+
+  Edges that will read from the file call AddReader, and Done once they have.
+  The file is closed after the last Done. Maps stay valid after that.
+  """
+  def __init__(self, file_name):
+    self.file_name_ = file_name
+    self.f_ = h5py.File(file_name, 'r')
+    self.num_readers_ = 0
+
+  def AddReader(self):
+    self.num_readers_ += 1
+
+  def Done(self):
+    self.num_readers_ -= 1
+    if self.num_readers_ == 0:
+      self.Close()
+
+  def Map(self, name):
+    """Returns the dataset called name as a memory-mapped array, or None if it
+    can not be mapped."""
+    dset = self.f_[name]
+    offset = dset.id.get_offset()
+    if offset is None or dset.chunks is not None or \
+       dset.dtype not in (np.float32, np.float16):
+      return None
+    return np.memmap(self.file_name_, dtype=dset.dtype, mode='c',
+                     offset=offset, shape=dset.shape)
+
+  def GetDtype(self, name):
+    return self.f_[name].dtype
+
+  def Read(self, name, shape):
+    """Returns the dataset called name as a FORTRAN-order array of the given
+    shape, in the type it is stored in. The array is memory-mapped if
+    possible."""
+    dset = self.f_[name]
+    assert dset.size == shape[0] * shape[1], '%s has shape %s, expected %s' % (
+      name, dset.shape, shape[::-1])
+    array = self.Map(name)
+    if array is None:
+      array = dset[()]
+    return np.asarray(array).reshape(shape[::-1]).T
+
+  def ReadInto(self, name, mat):
+    """Sets the contents of the CUDAMatrix mat to the dataset called name,
+    transposed."""
+    dset = self.f_[name]
+    shape = mat.shape
+    assert dset.size == shape[0] * shape[1], '%s has shape %s, expected %s' % (
+      name, dset.shape, shape[::-1])
+    array = self.Map(name)
+    if array is not None:
+      array = np.asarray(array).reshape(shape[::-1]).T
+      if USE_CPU and array.dtype == np.float32:
+        mat.numpy_array = array
+      else:
+        mat.overwrite(array)
+    elif USE_CPU:
+      dset.read_direct(mat.numpy_array.T.reshape(dset.shape))
+    else:
+      mat.overwrite(dset[()].reshape(shape[::-1]).T)
+
+  def GetTransformedFilters(self, name, algorithm):
+    """Checkpoints hold no Winograd or FFT filters (see model_cache.py)."""
+    return None
+
+  def Close(self):
+    self.f_.close()
@@ -0,0 +1,26 @@
+import sys
+import convnet as cn
+
+def Usage():
+  print 'python plan_memory.py <model_file(.pbtxt)> [batch_size] [pinned_layer ...]'
+
+def main():
+  if len(sys.argv) < 2:
+    Usage()
+    sys.exit(1)
+  pbtxt_file = sys.argv[1]
+  batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 128
+  pinned_layers = sys.argv[3:] if len(sys.argv) > 3 else None
+  model = cn.ConvNet(pbtxt_file)
+  model.PlanMemory(pinned_layers)
+  arena_of, arena_sizes = model.memory_plan_
+  for l in model.GetLayerNames():
+    print '%s -> arena %d' % (l, arena_of[l])
+  planned, unplanned = model.GetMemoryUsage(batch_size)
+  print 'Pinned layers: %s' % ', '.join(sorted(model.pinned_layers_))
+  print 'Layer states at batch size %d: %.1f MB in %d arenas, %.1f MB without the plan (%.1fx less).' % (
+    batch_size, planned / 2.**20, len(arena_sizes), unplanned / 2.**20,
+    float(unplanned) / planned)
+
+if __name__ == '__main__':
+  main()
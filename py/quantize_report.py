@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+import numpy as np
+import convnet as cn
+from image_reader import LoadImage
+
+def Usage():
+  print 'python quantize_report.py <model_file(.pbtxt)> <model_parameters(.h5)> <dataset(.pbtxt)> [num_calibration_images]'
+
+def ReadImages(dataset_pbtxt):
+  """Returns the images listed in the first data_config of a DatasetConfig,
+  resized and center-cropped, and the file name of their pixel mean."""
+  dataset = cn.convnet_config_pb2.DatasetConfig()
+  cn.text_format.Merge(open(dataset_pbtxt).read(), dataset)
+  config = dataset.data_config[0]
+  base_dir = os.path.dirname(os.path.abspath(dataset_pbtxt))
+  file_names = [os.path.join(base_dir, line.strip())
+                for line in open(os.path.join(base_dir, config.file_pattern))
+                if line.strip()]
+  data = np.concatenate([LoadImage(f, config.raw_image_size_y, config.image_size_y)
+                         for f in file_names]).astype(np.float32)
+  return data, os.path.join(base_dir, config.mean_file), config.image_size_y
+
+def TimeFprop(model, data, reps=3):
+  model.Fprop(data)
+  best = None
+  for i in range(reps):
+    start = time.time()
+    model.Fprop(data)
+    t = time.time() - start
+    best = t if best is None else min(best, t)
+  return best
+
+def GetWeightBytes(model):
+  total = 0
+  for e in model.edge_:
+    if e.quantized_:
+      total += e.weights_q_.nbytes
+    elif getattr(e, 'weights_half_', None) is not None:
+      total += e.weights_half_.nbytes
+    elif getattr(e, 'weights_', None) is not None:
+      total += 4 * e.weights_.shape[0] * e.weights_.shape[1]
+  return total
+
+def main():
+  board = cn.LockGPU()
+  if len(sys.argv) < 4:
+    Usage()
+    sys.exit(1)
+  pbtxt_file = sys.argv[1]
+  params_file = sys.argv[2]
+  data, means_file, image_size = ReadImages(sys.argv[3])
+  num_calibration = int(sys.argv[4]) if len(sys.argv) > 4 else 10
+
+  model = cn.ConvNet(pbtxt_file)
+  model.Load(params_file)
+  model.SetNormalizer(means_file, image_size)
+  float_time = TimeFprop(model, data)
+  float_output = model.GetState('output').copy()
+  float_bytes = GetWeightBytes(model)
+
+  sample = np.random.RandomState(0).permutation(data.shape[0])[:num_calibration]
+  model.Quantize(data[sample])
+  int8_time = TimeFprop(model, data)
+  int8_output = model.GetState('output')
+  int8_bytes = GetWeightBytes(model)
+
+  top1 = float_output.argmax(axis=1)
+  float_top5 = np.argsort(-float_output, axis=1, kind='mergesort')[:, :5]
+  top5 = np.argsort(-int8_output, axis=1, kind='mergesort')[:, :5]
+  overlap = [len(set(a) & set(b)) for a, b in zip(float_top5, top5)]
+  print 'Quantized edges: %s' % ', '.join(e.GetName() for e in model.edge_ if e.quantized_)
+  print 'Images: %d, calibrated on %d' % (data.shape[0], len(sample))
+  print 'Top-1 agreement: %.1f%% (same top class)' % (
+    100. * (int8_output.argmax(axis=1) == top1).mean())
+  print 'Top-5 overlap: %.1f%% (classes shared by the float and int8 top 5)' % (
+    100. * np.mean(overlap) / 5)
+  print 'Float top-1 in int8 top-5: %.1f%%' % (
+    100. * (top5 == top1[:, np.newaxis]).any(axis=1).mean())
+  print 'Fprop: %.3fs float32, %.3fs int8 (%.2fx)' % (
+    float_time, int8_time, float_time / int8_time)
+  print 'Weights: %.1f MB float32, %.1f MB int8' % (
+    float_bytes / 2.**20, int8_bytes / 2.**20)
+  cn.FreeGPU(board)
+
+if __name__ == '__main__':
+  main()
@@ -1,25 +1,7 @@
 import sys
 import convnet as cn
 import numpy as np
-import Image
-
-def LoadImage(file_name, resize=256, crop=224):
-  image = Image.open(file_name)
-  width, height = image.size
-
-  if width > height:
-    width = (width * resize) / height
-    height = resize
-  else:
-    height = (height * resize) / width
-    width = resize
-  left = (width  - crop) / 2
-  top  = (height - crop) / 2
-  image_resized = image.resize((width, height), Image.BICUBIC).crop((left, top, left + crop, top + crop))
-  # image_resized.show()
-  # raw_input('Press Enter.')
-  data = np.array(image_resized.convert('RGB').getdata()).T.reshape(1, -1)
-  return data
+from image_reader import LoadImage
 
 def Usage():
   print 'python run_convnet.py <model_file(.pbtxt)> <model_parameters(.h5)> <means_file(.h5)>'
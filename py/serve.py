@@ -0,0 +1,28 @@
+import os
+import sys
+from inference_server import InferenceServer
+
+def Usage():
+  print 'python serve.py <host:port|socket_path> <num_workers> [max_batch_size] [max_wait_ms] <name>=<model_file(.pbtxt)>,<model_parameters(.h5)>[,<means_file(.h5)>] ...'
+
+def main():
+  if len(sys.argv) < 4:
+    Usage()
+    sys.exit(1)
+  options = [a for a in sys.argv[3:] if '=' not in a]
+  models = [a for a in sys.argv[3:] if '=' in a]
+  max_batch_size = int(options[0]) if len(options) > 0 else 1
+  max_wait = float(options[1]) / 1000 if len(options) > 1 else 0.005
+  server = InferenceServer(sys.argv[1], int(sys.argv[2]),
+                           max_batch_size=max_batch_size, max_wait=max_wait,
+                           cache_dir=os.environ.get('CONVNET_MODEL_CACHE'))
+  for arg in models:
+    name, files = arg.split('=', 1)
+    server.AddModel(name, *files.split(','))
+  print 'Serving %s on %s with %d workers.' % (
+    ', '.join(sorted(server.models_)), sys.argv[1], server.num_workers_)
+  sys.stdout.flush()
+  server.Run()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,44 @@
+"""A small conv net and random parameters for it, written to a directory."""
+import os
+import h5py
+import numpy as np
+
+NET = """name: "small"
+patch_size: 15
+layer { name: "input" num_channels: 3 is_input: true }
+layer { name: "c1" num_channels: 8 activation: RECTIFIED_LINEAR }
+layer { name: "p1" num_channels: 8 }
+layer { name: "n1" num_channels: 8 }
+layer { name: "c2" num_channels: 8 activation: RECTIFIED_LINEAR }
+layer { name: "h3" num_channels: 16 activation: RECTIFIED_LINEAR }
+layer { name: "output" num_channels: 5 activation: SOFTMAX }
+edge { source: "input" dest: "c1" edge_type: CONVOLUTIONAL kernel_size: 5 stride: 2 padding: 1 shared_bias: true }
+edge { source: "c1" dest: "p1" edge_type: MAXPOOL kernel_size: 3 stride: 2 padding: 1 }
+edge { source: "p1" dest: "n1" edge_type: RESPONSE_NORM add_scale: 0.0005 pow_scale: 0.75 frac_of_filters_response_norm: 0.5 }
+edge { source: "n1" dest: "c2" edge_type: CONVOLUTIONAL kernel_size: 3 stride: 1 padding: 1 shared_bias: true }
+edge { source: "c2" dest: "h3" edge_type: FC }
+edge { source: "h3" dest: "output" edge_type: FC }
+"""
+
+def WriteSmallNet(directory, seed=0):
+  """Writes small.pbtxt and small.h5 to directory and returns their paths."""
+  import convnet as cn
+  pbtxt_file = os.path.join(directory, 'small.pbtxt')
+  params_file = os.path.join(directory, 'small.h5')
+  with open(pbtxt_file, 'w') as f:
+    f.write(NET)
+  random = np.random.RandomState(seed)
+  model = cn.ConvNet(pbtxt_file)
+  with h5py.File(params_file, 'w') as f:
+    for e in model.edge_:
+      e.AllocateMemory()
+      if getattr(e, 'weights_', None) is not None:
+        shape = e.weights_.shape[::-1]
+        f.create_dataset(e.GetName() + ':weight',
+                         data=(random.randn(*shape) / np.sqrt(shape[0])).astype(np.float32))
+        f.create_dataset(e.GetName() + ':bias',
+                         data=(0.1 * random.randn(e.bias_.shape[1])).astype(np.float32))
+  return pbtxt_file, params_file
+
+def GetInput(seed=1, num_images=4):
+  return np.random.RandomState(seed).randn(num_images, 3 * 15 * 15).astype(np.float32)
@@ -0,0 +1,152 @@
+"""Tests of Augmenter and JitterGrids against loops over single images."""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import h5py
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('CONVNET_BACKEND', 'cpu')
+import convnet_config_pb2
+from augmenter import Augmenter, JitterGrids, NeedsAugmenter
+
+def GetConfig(**kwargs):
+  config = convnet_config_pb2.DataStreamConfig()
+  config.layer_name = 'input'
+  config.file_pattern = ''
+  config.image_size_y = 8
+  config.image_size_x = 10
+  config.gpu_image_size_y = 5
+  config.gpu_image_size_x = 6
+  for key, value in kwargs.items():
+    setattr(config, key, value)
+  return config
+
+def NaivePatches(images, offset_y, offset_x, flip, patch_y, patch_x):
+  """images (n, c, y, x). Column j of a flipped patch is column
+  x - 1 - (offset_x + j) of the image."""
+  n, c, size_y, size_x = images.shape
+  out = np.zeros((n, c, patch_y, patch_x))
+  for i in range(n):
+    for y in range(patch_y):
+      for x in range(patch_x):
+        source_x = offset_x[i] + x
+        if flip[i]:
+          source_x = size_x - 1 - source_x
+        out[i, :, y, x] = images[i, :, offset_y[i] + y, source_x]
+  return out
+
+class AugmenterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.random = np.random.RandomState(0)
+    self.images = self.random.rand(16, 3, 8, 10).astype(np.float32)
+
+  def Run(self, augmenter, multiplicity_id=0):
+    augmenter.SampleNoise(16, multiplicity_id)
+    out = augmenter.AddNoise(self.images.reshape(16, -1))
+    self.assertEqual(out.shape, (16, augmenter.GetDims()))
+    return out.reshape(16, 3, 5, 6)
+
+  def testTranslateAndFlip(self):
+    config = GetConfig(can_translate=True, can_flip=True)
+    self.assertTrue(NeedsAugmenter(config))
+    a = Augmenter(config, seed=1)
+    for i in range(5):
+      out = self.Run(a)
+      self.assertTrue(a.flip_bit_.any() and not a.flip_bit_.all())
+      self.assertTrue((a.offset_y_ <= 3).all() and (a.offset_x_ <= 4).all())
+      np.testing.assert_array_equal(
+        out, NaivePatches(self.images, a.offset_y_, a.offset_x_, a.flip_bit_, 5, 6))
+
+  def testTenViews(self):
+    a = Augmenter(GetConfig())
+    views = [(1, 2), (0, 0), (0, 4), (3, 4), (3, 0)]
+    for multiplicity_id in range(10):
+      out = self.Run(a, multiplicity_id)
+      y, x = views[multiplicity_id % 5]
+      flip = np.repeat(multiplicity_id >= 5, 16)
+      np.testing.assert_array_equal(
+        out, NaivePatches(self.images, np.repeat(y, 16), np.repeat(x, 16), flip, 5, 6))
+
+  def testNoiseAndNormalization(self):
+    base_dir = tempfile.mkdtemp()
+    try:
+      mean = self.random.rand(3).astype(np.float32)
+      std = 1 + self.random.rand(3).astype(np.float32)
+      with h5py.File(os.path.join(base_dir, 'mean.h5'), 'w') as f:
+        f.create_dataset('pixel_mean', data=mean)
+        f.create_dataset('pixel_std', data=std)
+        f.create_dataset('S', data=np.array([0.5, 0.2, 0.1], dtype=np.float32))
+        f.create_dataset('U', data=np.linalg.qr(self.random.randn(3, 3))[0])
+      a = Augmenter(GetConfig(can_translate=True, can_flip=True, pixelwise_normalize=True,
+                              pca_noise_stddev=0.1, mean_file='mean.h5'), base_dir, 2)
+    finally:
+      shutil.rmtree(base_dir)
+    out = self.Run(a)
+    expected = NaivePatches(self.images, a.offset_y_, a.offset_x_, a.flip_bit_, 5, 6)
+    for i in range(16):
+      for c in range(3):
+        expected[i, c] = (expected[i, c] - mean[c]) / std[c] + a.noise_[i, c]
+    self.assertTrue(np.abs(a.noise_).max() > 0)
+    np.testing.assert_allclose(out, expected, rtol=1e-5, atol=1e-5)
+
+class JitterGridsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.images = np.random.RandomState(0).rand(4, 3, 8, 8).astype(np.float32)
+
+  def testIdentity(self):
+    grids = JitterGrids(8, 8, 0, 1)
+    g = grids.GetGrids([0] * 4, [1] * 4)
+    out = grids.Apply(self.images, g, np.random.rand(4), np.random.rand(4))
+    np.testing.assert_array_equal(out, self.images)
+
+  def testZoom(self):
+    # A scale of 2 takes a 4 x 4 crop at the translation and doubles it.
+    grids = JitterGrids(8, 8, 0, 2, num_scales=2)
+    g = grids.GetGrids([0] * 4, [2] * 4)
+    trans_y = np.array([0, 0.5, 1, 0.3])
+    trans_x = np.array([1, 0.5, 0, 0.9])
+    out = grids.Apply(self.images, g, trans_y, trans_x)
+    for i in range(4):
+      top, left = int(4 * trans_y[i]), int(4 * trans_x[i])
+      crop = self.images[i, :, top:top + 4, left:left + 4]
+      expected = np.zeros((3, 8, 8), dtype=np.float32)
+      for y in range(8):
+        for x in range(8):
+          source_y = min(3, max(0, int(np.rint((y - 3.5) / 2 + 1.5))))
+          source_x = min(3, max(0, int(np.rint((x - 3.5) / 2 + 1.5))))
+          expected[:, y, x] = crop[:, source_y, source_x]
+      np.testing.assert_array_equal(out[i], expected)
+
+  def testRotate(self):
+    # Angles of -90, 0 and 90 degrees. Positive angles turn the image
+    # counter-clockwise.
+    grids = JitterGrids(8, 8, 90, 1, num_angles=3)
+    g = grids.GetGrids([90, -90, 0, 80], [1] * 4)
+    out = grids.Apply(self.images, g, np.zeros(4), np.zeros(4))
+    for i, k in enumerate([1, -1, 0, 1]):
+      for c in range(3):
+        np.testing.assert_array_equal(out[i, c], np.rot90(self.images[i, c], k))
+
+  def testGridsAreCached(self):
+    grids = JitterGrids(8, 8, 15, 1.3)
+    g = grids.GetGrids([-15, 15, 14.9, 0.1], [1, 1.3, 1.29, 1])
+    self.assertEqual(g[1], g[2])
+    self.assertEqual(grids.GetNumGrids(), 3)
+    grids.GetGrids([-15, 15], [1, 1.3])
+    self.assertEqual(grids.GetNumGrids(), 3)
+
+  def testAugmenter(self):
+    a = Augmenter(GetConfig(image_size_y=8, image_size_x=8, gpu_image_size_y=8,
+                            gpu_image_size_x=8, random_rotate_raw_image=True,
+                            random_rotate_max_angle=15, min_scale=1.3))
+    a.SampleNoise(4)
+    out = a.AddNoise(self.images.reshape(4, -1))
+    expected = a.jitter_.Apply(self.images, a.grids_, a.trans_y_, a.trans_x_)
+    np.testing.assert_array_equal(out, expected.reshape(4, -1))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,148 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('CONVNET_BACKEND', 'cpu')
+import autotuner
+import autotune
+import convnet as cn
+from small_net import WriteSmallNet
+
+class StubEdge(object):
+  """Counts the runs of each algorithm; 'slow' takes longer than 'fast'."""
+
+  def __init__(self, shape=(3, 8, 3, 1, 1, 15)):
+    self.shape_ = shape
+    self.algorithm_ = None
+    self.runs_ = {}
+
+  def GetShape(self):
+    return self.shape_
+
+  def GetAlgorithms(self):
+    return ['slow', 'fast']
+
+  def SetAlgorithm(self, algorithm):
+    self.algorithm_ = algorithm
+
+  def ComputeUp(self, input_layer, output_layer, overwrite):
+    self.runs_[self.algorithm_] = self.runs_.get(self.algorithm_, 0) + 1
+    if self.algorithm_ == 'slow':
+      sum(range(100000))
+
+class StubLayer(object):
+
+  def __init__(self, batch_size):
+    self.state_ = np.zeros((batch_size, 1), dtype=np.float32)
+
+  def GetState(self):
+    return self.state_
+
+class AutotunerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir_ = tempfile.mkdtemp()
+    self.cache_file_ = os.path.join(self.dir_, 'autotune.json')
+    self.get_cpu_model_ = autotuner.GetCPUModel
+
+  def tearDown(self):
+    autotuner.GetCPUModel = self.get_cpu_model_
+    shutil.rmtree(self.dir_)
+
+  def Tune(self, edge, batch_size=4):
+    tuner = autotuner.Autotuner(self.cache_file_, reps=1)
+    return tuner.Tune(edge, StubLayer(batch_size), None)
+
+  def testShapeKey(self):
+    tuner = autotuner.Autotuner(self.cache_file_)
+    self.assertEqual(tuner.GetKey(StubEdge(), 4), '3,8,3,1,1,15,4')
+    self.assertNotEqual(tuner.GetKey(StubEdge(), 8), tuner.GetKey(StubEdge(), 4))
+
+  def testRoundTrip(self):
+    edge = StubEdge()
+    self.assertEqual(self.Tune(edge), 'fast')
+    self.assertEqual(edge.algorithm_, 'fast')
+    self.assertEqual(edge.runs_, {'slow': 2, 'fast': 2})
+    cache = json.load(open(self.cache_file_))
+    self.assertEqual(cache, {autotuner.GetCPUModel(): {'3,8,3,1,1,15,4': 'fast'}})
+    # A new process reads the decision instead of timing again.
+    edge = StubEdge()
+    self.assertEqual(self.Tune(edge), 'fast')
+    self.assertEqual(edge.runs_, {})
+    # Another batch size or shape is a new key.
+    edge = StubEdge()
+    self.Tune(edge, batch_size=8)
+    self.assertEqual(edge.runs_, {'slow': 2, 'fast': 2})
+    edge = StubEdge(shape=(3, 8, 5, 1, 2, 15))
+    self.Tune(edge)
+    self.assertEqual(edge.runs_, {'slow': 2, 'fast': 2})
+    self.assertEqual(len(json.load(open(self.cache_file_))[autotuner.GetCPUModel()]), 3)
+
+  def testCPUModel(self):
+    self.Tune(StubEdge())
+    autotuner.GetCPUModel = lambda: 'Other CPU'
+    edge = StubEdge()
+    self.Tune(edge)
+    self.assertEqual(edge.runs_, {'slow': 2, 'fast': 2})
+    cache = json.load(open(self.cache_file_))
+    self.assertEqual(sorted(cache), sorted([self.get_cpu_model_(), 'Other CPU']))
+
+  def testStaleDecision(self):
+    # An algorithm the edge does not support (any more) is timed again.
+    json.dump({autotuner.GetCPUModel(): {'3,8,3,1,1,15,4': 'fft'}},
+              open(self.cache_file_, 'w'))
+    edge = StubEdge()
+    self.assertEqual(self.Tune(edge), 'fast')
+    self.assertEqual(edge.runs_, {'slow': 2, 'fast': 2})
+
+  def testCorruptCache(self):
+    open(self.cache_file_, 'w').write('{"truncated')
+    self.assertEqual(self.Tune(StubEdge()), 'fast')
+    self.assertEqual(len(json.load(open(self.cache_file_))), 1)
+
+class AutotuneTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir_ = tempfile.mkdtemp()
+    self.argv_ = sys.argv
+    self.stdout_ = sys.stdout
+
+  def tearDown(self):
+    sys.argv = self.argv_
+    sys.stdout = self.stdout_
+    os.environ.pop('CONVNET_AUTOTUNE_CACHE', None)
+    shutil.rmtree(self.dir_)
+
+  def Run(self, cache_name, *args):
+    cache_file = os.path.join(self.dir_, cache_name)
+    os.environ['CONVNET_AUTOTUNE_CACHE'] = cache_file
+    sys.argv = ['autotune.py'] + list(args)
+    sys.stdout = StringIO()
+    autotune.main()
+    sys.stdout = self.stdout_
+    return json.load(open(cache_file)).values()[0]
+
+  def testWithoutParameters(self):
+    pbtxt_file, params_file = WriteSmallNet(self.dir_)
+    decisions = self.Run('random.json', pbtxt_file, '1', '2')
+    # Both conv edges, at both batch sizes.
+    self.assertEqual(len(decisions), 4)
+    decisions_trained = self.Run('trained.json', pbtxt_file, params_file, '1', '2')
+    self.assertEqual(sorted(decisions), sorted(decisions_trained))
+
+  def testRandomWeights(self):
+    pbtxt_file, _ = WriteSmallNet(self.dir_)
+    model = cn.ConvNet(pbtxt_file)
+    autotune.FillRandomWeights(model)
+    model.Fprop(np.random.RandomState(0).randn(2, 675).astype(np.float32))
+    output = model.GetState('output')
+    self.assertTrue(np.isfinite(output).all())
+    np.testing.assert_allclose(output.sum(axis=1), 1, rtol=1e-5)
+
+if __name__ == '__main__':
+  unittest.main()
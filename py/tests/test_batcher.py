@@ -0,0 +1,188 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+from StringIO import StringIO
+import numpy as np
+from PIL import Image
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('CONVNET_BACKEND', 'cpu')
+from batcher import Batcher, DeadlineExceeded
+from image_reader import LoadImage
+from inference_server import InferenceServer, MakeServer
+from small_net import WriteSmallNet
+
+class StubModel(object):
+  """Layer 'double' is twice the input and 'plus' the input plus one, so
+  each row of a result shows which input row it came from. Fprop blocks
+  while release_ is clear."""
+
+  def __init__(self):
+    self.layer_name_dict_ = {'double': None, 'plus': None}
+    self.batches_ = []
+    self.targets_ = []
+    self.release_ = threading.Event()
+    self.release_.set()
+    self.error_ = None
+
+  def Fprop(self, data, targets=None):
+    self.release_.wait()
+    self.batches_.append(data[:, 0].tolist())
+    self.targets_.append(targets)
+    if self.error_ is not None:
+      raise self.error_
+    self.states_ = {'double': 2 * data, 'plus': data + 1}
+
+  def GetState(self, name):
+    return self.states_[name]
+
+def Rows(start, n):
+  return np.arange(start, start + n, dtype=np.float32).reshape(n, 1) * np.ones((1, 3))
+
+class BatcherTest(unittest.TestCase):
+
+  def setUp(self):
+    self.model_ = StubModel()
+
+  def testMerge(self):
+    batcher = Batcher(self.model_, max_batch_size=16, max_wait=0.2)
+    requests = [batcher.Submit(Rows(10 * i, i + 1), ['double']) for i in range(3)]
+    for i, request in enumerate(requests):
+      result = request.Wait()
+      self.assertEqual(result.keys(), ['double'])
+      np.testing.assert_array_equal(result['double'], 2 * Rows(10 * i, i + 1))
+    self.assertEqual(self.model_.batches_, [[0, 10, 11, 20, 21, 22]])
+    stats = batcher.GetStats()
+    self.assertEqual(stats['batch_sizes'], {6: 1})
+    self.assertEqual(stats['queue_depth'], 0)
+    self.assertEqual(sorted(stats['wait_ms']), [50, 90, 99])
+
+  def testConcurrentCallers(self):
+    batcher = Batcher(self.model_, max_batch_size=8, max_wait=0.01)
+    errors = []
+    def Call(i):
+      for j in range(5):
+        data = Rows(100 * i + 10 * j, 1 + (i + j) % 3)
+        result = batcher.Compute(data, ['plus', 'double'] if i % 2 else ['plus'])
+        if not np.array_equal(result['plus'], data + 1) or \
+           (i % 2 and not np.array_equal(result['double'], 2 * data)):
+          errors.append((i, j))
+    threads = [threading.Thread(target=Call, args=(i,)) for i in range(6)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(errors, [])
+    self.assertEqual(sum(len(b) for b in self.model_.batches_),
+                     sum(1 + (i + j) % 3 for i in range(6) for j in range(5)))
+    self.assertTrue(max(len(b) for b in self.model_.batches_) <= 8)
+
+  def testLayers(self):
+    batcher = Batcher(self.model_, max_batch_size=16, max_wait=0.2)
+    a = batcher.Submit(Rows(0, 1), ['double'])
+    b = batcher.Submit(Rows(1, 1), ['plus'])
+    self.assertEqual(a.Wait().keys(), ['double'])
+    self.assertEqual(b.Wait().keys(), ['plus'])
+    self.assertEqual(self.model_.targets_, [['double', 'plus']])
+    self.assertRaises(Exception, batcher.Submit, Rows(0, 1), ['none'])
+
+  def testMaxBatchSize(self):
+    batcher = Batcher(self.model_, max_batch_size=4, max_wait=0.05)
+    requests = [batcher.Submit(Rows(i, 2), ['plus']) for i in (0, 10, 20)]
+    requests.append(batcher.Submit(Rows(30, 6), ['plus']))
+    for r in requests:
+      r.Wait()
+    # A full batch, the leftover request and the one too large for any batch.
+    self.assertEqual(self.model_.batches_, [[0, 1, 10, 11], [20, 21], range(30, 36)])
+
+  def testMaxWait(self):
+    batcher = Batcher(self.model_, max_batch_size=16, max_wait=0.1)
+    start = time.time()
+    batcher.Compute(Rows(0, 1), ['plus'])
+    self.assertTrue(0.09 <= time.time() - start < 1)
+
+  def testDeadlineFlush(self):
+    # The batch starts early enough for the request to meet its deadline,
+    # long before max_wait.
+    batcher = Batcher(self.model_, max_batch_size=16, max_wait=10)
+    start = time.time()
+    batcher.Compute(Rows(0, 1), ['plus'], timeout=0.1)
+    self.assertTrue(time.time() - start < 1)
+    self.assertEqual(self.model_.batches_, [[0]])
+
+  def testDeadlineExceeded(self):
+    batcher = Batcher(self.model_, max_batch_size=1, max_wait=0)
+    self.model_.release_.clear()
+    a = batcher.Submit(Rows(0, 1), ['plus'])
+    b = batcher.Submit(Rows(1, 1), ['plus'], timeout=0.05)
+    self.assertRaises(DeadlineExceeded, b.Wait)
+    self.model_.release_.set()
+    a.Wait()
+    batcher.Compute(Rows(2, 1), ['plus'])
+    # b expired before it was started, so the model never ran it.
+    self.assertEqual(self.model_.batches_, [[0], [2]])
+
+  def testError(self):
+    batcher = Batcher(self.model_, max_batch_size=16, max_wait=0.05)
+    self.model_.error_ = ValueError('boom')
+    requests = [batcher.Submit(Rows(i, 1), ['plus']) for i in range(2)]
+    for r in requests:
+      self.assertRaises(ValueError, r.Wait)
+
+class ServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir_ = tempfile.mkdtemp()
+    pbtxt_file, params_file = WriteSmallNet(self.dir_)
+    self.server_ = InferenceServer('localhost:0', resize=16)
+    self.server_.AddModel('small', pbtxt_file, params_file)
+    self.http_server_ = MakeServer('localhost:0', self.server_, threading=True)
+    thread = threading.Thread(target=self.http_server_.serve_forever)
+    thread.daemon = True
+    thread.start()
+    pixels = np.random.RandomState(0).randint(0, 256, size=(20, 24, 3)).astype(np.uint8)
+    f = StringIO()
+    Image.fromarray(pixels).save(f, 'PNG')
+    self.image_ = f.getvalue()
+
+  def tearDown(self):
+    self.http_server_.shutdown()
+    self.http_server_.server_close()
+    shutil.rmtree(self.dir_)
+
+  def Post(self, query):
+    url = 'http://localhost:%d/small?%s' % (self.http_server_.server_address[1], query)
+    try:
+      reply = urllib2.urlopen(url, self.image_)
+      return reply.getcode(), json.loads(reply.read())
+    except urllib2.HTTPError as e:
+      return e.code, json.loads(e.read())
+
+  def Expected(self):
+    model = self.server_.models_['small']
+    model.Fprop(LoadImage(StringIO(self.image_), 16, 15).astype(np.float32))
+    return model.GetState('output')[0]
+
+  def testTimeoutNeedsBatching(self):
+    code, result = self.Post('timeout_ms=500')
+    self.assertEqual(code, 400)
+    self.assertTrue('max_batch_size' in result['error'])
+    code, result = self.Post('layers=output')
+    self.assertEqual(code, 200)
+    np.testing.assert_allclose(result['output'], self.Expected(), rtol=1e-5)
+
+  def testBatched(self):
+    self.server_.max_batch_size_ = 4
+    self.server_.batchers_['small'] = Batcher(self.server_.models_['small'], 4, 0.001)
+    self.assertEqual(self.Post('timeout_ms=abc')[0], 400)
+    code, result = self.Post('layers=output&timeout_ms=5000')
+    self.assertEqual(code, 200)
+    np.testing.assert_allclose(result['output'], self.Expected(), rtol=1e-5)
+
+if __name__ == '__main__':
+  unittest.main()
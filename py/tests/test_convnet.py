@@ -0,0 +1,173 @@
+"""Tests of ConvNet features that change how Fprop runs but not what it
+computes, on the net of small_net.py."""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('CONVNET_BACKEND', 'cpu')
+import convnet as cn
+from memory_plan import GetLifetimes
+from small_net import WriteSmallNet, GetInput
+
+LAYERS = ['input', 'c1', 'p1', 'n1', 'c2', 'h3', 'output']
+
+class ConvNetTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.dir_ = tempfile.mkdtemp()
+    self.pbtxt_, self.params_ = WriteSmallNet(self.dir_)
+    self.data_ = GetInput(num_images=4)
+    model = self.GetModel()
+    model.Fprop(self.data_)
+    self.expected_ = dict((name, model.GetState(name).copy()) for name in LAYERS)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir_)
+
+  def GetModel(self):
+    model = cn.ConvNet(self.pbtxt_)
+    model.Load(self.params_)
+    return model
+
+  def AssertStates(self, model, names, num_images=4, rtol=1e-5, atol=1e-6):
+    for name in names:
+      np.testing.assert_allclose(model.GetState(name), self.expected_[name][:num_images],
+                                 rtol=rtol, atol=atol, err_msg=name)
+
+class MemoryPlanTest(ConvNetTestCase):
+
+  def testPinnedLayers(self):
+    model = self.GetModel()
+    model.PlanMemory(['h3', 'output'])
+    layers, pinned, memory_plan, _, _ = model.GetPlan()
+    arena_of, arena_sizes = memory_plan
+    self.assertTrue(len(arena_sizes) < len(LAYERS))
+    # Layers that share an arena are never live at the same time.
+    lifetimes = GetLifetimes(layers, pinned)
+    for a in LAYERS:
+      for b in LAYERS:
+        if a < b and arena_of[a] == arena_of[b]:
+          self.assertTrue(lifetimes[a][1] < lifetimes[b][0] or
+                          lifetimes[b][1] < lifetimes[a][0], (a, b))
+    planned, unplanned = model.GetMemoryUsage(4)
+    self.assertTrue(planned < unplanned)
+    for num_images in (4, 2, 4):
+      model.Fprop(self.data_[:num_images])
+      self.AssertStates(model, ['h3', 'output'], num_images)
+      self.assertRaises(Exception, model.GetState, 'c1')
+      self.assertRaises(Exception, model.GetState, 'n1')
+
+  def testDefaultPinsOutputs(self):
+    model = self.GetModel()
+    model.PlanMemory()
+    model.Fprop(self.data_)
+    self.AssertStates(model, ['output'])
+    self.assertRaises(Exception, model.GetState, 'h3')
+
+class TargetsTest(ConvNetTestCase):
+
+  def EdgeNames(self, model, dest_names):
+    return set(e.GetName() for e in model.edge_ if e.GetDestName() in dest_names)
+
+  def testTargets(self):
+    model = self.GetModel()
+    model.Fprop(self.data_, targets=['c2'])
+    self.AssertStates(model, ['input', 'c1', 'p1', 'n1', 'c2'])
+    self.assertRaises(Exception, model.GetState, 'h3')
+    self.assertRaises(Exception, model.GetState, 'output')
+    self.assertEqual([l.GetName() for l in model.GetPlan(['c2'])[0]],
+                     ['input', 'c1', 'p1', 'n1', 'c2'])
+    self.assertRaises(Exception, model.Fprop, self.data_, ['none'])
+
+  def testPlanCache(self):
+    model = self.GetModel()
+    plan = model.GetPlan(['p1', 'c2'])
+    self.assertTrue(model.GetPlan(['c2', 'p1']) is plan)
+    self.assertTrue(model.GetPlan(['output']) is not plan)
+    # Switching between plans recomputes only what each one needs.
+    for targets in (['c2'], None, ['c2'], ['h3']):
+      model.Fprop(self.data_[:2], targets=targets)
+      self.AssertStates(model, targets or LAYERS, num_images=2)
+    self.assertEqual(len(model.plan_cache_), 5)
+
+  def testLoadTargets(self):
+    model = cn.ConvNet(self.pbtxt_)
+    model.Load(self.params_, targets=['p1'])
+    self.assertEqual(model.loaded_edges_, self.EdgeNames(model, ['c1', 'p1']))
+    model.Fprop(self.data_, targets=['c2'])
+    self.AssertStates(model, ['c2'])
+    self.assertEqual(set(model.GetLoadTimes()),
+                     self.EdgeNames(model, ['c1', 'p1', 'n1', 'c2']))
+    model.Fprop(self.data_)
+    self.AssertStates(model, LAYERS)
+
+  def testLazyTargets(self):
+    # Only edges with weights read anything from the file.
+    model = cn.ConvNet(self.pbtxt_)
+    model.Load(self.params_, lazy=True)
+    model.Fprop(self.data_, targets=['c2'])
+    self.AssertStates(model, ['c2'])
+    self.assertEqual(set(model.GetLoadTimes()), self.EdgeNames(model, ['c1', 'c2']))
+
+class QuantizeTest(ConvNetTestCase):
+
+  def AssertNear(self, model, names, num_images=4):
+    for name in names:
+      expected = self.expected_[name][:num_images]
+      np.testing.assert_allclose(model.GetState(name), expected, rtol=0,
+                                 atol=0.05 * np.abs(expected).max(), err_msg=name)
+
+  def testQuantize(self):
+    model = self.GetModel()
+    model.Quantize(self.data_)
+    quantized = [e.GetName() for e in model.edge_ if e.quantized_]
+    self.assertTrue(len(quantized) > 0)
+    model.Fprop(self.data_)
+    self.AssertNear(model, ['c1', 'c2', 'h3', 'output'])
+
+  def testEdgeNames(self):
+    model = self.GetModel()
+    name = model.edge_[0].GetName()
+    model.Quantize(self.data_, edge_names=[name])
+    self.assertEqual([e.GetName() for e in model.edge_ if e.quantized_], [name])
+    self.assertRaises(Exception, self.GetModel().Quantize, self.data_, ['none'])
+
+  def testBuckets(self):
+    # Calibration goes in slices of the largest bucket and finds the same ranges.
+    model = self.GetModel()
+    model.Quantize(self.data_)
+    model.Fprop(self.data_)
+    expected = model.GetState('output').copy()
+    model = self.GetModel()
+    model.SetBatchBuckets([1, 2])
+    model.Quantize(self.data_)
+    for start in (0, 2):
+      model.Fprop(self.data_[start:start + 2])
+      np.testing.assert_allclose(model.GetState('output'), expected[start:start + 2],
+                                 rtol=1e-5, atol=1e-6)
+
+  def testChannelsLastAfterQuantize(self):
+    model = self.GetModel()
+    model.Quantize(self.data_)
+    self.assertRaises(Exception, model.SetChannelsLast)
+    model.Fprop(self.data_)
+    self.AssertNear(model, ['output'])
+
+  def testQuantizeAfterChannelsLast(self):
+    # Only the edge between the channels-first layers h3 and output is quantized.
+    model = self.GetModel()
+    model.SetChannelsLast()
+    self.assertRaises(Exception, model.Quantize, self.data_, [model.edge_[0].GetName()])
+    model.Quantize(self.data_)
+    quantized = [e for e in model.edge_ if e.quantized_]
+    self.assertEqual([(e.GetSourceName(), e.GetDestName()) for e in quantized],
+                     [('h3', 'output')])
+    model.Fprop(self.data_)
+    self.AssertStates(model, ['c2', 'h3'])
+    self.AssertNear(model, ['output'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,433 @@
+"""Tests of cpuconv against naive loops over (n_images, n_chans, y, x) arrays."""
+import os
+import sys
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cpumat as cm
+import cpuconv as cc
+
+def NaiveConv(images, filters, padding, stride, num_modules, num_groups=1):
+  """images (n, c, h, w), filters (f, c / num_groups, k, k). Returns
+  (n, f, num_modules, num_modules)."""
+  n, c, h, w = images.shape
+  f, cg, k = filters.shape[:3]
+  fg = f / num_groups
+  out = np.zeros((n, f, num_modules, num_modules))
+  for i in range(f):
+    g = i / fg
+    for my in range(num_modules):
+      for mx in range(num_modules):
+        for fy in range(k):
+          for fx in range(k):
+            y = my * stride - padding + fy
+            x = mx * stride - padding + fx
+            if 0 <= y < h and 0 <= x < w:
+              out[:, i, my, mx] += np.dot(images[:, g * cg:(g + 1) * cg, y, x],
+                                          filters[i, :, fy, fx])
+  return out
+
+def NaiveMaxPool(images, kernel_size, padding, stride, num_modules):
+  n, c, h, w = images.shape
+  out = np.zeros((n, c, num_modules, num_modules))
+  for my in range(num_modules):
+    for mx in range(num_modules):
+      y0, x0 = my * stride - padding, mx * stride - padding
+      window = images[:, :, max(y0, 0):min(y0 + kernel_size, h),
+                      max(x0, 0):min(x0 + kernel_size, w)]
+      out[:, :, my, mx] = window.max(axis=3).max(axis=2)
+  return out
+
+def NaiveResponseNorm(images, size, add_scale, pow_scale, blocked):
+  c = images.shape[1]
+  out = np.zeros(images.shape)
+  for i in range(c):
+    start = (i / size) * size if blocked else i - size / 2
+    end = min(c, start + size)
+    start = max(0, start)
+    denom = 1 + add_scale * (images[:, start:end] ** 2).sum(axis=1)
+    out[:, i] = images[:, i] * denom ** -pow_scale
+  return out
+
+def NaiveRGBToYUV(images):
+  out = np.zeros(images.shape)
+  for i in range(3):
+    for j in range(3):
+      out[:, i] += cc.RGB_TO_YUV[i, j] * images[:, j]
+  return out
+
+def Mat(array):
+  return cm.CUDAMatrix(array.reshape(array.shape[0], -1))
+
+def Array(mat, num_colors, size):
+  return mat.asarray().reshape(mat.shape[0], num_colors, size, size)
+
+def MatLast(array):
+  """Returns (n, c, h, w) array as a channels-last matrix."""
+  n, c, h, w = array.shape
+  mat = cm.empty((n, c * h * w))
+  mat.numpy_array.T.reshape(h, w, n, c)[...] = array.transpose(2, 3, 0, 1)
+  return mat
+
+def ArrayLast(mat, num_colors, size):
+  return cc.ChannelsFirst(mat, num_colors).reshape(-1, num_colors, size, size)
+
+def AssertClose(test, actual, expected):
+  tol = 1e-5 * max(1, np.abs(expected).max())
+  test.assertEqual(actual.shape, expected.shape)
+  test.assertTrue(np.abs(actual - expected).max() <= tol,
+                  'max error %g' % np.abs(actual - expected).max())
+
+class ConvUpTest(unittest.TestCase):
+
+  def Check(self, num_images, num_colors, size, num_filters, k, padding, stride,
+            num_groups=1, scale_targets=0):
+    random = np.random.RandomState(size * k + padding)
+    images = random.randn(num_images, num_colors, size, size).astype(np.float32)
+    filters = random.randn(num_filters, num_colors / num_groups, k, k).astype(np.float32)
+    num_modules = (size + 2 * padding - k) / stride + 1
+    targets = cm.CUDAMatrix(random.randn(num_images, num_filters * num_modules**2))
+    previous = Array(targets, num_filters, num_modules).astype(np.float64)
+    cc.convUp(Mat(images), Mat(filters), targets, size, num_modules, num_modules,
+              padding, stride, num_colors, scale_targets, num_groups)
+    expected = NaiveConv(images, filters, padding, stride, num_modules, num_groups)
+    AssertClose(self, Array(targets, num_filters, num_modules),
+                expected + scale_targets * previous)
+
+  def testOddSize(self):
+    self.Check(3, 3, 7, 4, 3, 0, 1)
+
+  def testPadding(self):
+    self.Check(2, 5, 9, 6, 3, 1, 1)
+    self.Check(2, 1, 6, 2, 5, 2, 1)
+
+  def testStride(self):
+    self.Check(2, 3, 11, 8, 5, 2, 2)
+    self.Check(1, 3, 15, 4, 7, 0, 4)
+
+  def testGroups(self):
+    self.Check(2, 4, 7, 6, 3, 1, 1, num_groups=2)
+
+  def testScaleTargets(self):
+    self.Check(2, 2, 5, 3, 3, 1, 1, scale_targets=0.5)
+
+class BiasReLUTest(unittest.TestCase):
+
+  def CheckConv(self, num_colors, size, num_filters, k, padding, stride,
+                relu, shared=True, num_groups=1):
+    random = np.random.RandomState(size + k)
+    images = random.randn(2, num_colors, size, size).astype(np.float32)
+    filters = random.randn(num_filters, num_colors / num_groups, k, k).astype(np.float32)
+    num_modules = (size + 2 * padding - k) / stride + 1
+    if shared:
+      bias = random.randn(1, num_filters).astype(np.float32)
+      b = bias.reshape(1, num_filters, 1, 1)
+    else:
+      bias = random.randn(1, num_filters * num_modules**2).astype(np.float32)
+      b = bias.reshape(1, num_filters, num_modules, num_modules)
+    targets = cm.empty((2, num_filters * num_modules**2))
+    cc.convUpBias(Mat(images), Mat(filters), cm.CUDAMatrix(bias), targets, size,
+                  num_modules, num_modules, padding, stride, num_colors, relu,
+                  num_groups)
+    expected = NaiveConv(images, filters, padding, stride, num_modules, num_groups) + b
+    if relu:
+      expected = np.maximum(expected, 0)
+    AssertClose(self, Array(targets, num_filters, num_modules), expected)
+
+  def testConv(self):
+    self.CheckConv(3, 7, 5, 3, 1, 1, False)
+    self.CheckConv(3, 7, 5, 3, 1, 1, True)
+    self.CheckConv(2, 11, 4, 5, 2, 2, True)
+
+  def testUnsharedBias(self):
+    self.CheckConv(3, 6, 4, 3, 1, 1, True, shared=False)
+
+  def testGroups(self):
+    self.CheckConv(4, 5, 6, 3, 0, 1, True, num_groups=2)
+
+  def testDot(self):
+    # Enough images for AddBiasReLU to work on several blocks of rows.
+    random = np.random.RandomState(0)
+    images = random.randn(2048, 30).astype(np.float32)
+    filters = random.randn(100, 30).astype(np.float32)
+    bias = random.randn(1, 100).astype(np.float32)
+    expected = np.dot(images.astype(np.float64), filters.T) + bias
+    for relu in (False, True):
+      targets = cm.empty((2048, 100))
+      cc.dotBias(cm.CUDAMatrix(images), cm.CUDAMatrix(filters),
+                 cm.CUDAMatrix(bias), targets, relu)
+      AssertClose(self, targets.asarray(), np.maximum(expected, 0) if relu else expected)
+
+  def testLargeValues(self):
+    # x + |x| would overflow to inf above FLT_MAX / 2.
+    big = np.finfo(np.float32).max
+    values = np.array([[big, -big, 0.75 * big, -1, 2]], dtype=np.float32)
+    expected = np.maximum(values, 0)
+    out = values.T.copy()
+    cc.AddBiasReLU(out, np.zeros((5, 1), dtype=np.float32), 1, True)
+    np.testing.assert_array_equal(out.T, expected)
+    out = values.reshape(1, 1, 5).copy()
+    cc.AddBiasReLUChannelsLast(out, np.zeros((5, 1), dtype=np.float32), True)
+    np.testing.assert_array_equal(out.reshape(1, 5), expected)
+
+class QuantizedTest(unittest.TestCase):
+  """int8 kernels against the float32 ones. Quantization errors are at most
+  half a step of each factor, so the tolerance is a few percent of the range."""
+
+  def AssertNear(self, actual, expected):
+    np.testing.assert_allclose(actual, expected, rtol=0,
+                               atol=0.03 * np.abs(expected).max())
+
+  def testQuantizeRows(self):
+    w = np.random.RandomState(0).randn(6, 20).astype(np.float32)
+    w[2] = 0
+    w_q, scale = cc.QuantizeRows(w)
+    self.assertEqual(w_q.dtype, np.int8)
+    self.assertEqual(np.abs(w_q).max(axis=1)[2], 0)
+    self.assertTrue((np.abs(w_q[[0, 1, 3, 4, 5]]).max(axis=1) == 127).all())
+    np.testing.assert_allclose(scale[:, np.newaxis] * w_q, w, rtol=0,
+                               atol=0.5 * scale.max() + 1e-7)
+
+  def testGemm(self):
+    # On integer inputs the product is exact up to the float32 rounding.
+    random = np.random.RandomState(1)
+    w_q = random.randint(-127, 128, size=(7, 30)).astype(np.int8)
+    w_scale = random.rand(7).astype(np.float32)
+    x_q = random.randint(-127, 128, size=(30, 5)).astype(np.float32)
+    bias = random.randn(7, 1).astype(np.float32)
+    expected = np.dot(w_scale[:, np.newaxis] * w_q.astype(np.float64), 0.25 * x_q) + bias
+    for relu in (False, True):
+      out = np.empty((7, 5), dtype=np.float32)
+      cc.GemmQuantized(w_q, w_scale, x_q, 0.25, bias, out, 1, relu)
+      AssertClose(self, out, np.maximum(expected, 0) if relu else expected)
+
+  def testDot(self):
+    random = np.random.RandomState(2)
+    images = random.randn(16, 40).astype(np.float32)
+    filters = random.randn(10, 40).astype(np.float32)
+    bias = cm.CUDAMatrix(random.randn(1, 10).astype(np.float32))
+    filters_q, filters_scale = cc.QuantizeRows(filters)
+    images_scale = np.abs(images).max() / 127
+    for relu in (False, True):
+      expected = cm.empty((16, 10))
+      cc.dotBias(cm.CUDAMatrix(images), cm.CUDAMatrix(filters), bias, expected, relu)
+      targets = cm.empty((16, 10))
+      cc.dotQuantized(cm.CUDAMatrix(images), filters_q, filters_scale,
+                      images_scale, bias, targets, relu)
+      self.AssertNear(targets.asarray(), expected.asarray())
+
+  def testConv(self):
+    random = np.random.RandomState(3)
+    images = random.randn(2, 3, 7, 7).astype(np.float32)
+    filters = random.randn(5, 3, 3, 3).astype(np.float32)
+    bias = cm.CUDAMatrix(random.randn(1, 5).astype(np.float32))
+    filters_q, filters_scale = cc.QuantizeRows(filters.reshape(5, -1))
+    images_scale = np.abs(images).max() / 127
+    for relu in (False, True):
+      expected = cm.empty((2, 5 * 7 * 7))
+      cc.convUpBias(Mat(images), Mat(filters), bias, expected, 7, 7, 7, 1, 1, 3, relu)
+      targets = cm.empty((2, 5 * 7 * 7))
+      cc.convUpQuantized(Mat(images), filters_q, filters_scale, images_scale,
+                         bias, targets, 7, 7, 7, 1, 1, 3, relu)
+      self.AssertNear(targets.asarray(), expected.asarray())
+
+class FastConvTest(unittest.TestCase):
+  """Winograd and FFT convolutions against convUp and the naive loops."""
+
+  def Check(self, algorithm, num_colors, size, num_filters, k, padding,
+            stride=1, relu=False):
+    random = np.random.RandomState(num_colors * size + k)
+    images = random.randn(3, num_colors, size, size).astype(np.float32)
+    filters = random.randn(num_filters, num_colors, k, k).astype(np.float32)
+    bias = random.randn(1, num_filters).astype(np.float32)
+    num_modules = (size + 2 * padding - k) / stride + 1
+    direct = cm.empty((3, num_filters * num_modules**2))
+    cc.convUp(Mat(images), Mat(filters), direct, size, num_modules, num_modules,
+              padding, stride, num_colors)
+    targets = cm.empty(direct.shape)
+    if algorithm == 'winograd':
+      cc.convUpWinograd(Mat(images), cc.WinogradFilters(Mat(filters).asarray(), num_colors),
+                        cm.CUDAMatrix(bias), targets, size, num_modules, padding,
+                        num_colors, relu)
+    else:
+      fft_size = cc.GetFFTSize(size, num_modules, padding, stride, k)
+      cc.convUpFFT(Mat(images), cc.FFTFilters(Mat(filters).asarray(), num_colors, fft_size),
+                   cm.CUDAMatrix(bias), targets, size, num_modules, padding, stride,
+                   num_colors, fft_size, relu)
+    expected = Array(direct, num_filters, num_modules) + bias.reshape(1, -1, 1, 1)
+    if relu:
+      expected = np.maximum(expected, 0)
+    AssertClose(self, Array(targets, num_filters, num_modules), expected)
+    if size <= 9:
+      expected = NaiveConv(images, filters, padding, stride, num_modules) + \
+          bias.reshape(1, -1, 1, 1)
+      if relu:
+        expected = np.maximum(expected, 0)
+      AssertClose(self, Array(targets, num_filters, num_modules), expected)
+
+  def testWinograd(self):
+    # Odd sizes leave a partial 2x2 tile at the right and bottom.
+    for num_colors in (1, 3, 8):
+      self.Check('winograd', num_colors, 7, 4, 3, 0)
+      self.Check('winograd', num_colors, 9, 5, 3, 1)
+    self.Check('winograd', 16, 13, 32, 3, 1, relu=True)
+    self.Check('winograd', 3, 8, 6, 3, 1, relu=True)
+
+  def testFFT(self):
+    for num_colors in (1, 3, 8):
+      self.Check('fft', num_colors, 9, 4, 5, 0)
+      self.Check('fft', num_colors, 7, 5, 5, 2)
+    self.Check('fft', 16, 15, 32, 7, 3, relu=True)
+    self.Check('fft', 4, 12, 6, 9, 4)
+
+  def testStridedFFT(self):
+    self.Check('fft', 3, 9, 4, 3, 1, stride=2)
+    self.Check('fft', 3, 23, 8, 7, 2, stride=3, relu=True)
+
+  def testChooseConvAlgorithm(self):
+    self.assertEqual(cc.ChooseConvAlgorithm(3, 1, 1, 13, 13, 256, 384), 'winograd')
+    self.assertEqual(cc.ChooseConvAlgorithm(7, 2, 0, 227, 111, 3, 96), 'direct')
+    self.assertEqual(cc.ChooseConvAlgorithm(9, 1, 4, 32, 32, 32, 32), 'fft')
+
+class ChannelsLastTest(unittest.TestCase):
+  """The channels-last kernels, from images in either layout, against the
+  naive loops."""
+
+  def setUp(self):
+    self.random = np.random.RandomState(0)
+
+  def Images(self, num_colors, size, num_images=3):
+    images = self.random.randn(num_images, num_colors, size, size).astype(np.float32)
+    return images, [(Mat(images), False), (MatLast(images), True)]
+
+  def CheckConv(self, algorithm, num_colors, size, num_filters, k, padding,
+                stride=1, relu=True):
+    images, inputs = self.Images(num_colors, size)
+    filters = self.random.randn(num_filters, num_colors, k, k).astype(np.float32)
+    bias = self.random.randn(1, num_filters).astype(np.float32)
+    num_modules = (size + 2 * padding - k) / stride + 1
+    expected = NaiveConv(images, filters, padding, stride, num_modules) + \
+        bias.reshape(1, -1, 1, 1)
+    if relu:
+      expected = np.maximum(expected, 0)
+    for mat, channels_last in inputs:
+      targets = cm.empty((3, num_filters * num_modules**2))
+      if algorithm == 'winograd':
+        cc.convUpWinogradChannelsLast(
+          mat, cc.WinogradFilters(Mat(filters).asarray(), num_colors),
+          cm.CUDAMatrix(bias), targets, size, num_modules, padding, num_colors,
+          relu, channels_last)
+      elif k == 1:
+        cc.convOneToOneChannelsLast(mat, Mat(filters), cm.CUDAMatrix(bias),
+                                    targets, num_colors, relu, channels_last)
+      else:
+        cc.convUpChannelsLast(mat, Mat(filters.transpose(0, 2, 3, 1)),
+                              cm.CUDAMatrix(bias), targets, size, num_modules,
+                              padding, stride, num_colors, relu, channels_last)
+      AssertClose(self, ArrayLast(targets, num_filters, num_modules), expected)
+
+  def testConv(self):
+    for num_colors in (1, 3, 8):
+      self.CheckConv('direct', num_colors, 7, 4, 3, 1)
+    self.CheckConv('direct', 3, 11, 5, 5, 2, stride=2, relu=False)
+    self.CheckConv('direct', 3, 9, 4, 7, 0, stride=2)
+
+  def testWinograd(self):
+    for num_colors in (1, 3, 8):
+      self.CheckConv('winograd', num_colors, 7, 4, 3, 0)
+      self.CheckConv('winograd', num_colors, 8, 5, 3, 1, relu=False)
+
+  def testOneToOne(self):
+    self.CheckConv('direct', 6, 5, 4, 1, 0)
+
+  def testDot(self):
+    for num_images in (1, 4):
+      images, _ = self.Images(5, 3, num_images)
+      filters = self.random.randn(7, 5, 3, 3).astype(np.float32)
+      bias = self.random.randn(1, 7).astype(np.float32)
+      targets = cm.empty((num_images, 7))
+      # The columns of the filters are in channels-last order.
+      cc.dotChannelsLast(MatLast(images), Mat(filters.transpose(0, 2, 3, 1)),
+                         cm.CUDAMatrix(bias), targets, 5, True)
+      expected = np.dot(images.reshape(num_images, -1).astype(np.float64),
+                        filters.reshape(7, -1).T) + bias
+      AssertClose(self, targets.asarray(), np.maximum(expected, 0))
+
+  def testMaxPool(self):
+    images, inputs = self.Images(4, 13)
+    for mat, channels_last in inputs:
+      targets = cm.empty((3, 4 * 7**2))
+      cc.MaxPoolChannelsLast(mat, targets, 4, 3, 0, 2, 7, channels_last)
+      np.testing.assert_array_equal(ArrayLast(targets, 4, 7),
+                                    NaiveMaxPool(images, 3, 0, 2, 7))
+      targets = cm.empty((3, 4 * 7**2))
+      cc.MaxPoolChannelsLast(mat, targets, 4, 3, 1, 2, 7, channels_last)
+      np.testing.assert_array_equal(ArrayLast(targets, 4, 7),
+                                    NaiveMaxPool(images, 3, 1, 2, 7))
+
+  def testRGBToYUV(self):
+    images, inputs = self.Images(3, 5)
+    for mat, channels_last in inputs:
+      targets = cm.empty(mat.shape)
+      cc.RGBToYUVChannelsLast(mat, targets, channels_last)
+      AssertClose(self, ArrayLast(targets, 3, 5), NaiveRGBToYUV(images))
+
+  def testResponseNorm(self):
+    for num_colors, size, blocked in ((16, 5, False), (7, 4, False), (10, 4, True)):
+      images, inputs = self.Images(num_colors, 5)
+      expected = NaiveResponseNorm(images.astype(np.float64), size, 0.01, 0.75, blocked)
+      for mat, channels_last in inputs:
+        targets = cm.empty(mat.shape)
+        cc.ResponseNormCrossMapChannelsLast(mat, targets, num_colors, size, 0.01,
+                                            0.75, blocked, channels_last)
+        AssertClose(self, ArrayLast(targets, num_colors, 5), expected)
+
+class MaxPoolTest(unittest.TestCase):
+
+  def Check(self, num_images, num_colors, size, k, padding, stride, num_modules):
+    random = np.random.RandomState(size)
+    images = random.randn(num_images, num_colors, size, size).astype(np.float32)
+    targets = cm.empty((num_images, num_colors * num_modules**2))
+    cc.MaxPool(Mat(images), targets, num_colors, k, padding, stride, num_modules)
+    np.testing.assert_array_equal(Array(targets, num_colors, num_modules),
+                                  NaiveMaxPool(images, k, padding, stride, num_modules))
+
+  def testNoPadding(self):
+    self.Check(3, 4, 9, 3, 0, 2, 4)
+
+  def testClippedWindows(self):
+    # The last windows run past the right and bottom edges.
+    self.Check(2, 3, 13, 3, 0, 2, 7)
+    self.Check(2, 2, 10, 3, 0, 3, 4)
+
+  def testPadding(self):
+    self.Check(2, 3, 8, 3, 1, 2, 4)
+
+class ResponseNormTest(unittest.TestCase):
+
+  def Check(self, num_colors, size, blocked):
+    random = np.random.RandomState(num_colors)
+    images = random.randn(4, num_colors, 5, 5).astype(np.float32)
+    targets = cm.empty((4, num_colors * 25))
+    cc.ResponseNormCrossMap(Mat(images), targets, num_colors, size, 0.01, 0.75, blocked)
+    AssertClose(self, Array(targets, num_colors, 5),
+                NaiveResponseNorm(images.astype(np.float64), size, 0.01, 0.75, blocked))
+
+  def testCrossMap(self):
+    self.Check(16, 5, False)
+    self.Check(7, 4, False)
+
+  def testBlocked(self):
+    self.Check(16, 4, True)
+    self.Check(10, 4, True)
+
+class RGBToYUVTest(unittest.TestCase):
+
+  def testRGBToYUV(self):
+    images = np.random.RandomState(0).rand(3, 3, 5, 5).astype(np.float32)
+    targets = cm.empty((3, 75))
+    cc.RGBToYUV(Mat(images), targets)
+    AssertClose(self, Array(targets, 3, 5), NaiveRGBToYUV(images))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,116 @@
+"""Tests of cpumat against numpy on the logical (row-major) matrices."""
+import os
+import sys
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cpumat as cm
+
+def Random(random, shape):
+  return random.randn(*shape).astype(np.float32)
+
+class CPUMatTest(unittest.TestCase):
+
+  def setUp(self):
+    self.random = np.random.RandomState(0)
+
+  def testLayout(self):
+    a = Random(self.random, (5, 7))
+    m = cm.CUDAMatrix(a)
+    self.assertTrue(m.numpy_array.flags.f_contiguous)
+    self.assertEqual(m.numpy_array.dtype, np.float32)
+    np.testing.assert_array_equal(m.asarray(), a)
+    self.assertEqual(m.T.shape, (7, 5))
+    np.testing.assert_array_equal(m.T.numpy_array, a.T)
+
+  def testReshapeIsAView(self):
+    a = Random(self.random, (4, 6))
+    m = cm.CUDAMatrix(a)
+    m.reshape((-1, 3))
+    self.assertEqual(m.shape, (8, 3))
+    # Reshapes reinterpret the FORTRAN-order buffer, as on the GPU.
+    np.testing.assert_array_equal(m.asarray(), a.T.reshape(3, 8).T)
+    m.reshape((4, -1))
+    np.testing.assert_array_equal(m.asarray(), a)
+    self.assertRaises(cm.CUDAMatException, m.reshape, (5, 5))
+
+  def testSliceIsAView(self):
+    a = Random(self.random, (3, 8))
+    m = cm.CUDAMatrix(a)
+    s = m.slice(2, 5)
+    np.testing.assert_array_equal(s.asarray(), a[:, 2:5])
+    s.assign(0)
+    a[:, 2:5] = 0
+    np.testing.assert_array_equal(m.asarray(), a)
+
+  def testAssignAndOverwrite(self):
+    a = Random(self.random, (3, 4))
+    b = Random(self.random, (3, 4))
+    m = cm.CUDAMatrix(a)
+    m.assign(cm.CUDAMatrix(b))
+    np.testing.assert_array_equal(m.asarray(), b)
+    m.assign(2.5)
+    np.testing.assert_array_equal(m.asarray(), np.full((3, 4), 2.5))
+    buf = m.numpy_array
+    m.overwrite(a)
+    self.assertTrue(m.numpy_array is buf)
+    np.testing.assert_array_equal(m.asarray(), a)
+    m.overwrite(np.ones((2, 2)))
+    self.assertEqual(m.shape, (2, 2))
+    self.assertRaises(ValueError, m.assign, 'x')
+
+  def testRowOps(self):
+    a = Random(self.random, (5, 6))
+    v = np.abs(Random(self.random, (1, 6))) + 0.5
+    m = cm.CUDAMatrix(a)
+    vec = cm.CUDAMatrix(v)
+    t = cm.empty((5, 6))
+    m.add_row_vec(vec, target=t)
+    np.testing.assert_allclose(t.asarray(), a + v, rtol=1e-6)
+    m.add_row_mult(vec, -2, target=t)
+    np.testing.assert_allclose(t.asarray(), a - 2 * v, rtol=1e-6)
+    m.div_by_row(vec, target=t)
+    np.testing.assert_allclose(t.asarray(), a / v, rtol=1e-6)
+    m.add_row_vec(vec)
+    np.testing.assert_allclose(m.asarray(), a + v, rtol=1e-6)
+
+  def testElementwise(self):
+    a = Random(self.random, (4, 5))
+    b = Random(self.random, (4, 5))
+    m = cm.CUDAMatrix(a)
+    t = cm.empty((4, 5))
+    m.mult(3, target=t)
+    np.testing.assert_allclose(t.asarray(), 3 * a, rtol=1e-6)
+    m.mult(cm.CUDAMatrix(b), target=t)
+    np.testing.assert_allclose(t.asarray(), a * b, rtol=1e-6)
+    m.lower_bound(0, target=t)
+    np.testing.assert_array_equal(t.asarray(), np.maximum(a, 0))
+    m.lower_bound(cm.CUDAMatrix(b), target=t)
+    np.testing.assert_array_equal(t.asarray(), np.maximum(a, b))
+
+  def testSoftmax(self):
+    a = 10 * Random(self.random, (6, 11))
+    m = cm.CUDAMatrix(a)
+    m.apply_softmax_row_major()
+    expected = np.zeros(a.shape)
+    for i in range(a.shape[0]):
+      e = np.exp(a[i].astype(np.float64) - a[i].max())
+      expected[i] = e / e.sum()
+    np.testing.assert_allclose(m.asarray(), expected, rtol=1e-5, atol=1e-7)
+
+  def testDot(self):
+    a = Random(self.random, (7, 9))
+    b = Random(self.random, (9, 4))
+    c = Random(self.random, (7, 4))
+    expected = np.dot(a.astype(np.float64), b)
+    t = cm.dot(cm.CUDAMatrix(a), cm.CUDAMatrix(b))
+    np.testing.assert_allclose(t.asarray(), expected, rtol=1e-5, atol=1e-5)
+    t = cm.CUDAMatrix(c)
+    cm.dot(cm.CUDAMatrix(a), cm.CUDAMatrix(b), mult=2, target=t, scale_targets=0.5)
+    np.testing.assert_allclose(t.asarray(), 0.5 * c + 2 * expected, rtol=1e-5, atol=1e-5)
+    t = cm.empty((7, 4))
+    cm.dot(cm.CUDAMatrix(a), cm.CUDAMatrix(b.T.copy()).T, target=t)
+    np.testing.assert_allclose(t.asarray(), expected, rtol=1e-5, atol=1e-5)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,143 @@
+"""Tests of DataHandler on a small HDF5 file whose rows hold their index."""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import h5py
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('CONVNET_BACKEND', 'cpu')
+import convnet_config_pb2
+from data_handler import DataHandler
+
+DATASET_SIZE = 10
+
+class DataHandlerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir_ = tempfile.mkdtemp()
+    with h5py.File(os.path.join(self.dir_, 'data.h5'), 'w') as f:
+      rows = np.arange(DATASET_SIZE)
+      f.create_dataset('data', data=np.column_stack([rows, 10 * rows]).astype(np.float32))
+      f.create_dataset('label', data=rows.astype(np.int32))
+    self.handlers_ = []
+
+  def tearDown(self):
+    for h in self.handlers_:
+      h.Close()
+    shutil.rmtree(self.dir_)
+
+  def GetHandler(self, seed=0, **kwargs):
+    config = convnet_config_pb2.DatasetConfig()
+    for layer_name in ('data', 'label'):
+      dsc = config.data_config.add()
+      dsc.layer_name = layer_name
+      dsc.file_pattern = 'data.h5'
+      dsc.dataset_name = layer_name
+      dsc.data_type = convnet_config_pb2.DataStreamConfig.HDF5
+    for key, value in kwargs.items():
+      setattr(config, key, value)
+    h = DataHandler(config, self.dir_, seed)
+    self.handlers_.append(h)
+    return h
+
+  def GetRows(self, h, num_batches):
+    """Returns the rows of num_batches batches, checking that the streams
+    agree."""
+    rows = []
+    for i in range(num_batches):
+      batch = h.GetBatch()
+      self.assertEqual(batch['data'].shape, (h.GetBatchSize(), 2))
+      self.assertEqual(batch['label'].shape, (h.GetBatchSize(), 1))
+      np.testing.assert_array_equal(batch['data'][:, 0], batch['label'][:, 0])
+      np.testing.assert_array_equal(batch['data'][:, 1], 10 * batch['label'][:, 0])
+      rows.append([int(r) for r in batch['label'][:, 0]])
+    return rows
+
+  def testChunks(self):
+    h = self.GetHandler(batch_size=2, chunk_size=4)
+    # The third chunk wraps around the end of the dataset.
+    self.assertEqual(self.GetRows(h, 7),
+                     [[0, 1], [2, 3], [4, 5], [6, 7], [8, 9], [0, 1], [2, 3]])
+    self.assertEqual(h.GetNumChunks(), 4)
+
+  def testBatchesDoNotSpanChunks(self):
+    h = self.GetHandler(batch_size=3, chunk_size=4)
+    self.assertEqual(self.GetRows(h, 3), [[0, 1, 2], [4, 5, 6], [8, 9, 0]])
+
+  def testWholeDataset(self):
+    h = self.GetHandler(batch_size=4)
+    # A batch that would run past the end of an epoch starts the next one.
+    self.assertEqual(self.GetRows(h, 3), [[0, 1, 2, 3], [4, 5, 6, 7], [0, 1, 2, 3]])
+    self.assertEqual(h.GetNumChunks(), 1)
+
+  def testMaxDatasetSize(self):
+    h = self.GetHandler(batch_size=3, max_dataset_size=6)
+    self.assertEqual(h.GetDataSetSize(), 6)
+    self.assertEqual(self.GetRows(h, 3), [[0, 1, 2], [3, 4, 5], [0, 1, 2]])
+
+  def testSeek(self):
+    h = self.GetHandler(batch_size=2, chunk_size=4)
+    self.GetRows(h, 1)
+    h.Seek(7)
+    self.assertEqual(self.GetRows(h, 2), [[7, 8], [9, 0]])
+
+  def testShuffle(self):
+    h = self.GetHandler(batch_size=5, randomize_gpu=True)
+    epochs = []
+    for i in range(3):
+      rows = sum(self.GetRows(h, 2), [])
+      self.assertEqual(sorted(rows), range(DATASET_SIZE))
+      epochs.append(rows)
+    self.assertNotEqual(epochs[0], epochs[1])
+    self.assertNotEqual(epochs[1], epochs[2])
+
+  def testShuffleChunks(self):
+    h = self.GetHandler(batch_size=2, chunk_size=4, randomize_gpu=True)
+    for chunk in [[0, 1, 2, 3], [4, 5, 6, 7], [0, 1, 8, 9]]:
+      self.assertEqual(sorted(sum(self.GetRows(h, 2), [])), chunk)
+
+  def testShuffleReusesBuffers(self):
+    h = self.GetHandler(batch_size=2, chunk_size=4, randomize_gpu=True,
+                        max_reuse_count=1)
+    def Arrays():
+      return set(id(b) for buffers in h.buffers_ + h.spare_buffers_
+                 for b in buffers.values())
+    arrays = Arrays()
+    for i in range(3):
+      self.assertEqual(len(sum(self.GetRows(h, 4), [])), 8)
+    self.assertEqual(Arrays(), arrays)
+
+  def testMultiplicity(self):
+    h = self.GetHandler(batch_size=2, chunk_size=4, multiplicity=3)
+    self.assertEqual(self.GetRows(h, 7),
+                     [[0, 1]] * 3 + [[2, 3]] * 3 + [[4, 5]])
+
+  def testReuse(self):
+    h = self.GetHandler(batch_size=2, chunk_size=4, max_reuse_count=1,
+                        randomize_gpu=True)
+    rows = self.GetRows(h, 6)
+    # Each chunk is used twice, shuffled again the second time.
+    self.assertEqual(sorted(sum(rows[0:2], [])), [0, 1, 2, 3])
+    self.assertEqual(sorted(sum(rows[2:4], [])), [0, 1, 2, 3])
+    self.assertEqual(sorted(sum(rows[4:6], [])), [4, 5, 6, 7])
+    self.assertEqual(h.GetNumChunks(), 2)
+
+  def testRandomAccessRuns(self):
+    h = self.GetHandler(batch_size=2, chunk_size=6, randomize_cpu=True,
+                        random_access_chunk_size=2)
+    for i in range(4):
+      # Each batch is one run of consecutive rows.
+      for a, b in self.GetRows(h, 3):
+        self.assertEqual(b, (a + 1) % DATASET_SIZE)
+
+  def testPipelineLoads(self):
+    for kwargs in [{}, {'randomize_cpu': True, 'randomize_gpu': True,
+                        'max_reuse_count': 1}]:
+      h = self.GetHandler(batch_size=2, chunk_size=4, **kwargs)
+      p = self.GetHandler(batch_size=2, chunk_size=4, pipeline_loads=True, **kwargs)
+      self.assertEqual(self.GetRows(p, 20), self.GetRows(h, 20))
+
+if __name__ == '__main__':
+  unittest.main()
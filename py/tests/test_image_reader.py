@@ -0,0 +1,69 @@
+"""Tests of ImageCache on small PNG files."""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+from PIL import Image
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from image_reader import DecodeImage, ImageCache
+
+IMAGE_BYTES = 3 * 8 * 8
+
+class ImageCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir_ = tempfile.mkdtemp()
+    random = np.random.RandomState(0)
+    self.files_ = {}
+    for name in 'abcd':
+      size = (16, 8) if name == 'd' else (8, 8)
+      pixels = random.randint(0, 256, size + (3,)).astype(np.uint8)
+      self.files_[name] = os.path.join(self.dir_, name + '.png')
+      Image.fromarray(pixels).save(self.files_[name])
+
+  def tearDown(self):
+    shutil.rmtree(self.dir_)
+
+  def Get(self, cache, names):
+    for name in names:
+      image = cache.Get(self.files_[name])
+      np.testing.assert_array_equal(image, DecodeImage(self.files_[name], 8))
+      self.assertFalse(image.flags.writeable)
+
+  def Held(self, cache):
+    return [f for f in sorted(self.files_) if self.files_[f] in cache.images_]
+
+  def testEviction(self):
+    cache = ImageCache(2 * IMAGE_BYTES, 8)
+    self.Get(cache, 'aba')
+    self.assertEqual(self.Held(cache), ['a', 'b'])
+    # b is now the least recently used.
+    self.Get(cache, 'c')
+    self.assertEqual(self.Held(cache), ['a', 'c'])
+    self.Get(cache, 'b')
+    self.assertEqual(self.Held(cache), ['b', 'c'])
+    stats = cache.GetStats()
+    self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (1, 4, 2))
+    self.assertEqual((stats['images'], stats['bytes']), (2, 2 * IMAGE_BYTES))
+    self.assertAlmostEqual(stats['hit_rate'], 0.2)
+
+  def testLargeImage(self):
+    # d takes two slots and pushes both others out.
+    cache = ImageCache(2 * IMAGE_BYTES, 8)
+    self.Get(cache, 'abd')
+    self.assertEqual(self.Held(cache), ['d'])
+    self.assertEqual(cache.GetStats()['evictions'], 2)
+    cache = ImageCache(IMAGE_BYTES, 8)
+    self.Get(cache, 'ad')
+    self.assertEqual(self.Held(cache), ['a'])
+
+  def testDisabled(self):
+    cache = ImageCache(0, 8)
+    self.Get(cache, 'aa')
+    stats = cache.GetStats()
+    self.assertEqual((stats['hits'], stats['misses'], stats['images']), (0, 2, 0))
+
+if __name__ == '__main__':
+  unittest.main()
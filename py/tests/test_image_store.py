@@ -0,0 +1,100 @@
+"""Tests that images written by WriteImageStore read back through ImageStore
+and DataHandler as they are decoded."""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+from PIL import Image
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('CONVNET_BACKEND', 'cpu')
+import convnet_config_pb2
+from data_handler import DataHandler
+from image_reader import DecodeImage
+from image_store import ALIGNMENT, ImageStore, IsImageStore, WriteImageStore
+
+SIZES = [(12, 10), (10, 16), (10, 10), (15, 11), (10, 13)]
+
+class ImageStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir_ = tempfile.mkdtemp()
+    random = np.random.RandomState(0)
+    self.names_ = []
+    for i, size in enumerate(SIZES):
+      name = 'images/%d.png' % i
+      if not os.path.isdir(os.path.join(self.dir_, 'images')):
+        os.mkdir(os.path.join(self.dir_, 'images'))
+      pixels = random.randint(0, 256, size + (3,)).astype(np.uint8)
+      Image.fromarray(pixels).save(os.path.join(self.dir_, name))
+      self.names_.append(name)
+    self.list_ = os.path.join(self.dir_, 'images.txt')
+    with open(self.list_, 'w') as f:
+      f.write('\n'.join(self.names_) + '\n')
+    self.store_ = os.path.join(self.dir_, 'images.store')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir_)
+
+  def Expected(self, i, size_y, size_x):
+    """Decodes image i and takes its center size_y x size_x crop."""
+    image = DecodeImage(os.path.join(self.dir_, self.names_[i]), 10)
+    top = (image.shape[1] - size_y) / 2
+    left = (image.shape[2] - size_x) / 2
+    return image[:, top:top + size_y, left:left + size_x].reshape(-1)
+
+  def testRoundTrip(self):
+    for num_workers in (0, 2):
+      WriteImageStore(self.list_, self.store_, 10, 7, 9, num_workers)
+      self.assertTrue(IsImageStore(self.store_))
+      self.assertFalse(IsImageStore(self.list_))
+      store = ImageStore(self.store_)
+      self.assertEqual(store.GetDataSetSize(), len(SIZES))
+      self.assertEqual(store.GetDims(), 3 * 7 * 9)
+      self.assertEqual(store.GetRawImageSize(), 10)
+      self.assertEqual(store.GetImageSize(), (7, 9))
+      self.assertEqual(store.GetIds(), self.names_)
+      rows = store.GetRows(0, len(SIZES))
+      self.assertEqual(rows.dtype, np.uint8)
+      self.assertFalse(rows.flags.writeable)
+      for i, name in enumerate(self.names_):
+        self.assertEqual(store.GetRow(name), i)
+        self.assertEqual(rows[i].ctypes.data % ALIGNMENT, 0)
+        np.testing.assert_array_equal(rows[i], self.Expected(i, 7, 9))
+      np.testing.assert_array_equal(store.GetRows(2, 4), rows[2:4])
+      store.Close()
+
+  def testTooLarge(self):
+    self.assertRaises(Exception, WriteImageStore, self.list_, self.store_, 10, 11)
+    self.assertFalse(os.path.exists(self.store_))
+
+  def GetConfig(self, file_pattern, raw_image_size=10):
+    config = convnet_config_pb2.DatasetConfig()
+    config.batch_size = 2
+    config.chunk_size = 3
+    dsc = config.data_config.add()
+    dsc.layer_name = 'input'
+    dsc.file_pattern = file_pattern
+    dsc.data_type = convnet_config_pb2.DataStreamConfig.IMAGE_RAW
+    dsc.raw_image_size = raw_image_size
+    dsc.image_size = 8
+    return config
+
+  def testDataHandler(self):
+    WriteImageStore(self.list_, self.store_, 10, 8, 8)
+    from_store = DataHandler(self.GetConfig('images.store'), self.dir_)
+    from_files = DataHandler(self.GetConfig('images.txt'), self.dir_)
+    try:
+      for i in range(6):
+        a = from_store.GetBatch()['input']
+        b = from_files.GetBatch()['input']
+        self.assertEqual(a.dtype, np.float32)
+        np.testing.assert_array_equal(a, b)
+    finally:
+      from_store.Close()
+      from_files.Close()
+    self.assertRaises(Exception, DataHandler, self.GetConfig('images.store', 12), self.dir_)
+
+if __name__ == '__main__':
+  unittest.main()
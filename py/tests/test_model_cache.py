@@ -0,0 +1,113 @@
+"""Tests of model_cache.LoadModel against ConvNet.Load."""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('CONVNET_BACKEND', 'cpu')
+import convnet as cn
+import model_cache as mc
+from convert_half import ConvertToHalf
+from small_net import WriteSmallNet, GetInput
+from test_params_file import IsMapped
+
+class ModelCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir_ = tempfile.mkdtemp()
+    self.cache_dir_ = os.path.join(self.dir_, 'cache')
+    self.pbtxt_, self.params_ = WriteSmallNet(self.dir_)
+    self.data_ = GetInput(num_images=3)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir_)
+
+  def GetArtifacts(self):
+    return sorted(os.listdir(self.cache_dir_))
+
+  def Output(self, model, channels_last=False):
+    if channels_last:
+      model.SetChannelsLast()
+    model.Fprop(self.data_)
+    return model.GetState('output').copy()
+
+  def Expected(self, params_file=None, channels_last=False):
+    model = cn.ConvNet(self.pbtxt_)
+    model.Load(params_file or self.params_)
+    return self.Output(model, channels_last)
+
+  def testColdWarm(self):
+    expected = self.Expected()
+    cold = mc.LoadModel(self.pbtxt_, self.params_, self.cache_dir_)
+    artifacts = self.GetArtifacts()
+    self.assertEqual(len(artifacts), 1)
+    file_name = os.path.join(self.cache_dir_, artifacts[0])
+    mtime = os.stat(file_name).st_mtime
+    warm = mc.LoadModel(self.pbtxt_, self.params_, self.cache_dir_)
+    self.assertEqual(self.GetArtifacts(), artifacts)
+    self.assertEqual(os.stat(file_name).st_mtime, mtime)
+    np.testing.assert_array_equal(self.Output(cold), expected)
+    np.testing.assert_array_equal(self.Output(warm), expected)
+    # The warm model reads its weights and Winograd filters from the map.
+    edges = [e for e in warm.edge_ if hasattr(e, 'algorithm_')]
+    self.assertTrue(all(IsMapped(e.weights_.numpy_array) for e in edges))
+    winograd = [e for e in edges if e.GetAlgorithm() == 'winograd']
+    self.assertEqual(len(winograd), 1)
+    self.assertTrue(IsMapped(winograd[0].transformed_filters_))
+
+  def testDefaultCacheDir(self):
+    os.environ['CONVNET_MODEL_CACHE'] = self.cache_dir_
+    try:
+      mc.LoadModel(self.pbtxt_, self.params_)
+    finally:
+      del os.environ['CONVNET_MODEL_CACHE']
+    self.assertEqual(len(self.GetArtifacts()), 1)
+
+  def testPbtxtChanged(self):
+    key = mc.GetKey(self.pbtxt_, self.params_)
+    mc.LoadModel(self.pbtxt_, self.params_, self.cache_dir_)
+    with open(self.pbtxt_, 'a') as f:
+      f.write('# Changed.\n')
+    self.assertNotEqual(mc.GetKey(self.pbtxt_, self.params_), key)
+    model = mc.LoadModel(self.pbtxt_, self.params_, self.cache_dir_)
+    self.assertEqual(len(self.GetArtifacts()), 2)
+    np.testing.assert_array_equal(self.Output(model), self.Expected())
+
+  def testParamsChanged(self):
+    key = mc.GetKey(self.pbtxt_, self.params_)
+    mc.LoadModel(self.pbtxt_, self.params_, self.cache_dir_)
+    # Same path and size, new weights. Set the mtime explicitly, in case the
+    # file system keeps it at a coarser resolution than the test runs.
+    mtime = os.stat(self.params_).st_mtime
+    WriteSmallNet(self.dir_, seed=1)
+    os.utime(self.params_, (mtime + 10, mtime + 10))
+    self.assertNotEqual(mc.GetKey(self.pbtxt_, self.params_), key)
+    model = mc.LoadModel(self.pbtxt_, self.params_, self.cache_dir_)
+    self.assertEqual(len(self.GetArtifacts()), 2)
+    np.testing.assert_array_equal(self.Output(model), self.Expected())
+
+  def testHalf(self):
+    half_file = os.path.join(self.dir_, 'half.h5')
+    ConvertToHalf(self.params_, half_file)
+    model = mc.LoadModel(self.pbtxt_, half_file, self.cache_dir_)
+    output = self.Output(model)
+    # The artifact keeps the weights in float16.
+    self.assertEqual(model.edge_[0].weights_half_.dtype, np.float16)
+    np.testing.assert_allclose(output, self.Expected(half_file), rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(output, self.Expected(), rtol=0, atol=1e-2)
+
+  def testChannelsLast(self):
+    model = mc.LoadModel(self.pbtxt_, self.params_, self.cache_dir_)
+    np.testing.assert_allclose(self.Output(model, channels_last=True),
+                               self.Expected(), rtol=1e-5, atol=1e-6)
+    model = mc.LoadModel(self.pbtxt_, self.params_, self.cache_dir_)
+    np.testing.assert_allclose(self.Output(model, channels_last=True),
+                               self.Expected(channels_last=True), rtol=1e-5, atol=1e-6)
+
+  def testNotAnArtifact(self):
+    self.assertRaises(Exception, mc.Artifact, self.pbtxt_)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,107 @@
+"""Tests of ParamsFile and of ConvNet.Load with lazy=True."""
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import h5py
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('CONVNET_BACKEND', 'cpu')
+import cpumat as cm
+import convnet as cn
+from params_file import ParamsFile
+from small_net import WriteSmallNet, GetInput
+
+def IsMapped(array):
+  while isinstance(array, np.ndarray):
+    if isinstance(array, np.memmap):
+      return True
+    array = array.base
+  return isinstance(array, mmap.mmap)
+
+class ParamsFileTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir_ = tempfile.mkdtemp()
+    self.file_ = os.path.join(self.dir_, 'params.h5')
+    random = np.random.RandomState(0)
+    self.w_ = random.randn(6, 4).astype(np.float32)
+    with h5py.File(self.file_, 'w') as f:
+      f.create_dataset('mapped', data=self.w_)
+      f.create_dataset('chunked', data=self.w_, chunks=(2, 4), compression='gzip')
+      f.create_dataset('half', data=self.w_.astype(np.float16))
+
+  def tearDown(self):
+    shutil.rmtree(self.dir_)
+
+  def testMap(self):
+    p = ParamsFile(self.file_)
+    mat = cm.empty((4, 6))
+    p.ReadInto('mapped', mat)
+    np.testing.assert_array_equal(mat.asarray(), self.w_.T)
+    self.assertTrue(mat.numpy_array.flags.f_contiguous)
+    self.assertTrue(IsMapped(mat.numpy_array))
+    # The map is copy-on-write.
+    mat.assign(0)
+    p.Close()
+    with h5py.File(self.file_, 'r') as f:
+      np.testing.assert_array_equal(f['mapped'][()], self.w_)
+
+  def testReadDirect(self):
+    p = ParamsFile(self.file_)
+    self.assertTrue(p.Map('chunked') is None)
+    mat = cm.empty((4, 6))
+    buf = mat.numpy_array
+    p.ReadInto('chunked', mat)
+    self.assertTrue(mat.numpy_array is buf)
+    np.testing.assert_array_equal(mat.asarray(), self.w_.T)
+    np.testing.assert_array_equal(p.Read('chunked', (4, 6)), self.w_.T)
+    p.Close()
+
+  def testHalf(self):
+    p = ParamsFile(self.file_)
+    w = p.Read('half', (4, 6))
+    self.assertEqual(w.dtype, np.float16)
+    np.testing.assert_array_equal(w, self.w_.T.astype(np.float16))
+    p.Close()
+
+  def testClosedAfterLastReader(self):
+    p = ParamsFile(self.file_)
+    p.AddReader()
+    p.AddReader()
+    p.Done()
+    self.assertTrue(p.f_.id.valid)
+    p.Done()
+    self.assertFalse(p.f_.id.valid)
+
+class LazyLoadTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir_ = tempfile.mkdtemp()
+    self.pbtxt_, self.params_ = WriteSmallNet(self.dir_)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir_)
+
+  def testLazyLoad(self):
+    model = cn.ConvNet(self.pbtxt_)
+    model.Load(self.params_)
+    model.Fprop(GetInput())
+    expected = model.GetState('output').copy()
+
+    model = cn.ConvNet(self.pbtxt_)
+    model.Load(self.params_, lazy=True)
+    params = model.edge_[0].params_
+    self.assertTrue(params.f_.id.valid)
+    model.Fprop(GetInput(), targets=['c1'])
+    self.assertTrue(params.f_.id.valid)
+    model.Fprop(GetInput())
+    # Every edge has read its parameters, so the file is closed.
+    self.assertFalse(params.f_.id.valid)
+    np.testing.assert_allclose(model.GetState('output'), expected, rtol=1e-6, atol=1e-7)
+    self.assertEqual(len(model.GetLoadTimes()), 4)
+
+if __name__ == '__main__':
+  unittest.main()
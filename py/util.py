@@ -1,20 +1,32 @@
 import numpy as np
-import cudamat as cm
-from cudamat import cudamat_conv as cc
+import os
 import sys
 import h5py
+import time
 from time import sleep
 from google.protobuf import text_format
 import convnet_config_pb2
 
-"""
-This script uses the GPU locking system used at University of Toronto.
-Please modify this accordingly for your GPU resource environment.
-"""
-from cudamat import gpu_lock2 as gpu_lock
+# Set CONVNET_BACKEND=cpu to run on hosts without a GPU.
+USE_CPU = os.environ.get('CONVNET_BACKEND', 'gpu') == 'cpu'
+
+if USE_CPU:
+  import cpumat as cm
+  import cpuconv as cc
+else:
+  import cudamat as cm
+  from cudamat import cudamat_conv as cc
+
+  """
+  This script uses the GPU locking system used at University of Toronto.
+  Please modify this accordingly for your GPU resource environment.
+  """
+  from cudamat import gpu_lock2 as gpu_lock
 
 def LockGPU(max_retries=10):
   """ Locks a free GPU board and returns its id. """
+  if USE_CPU:
+    return -1
   for retry_count in range(max_retries):
     board = gpu_lock.obtain_lock_id()
     if board != -1:
@@ -30,5 +42,7 @@ def LockGPU(max_retries=10):
 
 def FreeGPU(board):
   """ Frees the board. """
+  if USE_CPU:
+    return
   cm.cublas_shutdown()
   gpu_lock.free_lock(board)